@@ -0,0 +1,369 @@
+"""Background dispatcher for AI requests.
+
+Model calls used to run inside the Streamlit script thread, so a slow or
+overloaded upstream froze that session and nothing bounded how many calls
+the process had in flight. ``AIDispatcher`` runs them on a fixed pool of
+worker threads (the global concurrency limit) fed by per-user queues served
+round-robin, so one farmer's burst cannot starve the others. Each job has a
+deadline, retryable failures are retried with jittered exponential backoff,
+and identical in-flight requests share one job. The page polls the job's
+text while it streams (``python ai_dispatcher.py`` runs a load test against
+the offline fake client and exits non-zero when a fairness, dedup, retry or
+timeout check fails).
+"""
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+from assistant import ResponseStream
+
+MAX_CONCURRENT_REQUESTS = 4
+MAX_QUEUED_PER_USER = 3
+REQUEST_TIMEOUT_S = 60.0
+MAX_ATTEMPTS = 3
+BACKOFF_BASE_S = 1.0
+BACKOFF_MAX_S = 20.0
+# How often a page refreshes the text of a job it is waiting on
+POLL_INTERVAL_S = 0.1
+# Finished jobs are kept this long for the page to collect them
+RESULT_TTL_S = 300.0
+
+# Rate limits, request timeouts, conflicts, server errors and "overloaded"
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+RETRYABLE_ERRORS = {'APIConnectionError', 'APITimeoutError'}
+
+
+class DispatcherBusy(Exception):
+    """Raised when a user already has MAX_QUEUED_PER_USER requests waiting."""
+
+
+def is_retryable(error):
+    if type(error).__name__ in RETRYABLE_ERRORS:
+        return True
+    return getattr(error, 'status_code', None) in RETRYABLE_STATUS
+
+
+def backoff_delay(attempt, error=None, base=BACKOFF_BASE_S, cap=BACKOFF_MAX_S):
+    """Full-jitter exponential backoff, or the server's Retry-After when it sent one."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return min(float(headers['retry-after']), cap)
+    except (KeyError, TypeError, ValueError):
+        return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def request_key(request, user_id=None):
+    """Dedup key of a request; ``user_id`` scopes it to one farmer when tools read their data."""
+    payload = json.dumps([user_id, request], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class AIJob:
+    """One queued model request, polled by the page while a worker streams it.
+
+    ``status`` moves from ``queued`` to ``running`` and ends as ``completed``,
+    ``failed``, ``timed_out`` or ``cancelled``; ``text`` grows as tokens
+    arrive and ``response`` is the last attempt's ``ResponseStream``.
+    """
+
+    def __init__(self, job_id, user_id, key, request, run_tool=None, timeout_s=REQUEST_TIMEOUT_S, labels=None):
+        self.id = job_id
+        self.user_id = user_id
+        self.key = key
+        self.request = request
+        self.run_tool = run_tool
+        self.labels = labels or {}
+        self.status = 'queued'
+        self.text = ""
+        self.error = None
+        self.response = None
+        self.attempts = 0
+        self.subscribers = 1
+        self.submitted_at = time.monotonic()
+        self.deadline = self.submitted_at + timeout_s
+        self.ready_at = self.submitted_at
+        self.started_at = None
+        self.first_text_at = None
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def is_set(self):
+        """Stop signal for ``ResponseStream``: a cancel request or the job's deadline."""
+        return self._cancel.is_set() or time.monotonic() >= self.deadline
+
+    def _finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.finished_at = time.monotonic()
+        self._done.set()
+
+
+class AIDispatcher:
+    """Worker pool running AI requests with fairness, deadlines, retries and dedup."""
+
+    def __init__(self, client, workers=MAX_CONCURRENT_REQUESTS, max_queued_per_user=MAX_QUEUED_PER_USER,
+                 timeout_s=REQUEST_TIMEOUT_S, max_attempts=MAX_ATTEMPTS, backoff_base_s=BACKOFF_BASE_S,
+                 on_finish=None):
+        self.client = client
+        self.on_finish = on_finish
+        self.max_queued_per_user = max_queued_per_user
+        self.timeout_s = timeout_s
+        self.max_attempts = max_attempts
+        self.backoff_base_s = backoff_base_s
+        self._queues = OrderedDict()   # user_id -> deque of jobs, in round-robin order
+        self._jobs = {}                # job id -> job, until RESULT_TTL_S after it ends
+        self._by_key = {}              # dedup key -> queued or running job
+        self._ids = itertools.count(1)
+        self._ready = threading.Condition()
+        self._running = 0
+        self.stats = {'submitted': 0, 'deduplicated': 0, 'retries': 0, 'completed': 0, 'failed': 0,
+                      'timed_out': 0, 'cancelled': 0, 'rejected': 0, 'max_running': 0,
+                      'report_errors': 0}
+        self._workers = [threading.Thread(target=self._work, name=f"ai-worker-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, user_id, system, messages, tools=None, run_tool=None, shared=False, labels=None, **options):
+        """Queue a request and return its job, or the identical job already in flight.
+
+        ``shared`` requests do not depend on the farmer, so they are deduplicated
+        across users; anything else only against the same user's requests.
+        ``labels`` are passed through to the ``on_finish`` hook untouched.
+        """
+        request = {'system': system, 'messages': messages, 'tools': tools, **options}
+        key = request_key(request, None if shared else user_id)
+        with self._ready:
+            self._expire()
+            job = self._by_key.get(key)
+            if job is not None:
+                job.subscribers += 1
+                self.stats['deduplicated'] += 1
+                return job
+            queue = self._queues.get(user_id)
+            if queue is not None and len(queue) >= self.max_queued_per_user:
+                self.stats['rejected'] += 1
+                raise DispatcherBusy(f"{len(queue)} requests already waiting")
+
+            job = AIJob(next(self._ids), user_id, key, request, run_tool, self.timeout_s, labels)
+            self._jobs[job.id] = self._by_key[key] = job
+            self._queues.setdefault(user_id, deque()).append(job)
+            self.stats['submitted'] += 1
+            self._ready.notify()
+        return job
+
+    def get(self, job_id):
+        with self._ready:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Stop a job once nobody else waits on it; a queued one is dropped, a running one
+        stops at its next token."""
+        with self._ready:
+            job = self._jobs.get(job_id)
+            if job is None or job.done:
+                return
+            job.subscribers -= 1
+            if job.subscribers > 0:
+                return
+            job._cancel.set()
+            queue = self._queues.get(job.user_id)
+            if job.status != 'queued' or queue is None or job not in queue:
+                return
+            queue.remove(job)
+            if not queue:
+                del self._queues[job.user_id]
+            self._settle(job, 'cancelled')
+        self._report(job)
+
+    def _report(self, job):
+        # Outside the lock: the hook may write to the database
+        if self.on_finish is None:
+            return
+        try:
+            self.on_finish(job)
+        except Exception:
+            self.stats['report_errors'] += 1
+
+    def _expire(self):
+        now = time.monotonic()
+        for job_id in [i for i, job in self._jobs.items() if job.done and now - job.finished_at > RESULT_TTL_S]:
+            del self._jobs[job_id]
+
+    def _settle(self, job, status, error=None):
+        # Called with the lock held
+        if self._by_key.get(job.key) is job:
+            del self._by_key[job.key]
+        self.stats[status] += 1
+        job._finish(status, error)
+
+    def _next_job(self):
+        """Round-robin over users whose next job is ready; waits while none is."""
+        with self._ready:
+            while True:
+                now = time.monotonic()
+                wake = None
+                for user_id, queue in self._queues.items():
+                    job = queue[0]
+                    if job.ready_at <= now:
+                        queue.popleft()
+                        if queue:
+                            self._queues.move_to_end(user_id)
+                        else:
+                            del self._queues[user_id]
+                        self._running += 1
+                        self.stats['max_running'] = max(self.stats['max_running'], self._running)
+                        job.status = 'running'
+                        return job
+                    wake = job.ready_at if wake is None else min(wake, job.ready_at)
+                self._ready.wait(None if wake is None else wake - now)
+
+    def _requeue(self, job, delay):
+        # Called with the lock held; the job goes back to the front of its user's queue
+        job.status = 'queued'
+        job.ready_at = time.monotonic() + delay
+        self._queues.setdefault(job.user_id, deque()).appendleft(job)
+        self.stats['retries'] += 1
+        self._ready.notify()
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            try:
+                self._attempt(job)
+            except Exception as error:
+                # Anything escaping the stream (a bad client, a bug) fails this job
+                # only: the worker stays in the pool and the page stops polling
+                with self._ready:
+                    settle = not job.done
+                    if settle:
+                        self._settle(job, 'failed', error)
+                if settle:
+                    self._report(job)
+            finally:
+                with self._ready:
+                    self._running -= 1
+
+    def _attempt(self, job):
+        if job.is_set():
+            with self._ready:
+                self._settle(job, 'cancelled' if job._cancel.is_set() else 'timed_out')
+            self._report(job)
+            return
+        job.attempts += 1
+        job.started_at = job.started_at or time.monotonic()
+        client = self.client
+        if hasattr(client, 'with_options'):
+            # Bound each HTTP request by what is left of the job's deadline; retries are ours
+            client = client.with_options(timeout=max(job.deadline - time.monotonic(), 1.0), max_retries=0)
+        request = {k: v for k, v in job.request.items() if v is not None}
+        response = job.response = ResponseStream(client, cancel=job, run_tool=job.run_tool, **request)
+        for _ in response:
+            job.text = response.text
+            job.first_text_at = job.first_text_at or time.monotonic()
+
+        with self._ready:
+            remaining = job.deadline - time.monotonic()
+            if response.completed:
+                self._settle(job, 'completed')
+            elif job._cancel.is_set():
+                self._settle(job, 'cancelled')
+            elif response.cancelled:
+                self._settle(job, 'timed_out', TimeoutError(f"no answer within {self.timeout_s:.0f} s"))
+            elif (is_retryable(response.error) and not response.text and job.attempts < self.max_attempts
+                  and remaining > 0):
+                # Nothing was shown yet, so the request can be replayed from scratch
+                self._requeue(job, min(backoff_delay(job.attempts, response.error, self.backoff_base_s),
+                                       remaining))
+                return
+            else:
+                self._settle(job, 'failed', response.error)
+        self._report(job)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from ai_metrics import percentile
+    from assistant import FakeAnthropic
+
+    parser = argparse.ArgumentParser(description="Load-test the AI dispatcher against the offline fake client")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=3, help="questions per user, sent at once")
+    parser.add_argument('--workers', type=int, default=MAX_CONCURRENT_REQUESTS)
+    parser.add_argument('--fail-rate', type=float, default=0.2, help="share of calls answered 'overloaded'")
+    parser.add_argument('--duplicates', type=float, default=0.25, help="share of questions that are shared")
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT_S)
+    args = parser.parse_args()
+
+    client = FakeAnthropic(first_token_delay=0.2, token_delay=0.01, fail_rate=args.fail_rate, seed=1)
+    dispatcher = AIDispatcher(client, workers=args.workers, max_queued_per_user=args.requests,
+                              timeout_s=args.timeout, backoff_base_s=0.2)
+    rng = random.Random(2)
+    failures = []
+
+    def check(ok, label):
+        print(f"  {'ok' if ok else 'FAIL'}: {label}")
+        if not ok:
+            failures.append(label)
+
+    started = time.monotonic()
+    jobs, shared_jobs = [], []
+    # Each farmer sends a burst; a FIFO queue would serve the last farmer only after all the others.
+    # Holding the dispatcher lock queues the whole burst before any worker picks a job, so the
+    # order jobs start in is down to the round-robin alone.
+    with dispatcher._ready:
+        for user_id in range(args.users):
+            for n in range(args.requests):
+                shared = rng.random() < args.duplicates
+                question = "How to increase milk yield?" if shared else f"Question {n} from farmer {user_id}"
+                job = dispatcher.submit(user_id, "system", [{'role': 'user', 'content': question}], shared=shared)
+                jobs.append(job)
+                if shared:
+                    shared_jobs.append(job)
+    finished = all(job.wait(args.timeout * args.requests * args.users) for job in jobs)
+    elapsed = time.monotonic() - started
+
+    unique = {job.id: job for job in jobs}.values()
+    latencies = [job.finished_at - job.submitted_at for job in unique if job.done]
+    first_done = {}
+    for job in sorted((j for j in unique if j.done), key=lambda j: j.finished_at):
+        first_done.setdefault(job.user_id, job.finished_at - started)
+    print(f"{len(jobs)} requests from {args.users} users -> {len(unique)} model jobs in {elapsed:.1f} s "
+          f"({args.workers} workers, max {dispatcher.stats['max_running']} running)")
+    print(f"latency p50 {percentile(latencies, 50):.2f} s, p95 {percentile(latencies, 95):.2f} s; "
+          f"first answer per user within {max(first_done.values()):.2f} s")
+    print(', '.join(f"{k} {v}" for k, v in dispatcher.stats.items()))
+
+    check(finished and all(job.status in ('completed', 'failed', 'timed_out') for job in unique),
+          "every job finishes")
+    check(dispatcher.stats['max_running'] <= args.workers, f"at most {args.workers} jobs run at once")
+    check(len({job.id for job in shared_jobs}) <= 1 and dispatcher.stats['deduplicated'] == len(jobs) - len(unique),
+          "duplicate questions share one job")
+    check(all(job.attempts <= dispatcher.max_attempts for job in unique),
+          f"retries stay within {dispatcher.max_attempts} attempts")
+    check(args.fail_rate == 0 or dispatcher.stats['retries'] > 0, "overloaded answers are retried")
+    # Round-robin starts every farmer's first job before anyone's second; the
+    # worker count allows for workers racing each other to record the start
+    order = [job.user_id for job in sorted(unique, key=lambda j: j.started_at)]
+    senders = set(order)
+    check(all(order.index(user_id) < len(senders) + args.workers for user_id in senders),
+          "every farmer's first job starts in the first round")
+
+    # A request that cannot answer within its deadline is cut off and reported as timed out
+    slow = AIDispatcher(FakeAnthropic(first_token_delay=0.5, token_delay=0.01), workers=1, timeout_s=0.2)
+    job = slow.submit(0, "system", [{'role': 'user', 'content': "slow question"}])
+    check(job.wait(5) and job.status == 'timed_out', "a request past its deadline ends timed out")
+    raise SystemExit(1 if failures else 0)
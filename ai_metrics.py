@@ -0,0 +1,111 @@
+"""Per-call instrumentation of the AI assistant.
+
+Every answer, whether it came from the model, the shared response cache or
+ended in an error, is written to ``ai_usage`` with its latencies, token
+counts, estimated cost and the farmer it was for. ``usage_summary`` turns a
+time window of those rows into the figures needed to budget and tune the
+assistant (``python database.py ai-usage``).
+"""
+import time
+
+from assistant import MODEL
+from database import get_connection
+
+# USD per million tokens: input, output, prompt-cache read, prompt-cache write
+MODEL_PRICES = {
+    MODEL: (3.00, 15.00, 0.30, 3.75),
+}
+SUMMARY_WINDOW_DAYS = 7
+TOP_USERS = 10
+
+_TOKEN_FIELDS = ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+
+
+def call_cost(model, usage):
+    """Estimated USD cost of a call from its usage counts; 0 for unknown models."""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return 0.0
+    return sum(price * (usage.get(field) or 0) for price, field in zip(prices, _TOKEN_FIELDS)) / 1_000_000
+
+
+def record_ai_call(conn, user_id, district, kind, model, status, error_class=None, attempts=1, tool_calls=0,
+                   queue_s=None, ttft_s=None, duration_s=None, usage=None, created_at=None):
+    usage = usage or {}
+    conn.execute("""INSERT INTO ai_usage
+                    (created_at, user_id, district, kind, model, status, error_class, attempts, tool_calls,
+                     queue_s, ttft_s, duration_s, input_tokens, output_tokens, cache_read_tokens,
+                     cache_write_tokens, cost_usd)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                 (created_at or time.time(), user_id, district, kind, model, status, error_class, attempts,
+                  tool_calls, queue_s, ttft_s, duration_s,
+                  *(usage.get(field) or 0 for field in _TOKEN_FIELDS), call_cost(model, usage)))
+
+
+def record_job(job):
+    """``AIDispatcher`` finish hook: store one finished job's metrics.
+
+    Latencies are what the farmer saw, measured from submission, so time
+    spent queued or backing off between retries is included.
+    """
+    response = job.response
+    message = getattr(response, 'message', None)
+    with get_connection() as conn:
+        record_ai_call(
+            conn, job.labels.get('user_id', job.user_id), job.labels.get('district'),
+            job.labels.get('kind', 'chat'), getattr(message, 'model', None) or job.request.get('model', MODEL),
+            job.status, type(job.error).__name__ if job.error is not None else None,
+            attempts=job.attempts, tool_calls=len(getattr(job.run_tool, 'calls', ())),
+            queue_s=job.started_at - job.submitted_at if job.started_at else None,
+            ttft_s=job.first_text_at - job.submitted_at if job.first_text_at else None,
+            duration_s=job.finished_at - job.submitted_at,
+            usage=response.usage if response is not None else None)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values``; None when empty."""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(max(int(round(len(values) * pct / 100.0)) - 1, 0), len(values) - 1)]
+
+
+def usage_summary(conn, since=None, now=None):
+    """Calls, errors, tokens, cost and latency percentiles since ``since`` (default: last 7 days)."""
+    now = now or time.time()
+    since = since if since is not None else now - SUMMARY_WINDOW_DAYS * 86400
+    totals = conn.execute("""SELECT COUNT(*), COALESCE(SUM(status != 'completed'), 0),
+                                    COALESCE(SUM(input_tokens), 0), COALESCE(SUM(output_tokens), 0),
+                                    COALESCE(SUM(cache_read_tokens), 0), COALESCE(SUM(cache_write_tokens), 0),
+                                    COALESCE(SUM(cost_usd), 0), COALESCE(SUM(attempts - 1), 0),
+                                    COALESCE(SUM(kind = 'response_cache'), 0)
+                             FROM ai_usage WHERE created_at >= ?""", (since,)).fetchone()
+    calls, errors, input_tokens, output_tokens, cache_read, cache_write, cost, retries, cache_answers = totals
+
+    latencies = conn.execute("""SELECT ttft_s, duration_s FROM ai_usage
+                                WHERE created_at >= ? AND status='completed' AND kind != 'response_cache'""",
+                             (since,)).fetchall()
+    ttft = [row[0] for row in latencies if row[0] is not None]
+    duration = [row[1] for row in latencies if row[1] is not None]
+
+    by_error = conn.execute("""SELECT COALESCE(error_class, status), COUNT(*) FROM ai_usage
+                               WHERE created_at >= ? AND status != 'completed'
+                               GROUP BY 1 ORDER BY 2 DESC""", (since,)).fetchall()
+    by_user = conn.execute("""SELECT user_id, district, COUNT(*), SUM(input_tokens + output_tokens), SUM(cost_usd)
+                              FROM ai_usage WHERE created_at >= ?
+                              GROUP BY user_id ORDER BY 5 DESC LIMIT ?""", (since, TOP_USERS)).fetchall()
+
+    prompt_tokens = input_tokens + cache_read + cache_write
+    return {
+        'calls': calls, 'errors': errors, 'error_rate': errors / calls if calls else 0.0,
+        'retries': retries, 'response_cache_answers': cache_answers,
+        'input_tokens': input_tokens, 'output_tokens': output_tokens,
+        'cache_read_tokens': cache_read, 'cache_write_tokens': cache_write,
+        'prompt_cache_ratio': cache_read / prompt_tokens if prompt_tokens else 0.0,
+        'cost_usd': cost,
+        'ttft_s': {f"p{p}": percentile(ttft, p) for p in (50, 90, 99)},
+        'duration_s': {f"p{p}": percentile(duration, p) for p in (50, 90, 99)},
+        'errors_by_class': dict(by_error),
+        'top_users': [{'user_id': r[0], 'district': r[1], 'calls': r[2], 'tokens': r[3], 'cost_usd': r[4]}
+                      for r in by_user],
+    }
@@ -0,0 +1,190 @@
+"""Read-only farm-data tools the AI assistant can call.
+
+Instead of pasting tables into the prompt, the model is offered a few
+typed tools backed by indexed aggregate queries and asks for exactly the
+numbers it needs. Results are cached per tool and arguments against the
+write versions of the tables behind them, and ``ToolRunner`` enforces a
+wall-clock budget for all tool calls made while answering one question.
+"""
+import json
+import time
+from datetime import datetime
+
+import farm_events
+from database import get_connection
+from querycache import cached_value
+
+TOOL_LATENCY_BUDGET_S = 2.0
+MAX_RESULT_ROWS = 20
+
+TOOLS = [
+    {
+        'name': 'animal_yield_stats',
+        'description': ("Per-buffalo milk yield for the farmer's herd: average litres per day and fat % "
+                        "over the last `days`, the change against the `days` before that, and the herd "
+                        "average. Use it to find top, under-performing or declining animals, or to look "
+                        "up one animal by tag."),
+        'input_schema': {
+            'type': 'object',
+            'properties': {
+                'days': {'type': 'integer', 'minimum': 7, 'maximum': 365, 'default': 30},
+                'order': {'type': 'string', 'enum': ['lowest', 'highest', 'declining'], 'default': 'lowest'},
+                'limit': {'type': 'integer', 'minimum': 1, 'maximum': MAX_RESULT_ROWS, 'default': 10},
+                'tag_number': {'type': 'string', 'description': "Only this animal"},
+            },
+        },
+    },
+    {
+        'name': 'cost_per_litre',
+        'description': ("Milk produced, milk revenue, recorded expenses by category and the resulting "
+                        "cost and margin per litre over the last `days`."),
+        'input_schema': {
+            'type': 'object',
+            'properties': {
+                'days': {'type': 'integer', 'minimum': 7, 'maximum': 365, 'default': 30},
+            },
+        },
+    },
+    {
+        'name': 'upcoming_events',
+        'description': ("Expected calvings, vaccinations due, health follow-ups, predicted heats and calf "
+                        "weaning in the next `days`, soonest first."),
+        'input_schema': {
+            'type': 'object',
+            'properties': {
+                'days': {'type': 'integer', 'minimum': 1, 'maximum': 180, 'default': 30},
+            },
+        },
+    },
+]
+
+_SCHEMAS = {tool['name']: tool['input_schema']['properties'] for tool in TOOLS}
+
+
+def _arguments(name, raw):
+    """Validate and default tool input against its schema; raises ValueError."""
+    args = {}
+    for key, spec in _SCHEMAS[name].items():
+        value = (raw or {}).get(key, spec.get('default'))
+        if value is None:
+            continue
+        if spec['type'] == 'integer':
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{key} must be an integer")
+            value = min(max(value, spec['minimum']), spec['maximum'])
+        else:
+            value = str(value)
+            if 'enum' in spec and value not in spec['enum']:
+                raise ValueError(f"{key} must be one of {', '.join(spec['enum'])}")
+        args[key] = value
+    return args
+
+
+def animal_yield_stats(conn, user_id, days, order, limit, tag_number=None, today=None):
+    params = {'u': user_id, 'today': str(today or datetime.now().date()),
+              'recent': f"-{days} days", 'window': f"-{2 * days} days", 'tag': tag_number}
+    rows = conn.execute("""SELECT bi.tag_number, bi.name, bi.breed, bi.current_lactation,
+                                  SUM(CASE WHEN mp.date > date(:today, :recent) THEN mp.total_yield END)
+                                  / NULLIF(COUNT(DISTINCT CASE WHEN mp.date > date(:today, :recent)
+                                                              THEN mp.date END), 0),
+                                  SUM(CASE WHEN mp.date <= date(:today, :recent) THEN mp.total_yield END)
+                                  / NULLIF(COUNT(DISTINCT CASE WHEN mp.date <= date(:today, :recent)
+                                                              THEN mp.date END), 0),
+                                  AVG(CASE WHEN mp.date > date(:today, :recent) THEN mp.fat_percentage END),
+                                  COUNT(DISTINCT CASE WHEN mp.date > date(:today, :recent) THEN mp.date END)
+                           FROM milk_production mp
+                           JOIN buffalo_inventory bi ON bi.id = mp.buffalo_id
+                           WHERE mp.user_id=:u AND mp.date > date(:today, :window) AND mp.date <= :today
+                           AND (:tag IS NULL OR bi.tag_number = :tag)
+                           GROUP BY mp.buffalo_id""", params).fetchall()
+
+    animals = [{'tag_number': r[0], 'name': r[1], 'breed': r[2], 'lactation': r[3],
+                'litres_per_day': round(r[4], 2),
+                'previous_litres_per_day': round(r[5], 2) if r[5] is not None else None,
+                'change_pct': round((r[4] - r[5]) / r[5] * 100, 1) if r[5] else None,
+                'avg_fat_pct': round(r[6], 2) if r[6] is not None else None,
+                'days_recorded': r[7]}
+               for r in rows if r[4] is not None]
+    herd_average = (round(sum(a['litres_per_day'] for a in animals) / len(animals), 2)
+                    if animals else None)
+
+    if order == 'declining':
+        animals.sort(key=lambda a: a['change_pct'] if a['change_pct'] is not None else float('inf'))
+    else:
+        animals.sort(key=lambda a: a['litres_per_day'], reverse=order == 'highest')
+    return {'days': days, 'animals_with_records': len(animals), 'herd_average_litres_per_day': herd_average,
+            'animals': animals[:limit]}
+
+
+def cost_per_litre(conn, user_id, days, today=None):
+    params = {'u': user_id, 'today': str(today or datetime.now().date()), 'recent': f"-{days} days"}
+    litres, revenue = conn.execute("""SELECT COALESCE(SUM(total_litres), 0), COALESCE(SUM(revenue), 0)
+                                      FROM milk_daily_summary
+                                      WHERE user_id=:u AND date > date(:today, :recent) AND date <= :today""",
+                                   params).fetchone()
+    expenses = dict(conn.execute("""SELECT COALESCE(category, 'Other'), SUM(amount) FROM financial_records
+                                    WHERE user_id=:u AND date > date(:today, :recent) AND date <= :today
+                                    AND transaction_type='Expense'
+                                    GROUP BY 1 ORDER BY 2 DESC""", params).fetchall())
+    total_expense = sum(expenses.values())
+
+    def per_litre(amount):
+        return round(amount / litres, 2) if litres else None
+
+    return {'days': days, 'litres': round(litres, 1), 'milk_revenue': round(revenue),
+            'expenses_by_category': {k: round(v) for k, v in expenses.items()},
+            'total_expenses': round(total_expense),
+            'cost_per_litre': per_litre(total_expense), 'revenue_per_litre': per_litre(revenue),
+            'margin_per_litre': per_litre(revenue - total_expense)}
+
+
+def upcoming_events(conn, user_id, days, today=None):
+    events = farm_events.upcoming_events(conn, user_id, days, today, limit=MAX_RESULT_ROWS)
+    return {'days': days, 'events': [{'date': e['date'], 'type': e['label'], 'tag_number': e['tag_number'],
+                                      'name': e['name'], 'detail': e['detail']} for e in events]}
+
+
+# tool name -> (implementation, tables its result depends on)
+TOOL_HANDLERS = {
+    'animal_yield_stats': (animal_yield_stats, ('buffalo_inventory', 'milk_production')),
+    'cost_per_litre': (cost_per_litre, ('milk_production', 'financial_records')),
+    'upcoming_events': (upcoming_events, farm_events.EVENT_TABLES),
+}
+
+
+class ToolRunner:
+    """Executes the model's tool calls for one user within a shared latency budget.
+
+    Calls after the budget is spent are answered with an error telling the
+    model to answer from what it already has, so a chain of tool calls cannot
+    hold the farmer's answer hostage.
+    """
+
+    def __init__(self, user_id, budget_s=TOOL_LATENCY_BUDGET_S):
+        self.user_id = user_id
+        self.budget_s = budget_s
+        self.spent_s = 0.0
+        self.calls = []
+
+    def __call__(self, name, raw_input):
+        """Run one tool call and return ``(result_json, is_error)``."""
+        if name not in TOOL_HANDLERS:
+            return json.dumps({'error': f"unknown tool {name}"}), True
+        if self.spent_s >= self.budget_s:
+            return json.dumps({'error': "data lookup budget used up; answer with the data already retrieved"}), True
+        try:
+            args = _arguments(name, raw_input)
+        except ValueError as e:
+            return json.dumps({'error': str(e)}), True
+
+        handler, tables = TOOL_HANDLERS[name]
+        started = time.perf_counter()
+        with get_connection() as conn:
+            result = cached_value(conn, self.user_id, ('tool', name, json.dumps(args, sort_keys=True)), tables,
+                                  lambda: json.dumps(handler(conn, self.user_id, **args)))
+        elapsed = time.perf_counter() - started
+        self.spent_s += elapsed
+        self.calls.append((name, args, elapsed))
+        return result, False
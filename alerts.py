@@ -0,0 +1,251 @@
+"""Materialized alert engine.
+
+Alerts live in the ``alerts`` table instead of being recomputed on every
+render. Writes to breeding, vaccination and feed-inventory rows re-evaluate
+just the affected row through write hooks, and a once-a-day sweep per user
+picks up alerts that become due purely because the calendar moved on. Heat
+windows come from ``heat_cycles`` and are re-predicted for the one animal
+whose heat or breeding record was written; the same prediction is stored as
+the ``heat_expected`` events of ``farm_events``. Milk records feed the
+streaming baselines in ``anomalies``, and only the animals whose deviation
+changed have their ``milk_anomaly`` alert re-evaluated.
+"""
+from datetime import date, datetime, timedelta
+
+from anomalies import ALERT_KEEP_DAYS, HIGH_Z, METRICS, update_yield_baselines
+from database import register_write_hook
+from farm_events import store_predicted_heats
+from heat_cycles import predict_heats
+
+CALVING_WINDOW_DAYS = 30
+VACCINATION_WINDOW_DAYS = 15
+HEAT_WINDOW_DAYS = 3
+PRIORITY_ORDER = {'high': 0, 'medium': 1, 'low': 2}
+
+
+def _as_date(value):
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+def _calving_alerts(conn, user_id, today, record_id=None):
+    sql = """SELECT br.id, br.buffalo_id, bi.name, bi.tag_number, br.expected_calving_date
+             FROM breeding_records br
+             JOIN buffalo_inventory bi ON br.buffalo_id = bi.id
+             WHERE br.user_id=? AND br.pregnancy_status='Pregnant'
+             AND br.expected_calving_date BETWEEN ? AND ?"""
+    params = [user_id, today, today + timedelta(days=CALVING_WINDOW_DAYS)]
+    if record_id is not None:
+        sql += " AND br.id=?"
+        params.append(record_id)
+
+    alerts = {}
+    for source_id, buffalo_id, name, tag, due in conn.execute(sql, params):
+        days_until = (_as_date(due) - today).days
+        alerts[source_id] = (
+            buffalo_id, due,
+            f"{name} ({tag}) - Expected calving in {days_until} days",
+            'high' if days_until <= 7 else 'medium')
+    return alerts
+
+
+def _vaccination_alerts(conn, user_id, today, record_id=None):
+    sql = """SELECT vr.id, vr.buffalo_id, bi.name, bi.tag_number, vr.vaccination_type, vr.next_due_date
+             FROM vaccination_records vr
+             JOIN buffalo_inventory bi ON vr.buffalo_id = bi.id
+             WHERE vr.user_id=? AND vr.next_due_date BETWEEN ? AND ?"""
+    params = [user_id, today, today + timedelta(days=VACCINATION_WINDOW_DAYS)]
+    if record_id is not None:
+        sql += " AND vr.id=?"
+        params.append(record_id)
+
+    alerts = {}
+    for source_id, buffalo_id, name, tag, vacc_type, due in conn.execute(sql, params):
+        days_until = (_as_date(due) - today).days
+        alerts[source_id] = (
+            buffalo_id, due,
+            f"{name} ({tag}) - {vacc_type} due in {days_until} days",
+            'high' if days_until <= 3 else 'medium')
+    return alerts
+
+
+def _feed_alerts(conn, user_id, today, record_id=None):
+    sql = """SELECT id, feed_name, current_stock_kg
+             FROM feed_inventory
+             WHERE user_id=? AND current_stock_kg <= reorder_level_kg"""
+    params = [user_id]
+    if record_id is not None:
+        sql += " AND id=?"
+        params.append(record_id)
+
+    return {
+        source_id: (None, None, f"Low stock: {feed_name} - Only {stock:.1f} kg remaining", 'high')
+        for source_id, feed_name, stock in conn.execute(sql, params)
+    }
+
+
+def _milk_anomaly_alerts(conn, user_id, today, record_id=None):
+    """One alert per animal with an open deviation; ``record_id`` is the buffalo id."""
+    sql = """SELECT yb.buffalo_id, bi.name, bi.tag_number, yb.alert_date, yb.alert_metric,
+                    yb.alert_value, yb.alert_expected, yb.alert_z
+             FROM yield_baselines yb
+             JOIN buffalo_inventory bi ON yb.buffalo_id = bi.id
+             WHERE yb.user_id=? AND yb.alert_date >= ? AND bi.status='Active'"""
+    params = [user_id, today - timedelta(days=ALERT_KEEP_DAYS)]
+    if record_id is not None:
+        sql += " AND yb.buffalo_id=?"
+        params.append(record_id)
+
+    alerts = {}
+    for buffalo_id, name, tag, day, metric, value, expected, z in conn.execute(sql, params):
+        label, unit = METRICS[metric][:2]
+        alerts[buffalo_id] = (
+            buffalo_id, day,
+            f"{name} ({tag}) - {label} {value:.1f}{unit} on {day}, usually {expected:.1f}{unit}",
+            'high' if abs(z) >= HIGH_Z else 'medium')
+    return alerts
+
+
+def _heat_alerts(conn, user_id, today, record_id=None):
+    """Predicted heat windows opening within HEAT_WINDOW_DAYS; ``record_id`` is the buffalo id."""
+    return _heat_windows(predict_heats(conn, user_id, today, record_id), today)
+
+
+def _heat_windows(predictions, today):
+    soon = predictions[predictions['window_start'].dt.date <= today + timedelta(days=HEAT_WINDOW_DAYS)]
+
+    alerts = {}
+    for row in soon.itertuples():
+        window = f"{row.window_start:%d %b} - {row.window_end:%d %b}"
+        in_window = row.window_start.date() <= today
+        if in_window:
+            message = f"{row.name} ({row.tag_number}) - In heat window now ({window})"
+        else:
+            message = f"{row.name} ({row.tag_number}) - Heat expected {row.expected:%d %b} ({window})"
+        alerts[int(row.buffalo_id)] = (int(row.buffalo_id), str(row.expected.date()), message,
+                                       'high' if in_window else 'medium')
+    return alerts
+
+
+ALERT_SOURCES = {
+    'calving': _calving_alerts,
+    'vaccination': _vaccination_alerts,
+    'feed': _feed_alerts,
+    'milk_anomaly': _milk_anomaly_alerts,
+    'heat': _heat_alerts,
+}
+
+
+def _sync(conn, user_id, alert_type, today, record_id=None, wanted=None):
+    """Bring the stored alerts of one type in line with their source rows.
+
+    With ``record_id`` only the alert for that source row is touched;
+    otherwise every alert of the type is re-evaluated. ``wanted`` passes in
+    alerts the caller already built from the source.
+    """
+    if wanted is None:
+        wanted = ALERT_SOURCES[alert_type](conn, user_id, today, record_id)
+
+    sql = """SELECT source_id, buffalo_id, alert_date, message, priority, resolved
+             FROM alerts WHERE user_id=? AND alert_type=?"""
+    params = [user_id, alert_type]
+    if record_id is not None:
+        sql += " AND source_id=?"
+        params.append(record_id)
+    stored = {row[0]: row[1:] for row in conn.execute(sql, params)}
+
+    for source_id, (buffalo_id, alert_date, message, priority) in wanted.items():
+        current = stored.get(source_id)
+        if alert_date is not None:
+            alert_date = str(alert_date)
+        if current == (buffalo_id, alert_date, message, priority, 0):
+            continue
+        conn.execute("""INSERT INTO alerts
+                        (user_id, alert_type, source_id, buffalo_id, alert_date, message, priority, resolved)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+                        ON CONFLICT(user_id, alert_type, source_id) DO UPDATE SET
+                            buffalo_id=excluded.buffalo_id, alert_date=excluded.alert_date,
+                            message=excluded.message, priority=excluded.priority, resolved=0""",
+                     (user_id, alert_type, source_id, buffalo_id, alert_date, message, priority))
+
+    stale = [source_id for source_id, row in stored.items()
+             if source_id not in wanted and row[-1] == 0]
+    if stale:
+        conn.executemany("""UPDATE alerts SET resolved=1
+                            WHERE user_id=? AND alert_type=? AND source_id=?""",
+                         [(user_id, alert_type, source_id) for source_id in stale])
+
+
+def sweep_alerts(conn, user_id, today=None):
+    """Re-evaluate every alert type for the user, at most once per day."""
+    today = today or datetime.now().date()
+    row = conn.execute("SELECT swept_on FROM alert_sweeps WHERE user_id=?", (user_id,)).fetchone()
+    if row is not None and row[0] == str(today):
+        return False
+
+    for alert_type in ALERT_SOURCES:
+        if alert_type == 'heat':
+            # Predicted heats roll forward as windows pass unrecorded
+            _sync_heats(conn, user_id, today)
+        else:
+            _sync(conn, user_id, alert_type, today)
+    conn.execute("INSERT OR REPLACE INTO alert_sweeps (user_id, swept_on) VALUES (?, ?)",
+                 (user_id, today))
+    return True
+
+
+def open_alerts(conn, user_id):
+    """Open alerts for the user, most urgent first."""
+    rows = conn.execute("""SELECT alert_type, priority, message, alert_date, buffalo_id
+                           FROM alerts
+                           WHERE user_id=? AND resolved=0
+                           ORDER BY priority, alert_date""", (user_id,)).fetchall()
+    alerts = [{'type': r[0], 'priority': r[1], 'message': r[2], 'date': r[3], 'buffalo_id': r[4]}
+              for r in rows]
+    alerts.sort(key=lambda a: PRIORITY_ORDER.get(a['priority'], len(PRIORITY_ORDER)))
+    return alerts
+
+
+def open_alert_count(conn, user_id):
+    """Number of open alerts, read from the trigger-maintained counter."""
+    row = conn.execute("SELECT open_count FROM alert_counts WHERE user_id=?", (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def _on_write(alert_type):
+    def hook(conn, user_id, table, row_id):
+        _sync(conn, user_id, alert_type, datetime.now().date(), row_id)
+    return hook
+
+
+def _sync_heats(conn, user_id, today, buffalo_id=None):
+    """Predict heats once for the herd or one animal, for both the heat alerts and farm_events."""
+    predictions = predict_heats(conn, user_id, today, buffalo_id)
+    _sync(conn, user_id, 'heat', today, buffalo_id, _heat_windows(predictions, today))
+    store_predicted_heats(conn, user_id, predictions, buffalo_id)
+
+
+def _on_heat_write(conn, user_id, table, row_id):
+    """Re-predict the animal the written heat or breeding row belongs to."""
+    row = None
+    if row_id is not None:
+        row = conn.execute(f"SELECT buffalo_id FROM {table} WHERE id=?", (row_id,)).fetchone()
+    _sync_heats(conn, user_id, datetime.now().date(), row[0] if row else None)
+
+
+def _on_milk_write(conn, user_id, table, row_id):
+    today = datetime.now().date()
+    changed = update_yield_baselines(conn, user_id, row_id, today)
+    if len(changed) == 1:
+        _sync(conn, user_id, 'milk_anomaly', today, changed[0])
+    elif changed:
+        _sync(conn, user_id, 'milk_anomaly', today)
+
+
+register_write_hook('breeding_records', _on_write('calving'))
+register_write_hook('breeding_records', _on_heat_write)
+register_write_hook('heat_detection', _on_heat_write)
+register_write_hook('vaccination_records', _on_write('vaccination'))
+register_write_hook('feed_inventory', _on_write('feed'))
+register_write_hook('milk_production', _on_milk_write)
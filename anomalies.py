@@ -0,0 +1,167 @@
+"""Streaming per-animal milk anomaly detection.
+
+Each active animal keeps an exponentially weighted mean and variance of its
+morning yield, evening yield and fat percentage in ``yield_baselines``
+(migration 12). A new milk record is scored against the baseline as it was
+before the record and then folded in, so every record costs O(1) and history
+is never rescanned. A sudden yield drop (the earliest practical sign of
+mastitis or illness) or a fat swing either way is kept on the baseline row and
+surfaced by the alert engine as a ``milk_anomaly`` alert.
+
+Editing or deleting an already folded record drops the animal's baseline
+(triggers in migration 12); it is then seeded again from only its latest
+``SEED_RECORDS`` records.
+"""
+import json
+import math
+import time
+from datetime import date, timedelta
+
+from lactation import DRY_GAP_DAYS
+
+# Weight of the newest record; the baseline effectively spans ~2/alpha records
+EWMA_ALPHA = 0.1
+# Records an animal needs before its deviations are trusted
+WARMUP_RECORDS = 10
+SEED_RECORDS = 60
+ALERT_Z = 3.0
+HIGH_Z = 5.0
+# Outliers are clipped to this many deviations before being folded in, so a
+# single bad day neither drags the mean nor blinds the variance to the next one
+CLIP_Z = 3.0
+# Only records this recent can raise an alert; imports of old data stay quiet
+ALERT_MAX_AGE_DAYS = 3
+# How long a raised alert stays open without a normal record after it
+ALERT_KEEP_DAYS = 7
+
+# column -> (label, unit, drops only, absolute sd floor, sd floor relative to the mean)
+METRICS = {
+    'morning_yield': ('Morning yield', ' L', True, 0.3, 0.10),
+    'evening_yield': ('Evening yield', ' L', True, 0.3, 0.10),
+    'fat_percentage': ('Fat', '%', False, 0.3, 0.0),
+}
+_STATE_KEYS = {column: tuple(f"{column}_{part}" for part in ('n', 'mean', 'var')) for column in METRICS}
+STATE_COLUMNS = sum(_STATE_KEYS.values(), ())
+ALERT_COLUMNS = ('alert_date', 'alert_metric', 'alert_value', 'alert_expected', 'alert_z')
+
+
+def _as_date(value):
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _new_state():
+    return {'through_id': 0, 'last_date': None, **dict.fromkeys(STATE_COLUMNS, 0.0),
+            **dict.fromkeys(ALERT_COLUMNS)}
+
+
+def fold_record(state, values, can_alert):
+    """Score one record against the baseline, then fold it in.
+
+    ``values`` maps METRICS columns to the record's readings (None when not
+    recorded). Returns the worst deviation as ``(metric, value, expected, z)``,
+    or None when the record looks normal or ``can_alert`` is false.
+    """
+    worst = None
+    for column, value in values.items():
+        if value is None:
+            continue
+        _, _, drops_only, min_sd, rel_sd = METRICS[column]
+        n_key, mean_key, var_key = _STATE_KEYS[column]
+        n, mean, var = state[n_key], state[mean_key], state[var_key]
+        if n == 0:
+            state[n_key], state[mean_key] = 1, value
+            continue
+        sd = max(math.sqrt(var), min_sd, rel_sd * abs(mean))
+        z = (value - mean) / sd
+        if can_alert and n >= WARMUP_RECORDS and (z <= -ALERT_Z if drops_only else abs(z) >= ALERT_Z):
+            if worst is None or abs(z) > abs(worst[3]):
+                worst = (column, value, mean, z)
+        diff = min(max(value, mean - CLIP_Z * sd), mean + CLIP_Z * sd) - mean
+        increment = EWMA_ALPHA * diff
+        state[n_key] = n + 1
+        state[mean_key] = mean + increment
+        state[var_key] = (1 - EWMA_ALPHA) * (var + diff * increment)
+    return worst
+
+
+def _fold(state, records, today):
+    """Fold an animal's new records in date order; True if its open deviation changed."""
+    before = tuple(state[column] for column in ALERT_COLUMNS)
+    alert_from = today - timedelta(days=ALERT_MAX_AGE_DAYS)
+    last = _as_date(state['last_date']) if state['last_date'] else None
+    for record_id, record_date, *readings in sorted(records, key=lambda r: (r[1], r[0])):
+        state['through_id'] = max(state['through_id'], record_id)
+        day = _as_date(record_date)
+        # Back-filled days would feed the baseline out of order: skip them
+        if last is not None and day < last:
+            continue
+        if last is not None and (day - last).days > DRY_GAP_DAYS:
+            # Dried off and calved again: the old lactation says nothing about this one
+            through_id = state['through_id']
+            state.clear()
+            state.update(_new_state(), through_id=through_id)
+        state['last_date'], last = str(day), day
+        worst = fold_record(state, dict(zip(METRICS, readings)), day >= alert_from)
+        if worst is not None:
+            state.update(zip(ALERT_COLUMNS, (str(day), *worst)))
+        elif day >= alert_from and state['alert_date'] is not None and str(day) > state['alert_date']:
+            state.update(dict.fromkeys(ALERT_COLUMNS))
+    return tuple(state[column] for column in ALERT_COLUMNS) != before
+
+
+def update_yield_baselines(conn, user_id, row_id=None, today=None):
+    """Fold new milk records into the baselines; ids of animals whose alert changed.
+
+    With ``row_id`` only that record's animal is looked at, otherwise every
+    active animal of the user. Known animals read just the records after
+    their ``through_id`` (one seek each on idx_milk_buffalo_id); animals
+    without a baseline are seeded from their latest SEED_RECORDS records.
+    """
+    today = _as_date(today or date.today())
+    if row_id is not None:
+        ids = [row[0] for row in conn.execute("SELECT buffalo_id FROM milk_production WHERE id=?", (row_id,))]
+    else:
+        ids = [row[0] for row in conn.execute(
+            "SELECT id FROM buffalo_inventory WHERE user_id=? AND status='Active'", (user_id,))]
+    if not ids:
+        return []
+
+    columns = ('buffalo_id', 'through_id', 'last_date') + STATE_COLUMNS + ALERT_COLUMNS
+    stored = {row[0]: dict(zip(columns[1:], row[1:])) for row in conn.execute(
+        f"""SELECT {', '.join(columns)} FROM yield_baselines
+            WHERE buffalo_id IN (SELECT value FROM json_each(?))""", (json.dumps(ids),))}
+    known = [[buffalo_id, stored[buffalo_id]['through_id']] for buffalo_id in ids if buffalo_id in stored]
+    missing = [buffalo_id for buffalo_id in ids if buffalo_id not in stored]
+
+    records = {}
+    readings = ', '.join(f"mp.{column}" for column in METRICS)
+    if known:
+        for buffalo_id, *record in conn.execute(
+                f"""SELECT mp.buffalo_id, mp.id, mp.date, {readings}
+                    FROM json_each(?) w
+                    JOIN milk_production mp
+                      ON mp.buffalo_id = json_extract(w.value, '$[0]')
+                     AND mp.id > json_extract(w.value, '$[1]')""", (json.dumps(known),)):
+            records.setdefault(buffalo_id, []).append(record)
+    if missing:
+        # Latest records only, newest first on idx_milk_buffalo_keyset
+        for buffalo_id, *record in conn.execute(
+                f"""SELECT mp.buffalo_id, mp.id, mp.date, {readings}
+                    FROM json_each(?) w
+                    JOIN milk_production mp ON mp.id IN (
+                        SELECT id FROM milk_production WHERE buffalo_id = w.value
+                        ORDER BY date DESC, id DESC LIMIT ?)""", (json.dumps(missing), SEED_RECORDS)):
+            records.setdefault(buffalo_id, []).append(record)
+
+    changed, writes, now = [], [], time.time()
+    for buffalo_id, new in records.items():
+        state = stored.get(buffalo_id) or _new_state()
+        if _fold(state, new, today):
+            changed.append(buffalo_id)
+        writes.append((buffalo_id, user_id, *(state[column] for column in columns[1:]), now))
+    conn.executemany(
+        f"""INSERT OR REPLACE INTO yield_baselines (buffalo_id, user_id, {', '.join(columns[1:])}, updated_at)
+            VALUES ({', '.join('?' * (len(columns) + 2))})""", writes)
+    return changed
@@ -0,0 +1,409 @@
+"""BuffaloMitra AI assistant: prompt construction and streamed responses.
+
+Answers are streamed from the Messages API so the first words reach the
+farmer while the rest is still being generated. ``FakeAnthropic`` stands in
+for the SDK client with scripted latencies, so time-to-first-token and
+cancellation can be checked without a network or an API key
+(``python assistant.py ttft`` exits non-zero when a check fails).
+"""
+import json
+import random
+import time
+from types import SimpleNamespace
+
+MODEL = "claude-sonnet-4-20250514"
+MAX_TOKENS = 1500
+
+
+# Identical for every farmer and every turn, so it leads the prompt and is
+# marked for provider-side prompt caching.
+STATIC_SYSTEM_PROMPT = """You are BuffaloMitra AI, an expert buffalo dairy farming advisor.
+
+You provide:
+1. Buffalo breed selection and management advice
+2. Feeding and nutrition recommendations
+3. Breeding and reproduction guidance
+4. Disease prevention and treatment advice
+5. Milk production optimization
+6. Financial and business advice for dairy farming
+7. Government schemes and subsidies information
+
+Always be:
+- Practical and actionable
+- Specific to Indian dairy farming conditions
+- Supportive and encouraging
+- Data-driven with realistic expectations
+
+When tools are offered, use them to look up the farmer's own figures
+instead of guessing, and ask only for what the question needs."""
+
+MAX_TOOL_ROUNDS = 4
+HISTORY_TOKEN_BUDGET = 3000
+SUMMARY_TOKEN_BUDGET = 400
+_CACHED = {'type': 'ephemeral'}
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token), good enough for budgeting."""
+    return len(text) // 4 + 1
+
+
+def build_system_prompt(user_data, context="", summary=""):
+    """System prompt as content blocks: static instructions, farm context, conversation summary.
+
+    The first two blocks carry cache breakpoints so repeat turns read them
+    from the provider's prompt cache; the summary changes as the conversation
+    slides and is left uncached after them.
+    """
+    user_data = user_data or {}
+    location = ', '.join(part for part in (user_data.get('village'), user_data.get('district')) if part) or 'India'
+    farm = f"Current farmer context:\n- Location: {location}"
+    if context:
+        farm += f"\n\n{context}"
+    blocks = [
+        {'type': 'text', 'text': STATIC_SYSTEM_PROMPT, 'cache_control': _CACHED},
+        {'type': 'text', 'text': farm, 'cache_control': _CACHED},
+    ]
+    if summary:
+        blocks.append({'type': 'text', 'text': f"Summary of earlier conversation:\n{summary}"})
+    return blocks
+
+
+def _exchanges(history):
+    """Pair chat history messages into (question, answer) turns."""
+    return [(history[i]['content'], history[i + 1]['content'])
+            for i in range(0, len(history) - 1, 2)
+            if history[i]['role'] == 'user' and history[i + 1]['role'] == 'assistant']
+
+
+def _gist(answer):
+    first = answer.strip().split('\n', 1)[0]
+    return first if len(first) <= 200 else first[:197] + '...'
+
+
+def summarize_turns(summary, turns, budget=SUMMARY_TOKEN_BUDGET):
+    """Fold turns that left the window into the running summary, oldest lines dropped first."""
+    lines = [line for line in summary.split('\n') if line]
+    lines += [f"- Farmer asked: {question.strip()} | Advice given: {_gist(answer)}" for question, answer in turns]
+    while len(lines) > 1 and estimate_tokens('\n'.join(lines)) > budget:
+        lines.pop(0)
+    return '\n'.join(lines)
+
+
+def question_turn(question, reference=""):
+    """The new user message: the question with a cache breakpoint, then any reference notes.
+
+    The notes sit after the breakpoint because they are picked per question
+    and are not kept in the history; the cached prefix stays exactly what the
+    next turn will resend.
+    """
+    content = [{'type': 'text', 'text': question, 'cache_control': _CACHED}]
+    if reference:
+        content.append({'type': 'text', 'text': "Reference notes from the BuffaloMitra knowledge base "
+                                                f"(use them where relevant):\n{reference}"})
+    return {'role': 'user', 'content': content}
+
+
+def build_conversation(history, question, summary_state=None, budget=HISTORY_TOKEN_BUDGET, reference=""):
+    """Messages for a follow-up question: recent turns within ``budget`` tokens plus the new question.
+
+    ``summary_state`` is ``{'text': ..., 'turns': n}``, the running summary of
+    the first ``n`` turns; it is returned updated with any turns compacted
+    out of the window, so each turn is summarized only once. The new question
+    carries a cache breakpoint, so the next request finds this whole prefix
+    in the provider's prompt cache; ``reference`` notes follow it.
+    """
+    summary_state = dict(summary_state or {'text': '', 'turns': 0})
+    turns = _exchanges(history)
+    start = summary_state['turns']
+
+    def cost(turn):
+        return sum(estimate_tokens(text) for text in turn)
+
+    used = estimate_tokens(question) + sum(cost(turn) for turn in turns[start:])
+    if used > budget:
+        # Compact down to half the budget in one step rather than a turn at a
+        # time: the window then stays byte-identical, and so prompt-cached,
+        # for several turns after each compaction.
+        while start < len(turns) and used > budget // 2:
+            used -= cost(turns[start])
+            start += 1
+        summary_state['text'] = summarize_turns(summary_state['text'], turns[summary_state['turns']:start])
+        summary_state['turns'] = start
+
+    messages = []
+    for asked, answered in turns[start:]:
+        messages.append({'role': 'user', 'content': asked})
+        messages.append({'role': 'assistant', 'content': answered})
+    messages.append(question_turn(question, reference))
+    return messages, summary_state
+
+
+class ResponseStream:
+    """One streamed model response.
+
+    Iterating yields text deltas as they arrive. Afterwards exactly one of
+    ``completed``, ``cancelled`` or ``error`` describes how it ended; a
+    consumer that stops iterating early closes the underlying HTTP stream.
+    ``cancel`` is an optional ``threading.Event`` checked between deltas.
+
+    With ``tools`` and ``run_tool(name, input) -> (content, is_error)``, tool
+    calls the model makes are executed and returned to it, and the answer
+    keeps streaming from the follow-up request, for up to MAX_TOOL_ROUNDS.
+    """
+
+    def __init__(self, client, system, messages, model=MODEL, max_tokens=MAX_TOKENS, cancel=None,
+                 tools=None, run_tool=None):
+        self.client = client
+        self.request = {'model': model, 'max_tokens': max_tokens, 'system': system, 'messages': messages}
+        if tools:
+            self.request['tools'] = tools
+        self.run_tool = run_tool
+        self.cancel = cancel
+        self.text = ""
+        self.message = None
+        self.rounds = []
+        self.completed = False
+        self.cancelled = False
+        self.error = None
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+
+    def __iter__(self):
+        self.started_at = time.perf_counter()
+        request = dict(self.request)
+        try:
+            for _ in range(MAX_TOOL_ROUNDS + 1):
+                separate = bool(self.text)
+                with self.client.messages.stream(**request) as stream:
+                    for delta in stream.text_stream:
+                        if self.cancel is not None and self.cancel.is_set():
+                            self.cancelled = True
+                            return
+                        if self.first_token_at is None:
+                            self.first_token_at = time.perf_counter()
+                        if separate:
+                            delta, separate = "\n\n" + delta, False
+                        self.text += delta
+                        yield delta
+                    self.message = stream.get_final_message()
+                self.rounds.append(self.message)
+                if self.message.stop_reason != 'tool_use' or self.run_tool is None:
+                    break
+                request['messages'] = request['messages'] + [
+                    {'role': 'assistant', 'content': [_content_block(b) for b in self.message.content]},
+                    {'role': 'user', 'content': self._tool_results(self.message)},
+                ]
+            self.completed = True
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished_at = time.perf_counter()
+
+    def _tool_results(self, message):
+        results = []
+        for block in message.content:
+            if block.type == 'tool_use':
+                content, is_error = self.run_tool(block.name, block.input)
+                results.append({'type': 'tool_result', 'tool_use_id': block.id,
+                                'content': content, 'is_error': is_error})
+        return results
+
+    @property
+    def time_to_first_token(self):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def duration(self):
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    @property
+    def usage(self):
+        """Token counts summed over every request of the answer; cached prompt tokens are reported separately."""
+        names = ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+        return {name: sum(getattr(getattr(message, 'usage', None), name, None) or 0 for message in self.rounds)
+                for name in names}
+
+
+def _content_block(block):
+    """Plain-dict copy of a response content block, to send back in the next request."""
+    if block.type == 'tool_use':
+        return {'type': 'tool_use', 'id': block.id, 'name': block.name, 'input': block.input}
+    return {'type': 'text', 'text': block.text}
+
+
+class FakeOverloadedError(Exception):
+    status_code = 529
+
+
+class _FakeStream:
+    def __init__(self, owner, tokens, message):
+        self.owner = owner
+        self.tokens = tokens
+        self.message = message
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
+        return False
+
+    @property
+    def text_stream(self):
+        time.sleep(self.owner.first_token_delay)
+        for i, token in enumerate(self.tokens):
+            if i:
+                time.sleep(self.owner.token_delay)
+            if self.closed:
+                return
+            yield token
+
+    def get_final_message(self):
+        return self.message
+
+
+class FakeAnthropic:
+    """Offline stand-in for ``anthropic.Anthropic`` with scripted latencies.
+
+    ``messages.create`` blocks for the whole generation time, like the real
+    non-streaming call; ``messages.stream`` yields the first token after
+    ``first_token_delay`` and each further one after ``token_delay``.
+    Usage mimics prompt caching: prefixes ending at a cache breakpoint are
+    remembered, and the longest remembered prefix of a later request is
+    reported as cache reads. With ``tool_calls`` (``[(name, input), ...]``) a
+    request offering tools is first answered with those tool calls, and a
+    ``fail_rate`` share of requests fails with an "overloaded" error.
+    """
+
+    def __init__(self, reply="Feed 1 kg of concentrate for every 2.5 litres of milk.",
+                 first_token_delay=0.4, token_delay=0.02, tool_calls=None, fail_rate=0.0, seed=None):
+        self.tokens = [word + ' ' for word in reply.split()]
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.tool_calls = tool_calls or []
+        self.fail_rate = fail_rate
+        self._random = random.Random(seed)
+        self.requests = []
+        self._cached_prefixes = set()
+        self.messages = SimpleNamespace(create=self._create, stream=self._stream)
+
+    def _usage(self, request, output_tokens=0):
+        system = request.get('system') or []
+        blocks = [{'text': system}] if isinstance(system, str) else list(system)
+        for message in request['messages']:
+            content = message['content']
+            blocks += [{'text': content}] if isinstance(content, str) else content
+
+        prefix, total, cached = '', 0, 0
+        for block in blocks:
+            text = block['text'] if 'text' in block else json.dumps(block, default=str)
+            prefix += text
+            total += estimate_tokens(text)
+            if prefix in self._cached_prefixes:
+                cached = total
+            if 'cache_control' in block:
+                self._cached_prefixes.add(prefix)
+        return SimpleNamespace(input_tokens=total - cached, output_tokens=output_tokens,
+                               cache_read_input_tokens=cached, cache_creation_input_tokens=0)
+
+    def with_options(self, **options):
+        return self
+
+    def _reply(self, request):
+        """Streamed tokens and final message: the scripted tool calls first, then the text reply."""
+        if self.fail_rate and self._random.random() < self.fail_rate:
+            time.sleep(self.first_token_delay / 4)
+            raise FakeOverloadedError("Overloaded")
+        last = request['messages'][-1]['content']
+        answered = not isinstance(last, str) and any(b.get('type') == 'tool_result' for b in last)
+        if request.get('tools') and self.tool_calls and not answered:
+            content = [SimpleNamespace(type='tool_use', id=f"toolu_fake_{i}", name=name, input=args)
+                       for i, (name, args) in enumerate(self.tool_calls)]
+            return [], SimpleNamespace(model=MODEL, content=content, stop_reason='tool_use',
+                                       usage=self._usage(request, 20 * len(content)))
+        content = [SimpleNamespace(type='text', text=''.join(self.tokens))]
+        return self.tokens, SimpleNamespace(model=MODEL, content=content, stop_reason='end_turn',
+                                            usage=self._usage(request, len(self.tokens)))
+
+    def _create(self, **request):
+        self.requests.append(request)
+        tokens, message = self._reply(request)
+        time.sleep(self.first_token_delay + self.token_delay * max(len(tokens) - 1, 0))
+        return message
+
+    def _stream(self, **request):
+        self.requests.append(request)
+        return _FakeStream(self, *self._reply(request))
+
+
+if __name__ == '__main__':
+    import argparse
+    import threading
+
+    parser = argparse.ArgumentParser(description="Measure assistant latency against the offline fake client")
+    parser.add_argument('command', choices=['ttft', 'history'])
+    parser.add_argument('--words', type=int, default=300)
+    parser.add_argument('--turns', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == 'history':
+        # Uncached input tokens per turn: whole history resent vs. windowed and prompt-cached
+        client = FakeAnthropic(reply=' '.join(['word'] * args.words), first_token_delay=0, token_delay=0)
+        history, summary_state = [], None
+        for turn in range(1, args.turns + 1):
+            question = f"Follow-up question number {turn} about feeding my Murrah buffaloes?"
+            full = [{'role': m['role'], 'content': m['content']} for m in history]
+            full.append({'role': 'user', 'content': question})
+            naive = FakeAnthropic()._usage({'system': STATIC_SYSTEM_PROMPT, 'messages': full})
+            messages, summary_state = build_conversation(history, question, summary_state)
+            response = ResponseStream(client, build_system_prompt({}, summary=summary_state['text']), messages)
+            for _ in response:
+                pass
+            print(f"turn {turn:2d}: full history {naive.input_tokens:6d} tokens | windowed "
+                  f"{response.usage['input_tokens']:5d} uncached + {response.usage['cache_read_input_tokens']:5d} cached")
+            history += [{'role': 'user', 'content': question}, {'role': 'assistant', 'content': response.text}]
+        raise SystemExit(0)
+
+    client = FakeAnthropic(reply=' '.join(['word'] * args.words))
+    request = {'system': build_system_prompt({}), 'messages': [{'role': 'user', 'content': "test"}]}
+    failures = []
+
+    def check(ok, label):
+        print(f"  {'ok' if ok else 'FAIL'}: {label}")
+        if not ok:
+            failures.append(label)
+
+    started = time.perf_counter()
+    client.messages.create(model=MODEL, max_tokens=MAX_TOKENS, **request)
+    blocking = time.perf_counter() - started
+
+    response = ResponseStream(client, **request)
+    for _ in response:
+        pass
+    print(f"blocking create: first text after {blocking * 1000:.0f} ms")
+    print(f"streaming:       first text after {response.time_to_first_token * 1000:.0f} ms, "
+          f"complete after {response.duration * 1000:.0f} ms")
+    check(response.completed and response.error is None, "stream completes without error")
+    check(response.text == ''.join(client.tokens), "stream yields the whole reply")
+    check(response.time_to_first_token < response.duration, "first token arrives before completion")
+    check(response.time_to_first_token < blocking, "first token arrives before a blocking call returns")
+
+    # Stop a second answer a few tokens in, as the page's Stop button does
+    stop = threading.Event()
+    cancelled = ResponseStream(client, cancel=stop, **request)
+    for n, _ in enumerate(cancelled, 1):
+        if n == 5:
+            stop.set()
+    print(f"cancelled:       stopped after {len(cancelled.text.split())} of {args.words} words, "
+          f"{cancelled.duration * 1000:.0f} ms")
+    check(cancelled.cancelled and not cancelled.completed, "cancel leaves cancelled=True")
+    check(len(cancelled.text.split()) == 5, "no text arrives after cancel")
+    check(cancelled.duration < response.duration, "a cancelled stream stops before the full answer")
+    raise SystemExit(1 if failures else 0)
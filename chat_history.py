@@ -0,0 +1,58 @@
+"""Per-farmer AI chat history stored in SQLite.
+
+Sessions no longer keep the conversation in memory: the page reads only
+the latest ``CHAT_PAGE_SIZE`` messages (more on request, up to
+``CHAT_MAX_LOADED``), and prompts are built from the running summary plus
+the messages after it. History survives logout and server restarts.
+"""
+import time
+
+CHAT_PAGE_SIZE = 20
+CHAT_MAX_LOADED = 200
+# Upper bound on unsummarized messages read back for a prompt; compaction
+# normally keeps the tail far shorter. Even, so the tail starts on a question.
+CONTEXT_MESSAGE_LIMIT = 100
+
+
+def _messages(rows):
+    return [{'id': row[0], 'role': row[1], 'content': row[2]} for row in rows]
+
+
+def recent_messages(conn, user_id, limit=CHAT_PAGE_SIZE):
+    """The latest ``limit`` messages oldest first, and whether older ones exist."""
+    rows = conn.execute("""SELECT id, role, content FROM chat_messages
+                           WHERE user_id=? ORDER BY id DESC LIMIT ?""", (user_id, limit + 1)).fetchall()
+    return _messages(reversed(rows[:limit])), len(rows) > limit
+
+
+def load_conversation(conn, user_id):
+    """Messages not yet folded into the summary, and the summary state for ``build_conversation``."""
+    row = conn.execute("SELECT summary, through_id FROM chat_summaries WHERE user_id=?", (user_id,)).fetchone()
+    text, through_id = row if row is not None else ('', 0)
+    rows = conn.execute("""SELECT id, role, content FROM chat_messages
+                           WHERE user_id=? AND id > ? ORDER BY id DESC LIMIT ?""",
+                        (user_id, through_id, CONTEXT_MESSAGE_LIMIT)).fetchall()
+    return _messages(reversed(rows)), {'text': text, 'turns': 0, 'through_id': through_id}
+
+
+def summary_record(tail, summary_state):
+    """``{'text', 'through_id'}`` after ``build_conversation`` compacted ``summary_state['turns']`` turns of ``tail``."""
+    turns = summary_state['turns']
+    through_id = tail[2 * turns - 1]['id'] if turns else summary_state['through_id']
+    return {'text': summary_state['text'], 'through_id': through_id}
+
+
+def save_exchange(conn, user_id, question, answer, summary=None, now=None):
+    """Append a question and its answer, and the updated running summary if there is one."""
+    now = now or time.time()
+    conn.executemany("INSERT INTO chat_messages (user_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                     [(user_id, 'user', question, now), (user_id, 'assistant', answer, now)])
+    if summary is not None and summary['through_id']:
+        conn.execute("""INSERT INTO chat_summaries (user_id, summary, through_id) VALUES (?, ?, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET summary=excluded.summary, through_id=excluded.through_id""",
+                     (user_id, summary['text'], summary['through_id']))
+
+
+def clear_history(conn, user_id):
+    conn.execute("DELETE FROM chat_messages WHERE user_id=?", (user_id,))
+    conn.execute("DELETE FROM chat_summaries WHERE user_id=?", (user_id,))
@@ -0,0 +1,473 @@
+"""SQLite data-access layer for BuffaloMitra.
+
+Every page used to open and close its own sqlite3 connection, often several
+times per Streamlit rerun. This module keeps a small per-process pool of
+tuned connections instead, so a rerun reuses open connections together with
+their compiled-statement caches.
+"""
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from migrations import MIGRATIONS
+
+DB_PATH = os.environ.get('BUFFALOMITRA_DB', 'buffalomitra.db')
+POOL_SIZE = 8
+# Compiled statements kept per connection; the app issues well under this many
+# distinct SQL strings, so every hot query stays prepared between reruns.
+STATEMENT_CACHE_SIZE = 256
+BUSY_TIMEOUT_MS = 5000
+# How long a caller waits for a pooled connection when all are checked out
+POOL_TIMEOUT_S = BUSY_TIMEOUT_MS / 1000
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    "PRAGMA cache_size=-16000",      # ~16 MB page cache per connection
+    "PRAGMA mmap_size=268435456",    # 256 MB memory-mapped reads
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def connect(path=DB_PATH):
+    """Open a single connection with the pool's pragmas applied."""
+    conn = sqlite3.connect(path, check_same_thread=False,
+                           timeout=BUSY_TIMEOUT_MS / 1000,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """Raised when no pooled connection is free within the pool's timeout."""
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections shared by all sessions in a process.
+
+    Connections are handed out per thread and re-entrantly: a helper that asks
+    for a connection while its caller already holds one gets the same
+    connection (and transaction) back, so nested calls never exhaust the pool.
+    """
+
+    def __init__(self, path=DB_PATH, size=POOL_SIZE, timeout_s=POOL_TIMEOUT_S):
+        self.path = path
+        self.size = size
+        self.timeout_s = timeout_s
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return connect(self.path)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        # A leaked or long-held connection must surface as an error, not hang every session
+        try:
+            return self._idle.get(timeout=self.timeout_s)
+        except queue.Empty:
+            raise PoolTimeout(f"all {self.size} database connections busy for {self.timeout_s:g} s") from None
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Yield a pooled connection, committing on success and rolling back on error."""
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            self._local.depth += 1
+            try:
+                yield held
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        self._local.depth = 1
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._local.depth = 0
+            self._release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def get_connection():
+    """Context manager yielding a pooled connection to the app database."""
+    return get_pool().connection()
+
+
+_write_hooks = {}
+
+
+def register_write_hook(table, hook):
+    """Call ``hook(conn, user_id, table, row_id)`` whenever the app writes to ``table``.
+
+    Hooks run inside the writer's transaction, so whatever they maintain is
+    committed (or rolled back) together with the row that triggered them.
+    """
+    _write_hooks.setdefault(table, []).append(hook)
+
+
+def notify_write(conn, user_id, table, row_id=None):
+    """Run the hooks registered for ``table`` after an insert/update/delete."""
+    for hook in _write_hooks.get(table, []):
+        hook(conn, user_id, table, row_id)
+
+
+def schema_version(conn):
+    """Return the highest applied migration version (0 for a fresh database)."""
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='schema_version'").fetchone()
+    if exists is None:
+        return 0
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def migrate(conn, migrations=MIGRATIONS):
+    """Apply pending migrations in order; returns the number applied."""
+    if schema_version(conn) >= migrations[-1][0]:
+        return 0
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("""CREATE TABLE IF NOT EXISTS schema_version
+                        (version INTEGER PRIMARY KEY,
+                         description TEXT,
+                         applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+        # Re-read under the write lock: another process may have migrated meanwhile
+        current = schema_version(conn)
+        applied = 0
+        for version, description, steps in migrations:
+            if version <= current:
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                         (version, description))
+            applied += 1
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return applied
+
+
+# Representative shapes of the queries every page issues on each rerun.
+# find_table_scans() checks that none of them falls back to a full table scan.
+HOT_QUERIES = [
+    ("SELECT COUNT(*) FROM buffalo_inventory WHERE user_id=? AND status='Active'", (1,)),
+    ("SELECT COUNT(*) FROM buffalo_inventory WHERE user_id=? AND current_lactation>0 AND status='Active'", (1,)),
+    ("SELECT id, tag_number, name FROM buffalo_inventory WHERE user_id=? AND status='Active'", (1,)),
+    ("""SELECT id, tag_number, name, breed, date_of_birth, current_lactation, status
+        FROM buffalo_inventory WHERE user_id=? ORDER BY tag_number""", (1,)),
+    ("""SELECT id, tag_number, name FROM buffalo_inventory
+        WHERE user_id=? AND tag_number COLLATE NOCASE >= ? AND (tag_number COLLATE NOCASE, id) > (?, ?)
+        ORDER BY tag_number COLLATE NOCASE, id LIMIT 101""", (1, 'a1', 'a1', 1)),
+    ("SELECT SUM(total_yield) FROM milk_production WHERE user_id=? AND date=?", (1, '2024-01-01')),
+    ("""SELECT date, SUM(total_yield) as total FROM milk_production
+        WHERE user_id=? AND date >= date('now', '-30 days') GROUP BY date ORDER BY date""", (1,)),
+    ("""SELECT date, total_litres, avg_fat FROM milk_daily_summary
+        WHERE user_id=? AND date BETWEEN ? AND ? ORDER BY date""", (1, '2024-01-01', '2024-02-01')),
+    ("""SELECT mp.id, mp.date, bi.tag_number, mp.total_yield
+        FROM milk_production mp JOIN buffalo_inventory bi ON mp.buffalo_id = bi.id
+        WHERE mp.user_id=? AND (mp.date, mp.id) < (?, ?)
+        ORDER BY mp.date DESC, mp.id DESC LIMIT 51""", (1, '2024-01-01', 1)),
+    ("""SELECT mp.id, mp.date, mp.total_yield
+        FROM milk_production mp JOIN buffalo_inventory bi ON mp.buffalo_id = bi.id
+        WHERE mp.user_id=? AND mp.buffalo_id=? AND (mp.date, mp.id) > (?, ?)
+        ORDER BY mp.date, mp.id LIMIT 51""", (1, 1, '2024-01-01', 1)),
+    ("""SELECT b.tag_number, AVG(m.total_yield), AVG(m.fat_percentage), COUNT(m.id)
+        FROM buffalo_inventory b LEFT JOIN milk_production m ON b.id = m.buffalo_id
+        WHERE b.user_id=? AND b.status='Active' AND m.date >= date('now', '-90 days')
+        GROUP BY b.id""", (1,)),
+    ("""SELECT br.id, bi.name, br.expected_calving_date
+        FROM breeding_records br JOIN buffalo_inventory bi ON br.buffalo_id = bi.id
+        WHERE br.user_id=? AND br.pregnancy_status='Pregnant'
+        AND br.expected_calving_date BETWEEN ? AND ?""", (1, '2024-01-01', '2024-02-01')),
+    ("""SELECT br.breeding_date, bi.tag_number FROM breeding_records br
+        JOIN buffalo_inventory bi ON br.buffalo_id = bi.id
+        WHERE br.user_id=? AND br.breeding_date BETWEEN ? AND ?""", (1, '2024-01-01', '2024-02-01')),
+    ("""SELECT vr.id, bi.name, vr.next_due_date
+        FROM vaccination_records vr JOIN buffalo_inventory bi ON vr.buffalo_id = bi.id
+        WHERE vr.user_id=? AND vr.next_due_date BETWEEN ? AND ?""", (1, '2024-01-01', '2024-02-01')),
+    ("""SELECT hr.date, bi.tag_number FROM health_records hr
+        JOIN buffalo_inventory bi ON hr.buffalo_id = bi.id
+        WHERE hr.user_id=? AND hr.date BETWEEN ? AND ? ORDER BY hr.date DESC""", (1, '2024-01-01', '2024-02-01')),
+    ("""SELECT h.heat_date, b.tag_number FROM heat_detection h
+        JOIN buffalo_inventory b ON h.buffalo_id = b.id
+        WHERE h.user_id=? ORDER BY h.heat_date DESC LIMIT 50""", (1,)),
+    ("SELECT COUNT(*) FROM calf_records WHERE user_id=? AND status='Active'", (1,)),
+    ("""SELECT feed_name, current_stock_kg, reorder_level_kg FROM feed_inventory
+        WHERE user_id=? AND current_stock_kg <= reorder_level_kg""", (1,)),
+    ("SELECT transaction_type, SUM(amount) FROM financial_records WHERE user_id=? GROUP BY transaction_type", (1,)),
+    ("""SELECT category, transaction_type, SUM(amount) FROM financial_records
+        WHERE user_id=? AND date BETWEEN ? AND ? GROUP BY category, transaction_type""", (1, '2024-01-01', '2024-02-01')),
+    ("""SELECT fe.event_date, fe.type, bi.tag_number, fe.detail FROM farm_events fe
+        LEFT JOIN buffalo_inventory bi ON bi.id = fe.buffalo_id
+        WHERE fe.user_id=? AND fe.event_date BETWEEN ? AND ?
+        ORDER BY fe.event_date, fe.type""", (1, '2024-01-01', '2024-02-01')),
+]
+
+
+def find_table_scans(conn, queries=HOT_QUERIES):
+    """Return ``(sql, plan_detail)`` for every query whose plan scans a whole table or index."""
+    offenders = []
+    for sql, params in queries:
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row[-1]
+            if detail.startswith('SCAN ') and 'CONSTANT ROW' not in detail:
+                offenders.append((' '.join(sql.split()), detail))
+    return offenders
+
+
+def bench_database(path, animals, days):
+    """Create a migrated database at ``path`` holding one farm of ``animals`` milked daily for ``days`` days."""
+    import random
+    from datetime import date, timedelta
+
+    conn = connect(path)
+    try:
+        migrate(conn)
+        conn.execute("""INSERT INTO users (id, username, password_hash, full_name, mobile)
+                        VALUES (1, 'bench', '-', 'Benchmark Farm', '-')""")
+        conn.executemany("""INSERT INTO buffalo_inventory (id, user_id, tag_number, name, current_lactation, status)
+                            VALUES (?, 1, ?, ?, 1, 'Active')""",
+                         [(i, f"B{i:05d}", f"Buffalo {i}") for i in range(1, animals + 1)])
+        rng = random.Random(1)
+        first = date.today() - timedelta(days=days)
+        for offset in range(days):
+            day = str(first + timedelta(days=offset))
+            rows = []
+            for buffalo_id in range(1, animals + 1):
+                morning, evening = rng.uniform(3, 7), rng.uniform(2, 6)
+                rows.append((buffalo_id, day, morning, evening, morning + evening, rng.uniform(6, 8)))
+            conn.executemany("""INSERT INTO milk_production
+                                (user_id, buffalo_id, date, morning_yield, evening_yield, total_yield,
+                                 fat_percentage, price_per_liter)
+                                VALUES (1, ?, ?, ?, ?, ?, ?, 60)""", rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def bench_reruns(path, blocks=10, reruns=50):
+    """Mean milliseconds per rerun, opening a connection per block versus borrowing one from the pool.
+
+    A rerun is ``blocks`` connection blocks, as a page render had before the
+    pool. Dashboard-style blocks run HOT_QUERIES in turn; setup-bound blocks
+    run a single primary-key lookup, so connection setup dominates.
+    """
+    import time
+
+    workloads = {'dashboard-style': HOT_QUERIES,
+                 'setup-bound': [("SELECT full_name FROM users WHERE id=?", (1,))]}
+    pool = ConnectionPool(path)
+
+    @contextmanager
+    def direct():
+        conn = sqlite3.connect(path, check_same_thread=False)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    results = {}
+    for workload, queries in workloads.items():
+        for mode, open_block in (('connect per block', direct), ('pooled', pool.connection)):
+            def rerun():
+                for block in range(blocks):
+                    with open_block() as conn:
+                        sql, params = queries[block % len(queries)]
+                        conn.execute(sql, params).fetchall()
+
+            rerun()   # warm the page cache and the pool
+            started = time.perf_counter()
+            for _ in range(reruns):
+                rerun()
+            results[workload, mode] = (time.perf_counter() - started) * 1000 / reruns
+    pool.close_all()
+    return results
+
+
+def bench_bootstrap(path, sessions=8, reruns=200):
+    """Per-rerun schema bootstrap cost, in ms, with ``sessions`` concurrent sessions on one database.
+
+    Returns ``{mode: (mean, p95)}`` for the old init_database(), which ran
+    the baseline CREATE TABLE IF NOT EXISTS statements and a commit on a
+    fresh connection, and for migrate() on a pooled connection with the
+    schema already current.
+    """
+    import time
+
+    from ai_metrics import percentile
+    from migrations import BASELINE_TABLES
+
+    def old_init(_pool):
+        conn = sqlite3.connect(path, check_same_thread=False, timeout=BUSY_TIMEOUT_MS / 1000)
+        try:
+            for statement in BASELINE_TABLES:
+                conn.execute(statement)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def fast_path(pool):
+        with pool.connection() as conn:
+            migrate(conn)
+
+    results = {}
+    for mode, bootstrap in (('old init_database()', old_init), ('migrate() fast path', fast_path)):
+        pool = ConnectionPool(path, size=sessions)
+        timings = [[] for _ in range(sessions)]
+        start = threading.Barrier(sessions)
+
+        def session(times):
+            start.wait()
+            for _ in range(reruns):
+                began = time.perf_counter()
+                bootstrap(pool)
+                times.append((time.perf_counter() - began) * 1000)
+
+        threads = [threading.Thread(target=session, args=(times,)) for times in timings]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.close_all()
+        every = sum(timings, [])
+        results[mode] = (sum(every) / len(every), percentile(every, 95))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="BuffaloMitra database maintenance")
+    parser.add_argument('command', choices=['migrate', 'check-plans', 'rebuild-rollups', 'ai-cache-stats', 'ai-usage',
+                                            'bench', 'bench-bootstrap'])
+    parser.add_argument('--animals', type=int, default=3000, help="bench: herd size")
+    parser.add_argument('--days', type=int, default=60, help="bench: days of milk records per animal")
+    parser.add_argument('--blocks', type=int, default=10, help="bench: connection blocks per rerun")
+    parser.add_argument('--reruns', type=int, help="bench: reruns timed per mode (default 50); "
+                                                   "bench-bootstrap: reruns per session (default 200)")
+    parser.add_argument('--sessions', type=int, default=8, help="bench-bootstrap: concurrent sessions")
+    args = parser.parse_args()
+
+    if args.command == 'bench-bootstrap':
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.db')
+            bench_database(path, animals=0, days=0)
+            reruns = args.reruns or 200
+            print(f"{args.sessions} concurrent sessions x {reruns} reruns, one WAL database")
+            for mode, (mean, p95) in bench_bootstrap(path, args.sessions, reruns).items():
+                print(f"  {mode + ':':<24}mean {mean:.2f} ms, p95 {p95:.2f} ms per rerun")
+            print(f"  {'cached bootstrap:':<24}no database access")
+        raise SystemExit(0)
+
+    if args.command == 'bench':
+        # Runs against a throwaway database, never the app's
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.db')
+            bench_database(path, args.animals, args.days)
+            reruns = args.reruns or 50
+            print(f"{args.animals} animals, {args.animals * args.days} milk rows, "
+                  f"{args.blocks} connection blocks per rerun, {reruns} reruns")
+            results = bench_reruns(path, args.blocks, reruns)
+            for workload in ('dashboard-style', 'setup-bound'):
+                before, after = results[workload, 'connect per block'], results[workload, 'pooled']
+                print(f"  {workload + ' rerun:':<24}{before:8.2f} ms -> {after:.2f} ms ({before / after:.1f}x)")
+        raise SystemExit(0)
+
+    with get_connection() as conn:
+        applied = migrate(conn)
+        if args.command == 'migrate':
+            print(f"Applied {applied} migration(s); schema at version {schema_version(conn)}")
+        elif args.command == 'rebuild-rollups':
+            from milk import rebuild_daily_summary
+            print(f"Rebuilt {rebuild_daily_summary(conn)} milk_daily_summary row(s)")
+        elif args.command == 'ai-cache-stats':
+            from response_cache import response_cache_stats
+            stats = response_cache_stats(conn)
+            print(f"{stats['entries']} cached answer(s); {stats['hits']} hit(s), {stats['misses']} miss(es), "
+                  f"hit rate {stats['hit_rate']:.1%}")
+        elif args.command == 'ai-usage':
+            from ai_metrics import SUMMARY_WINDOW_DAYS, usage_summary
+            summary = usage_summary(conn)
+
+            def seconds(value):
+                return f"{value:.2f} s" if value is not None else "-"
+
+            print(f"Last {SUMMARY_WINDOW_DAYS} days: {summary['calls']} answer(s), {summary['errors']} error(s) "
+                  f"({summary['error_rate']:.1%}), {summary['retries']} retries, "
+                  f"{summary['response_cache_answers']} from the response cache")
+            print(f"tokens: {summary['input_tokens']} input, {summary['output_tokens']} output, "
+                  f"{summary['cache_read_tokens']} cache read ({summary['prompt_cache_ratio']:.1%} of prompt), "
+                  f"{summary['cache_write_tokens']} cache write; cost ${summary['cost_usd']:.2f}")
+            for name in ('ttft_s', 'duration_s'):
+                print(f"{name[:-2]}: " + ', '.join(f"{p} {seconds(v)}" for p, v in summary[name].items()))
+            for error, count in summary['errors_by_class'].items():
+                print(f"  {error}: {count}")
+            for user in summary['top_users']:
+                print(f"  user {user['user_id']} ({user['district'] or '-'}): {user['calls']} call(s), "
+                      f"{user['tokens']} tokens, ${user['cost_usd']:.3f}")
+        else:
+            scans = find_table_scans(conn)
+            for sql, detail in scans:
+                print(f"{detail}\n    {sql}")
+            print("No full table scans in hot queries" if not scans else f"{len(scans)} scan(s) found")
+            raise SystemExit(1 if scans else 0)
@@ -0,0 +1,131 @@
+"""Chunked report exports to CSV, Excel and Parquet.
+
+Rows are pulled from SQLite with ``fetchmany`` and handed to a format writer
+one chunk at a time, so an export never holds more than ``EXPORT_CHUNK_ROWS``
+rows in Python however long the date range is. Output goes to a temporary
+file on disk rather than an in-memory buffer.
+"""
+import csv
+import io
+import os
+import tempfile
+from contextlib import contextmanager
+from importlib.util import find_spec
+
+EXPORT_CHUNK_ROWS = 5000
+# Rows of a report shown on screen; the export carries the rest
+REPORT_PREVIEW_ROWS = 500
+
+# format name -> (file extension, MIME type, module the writer needs)
+EXPORT_FORMATS = {
+    'CSV': ('csv', 'text/csv', None),
+    'Excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'openpyxl'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet', 'pyarrow'),
+}
+
+
+def available_formats():
+    """Export formats whose writer library is installed, in display order."""
+    return [name for name, (_, _, module) in EXPORT_FORMATS.items()
+            if module is None or find_spec(module) is not None]
+
+
+def iter_query_chunks(conn, sql, params=(), chunk_rows=EXPORT_CHUNK_ROWS):
+    """Run ``sql`` and return ``(column_names, iterator of row lists)``."""
+    cur = conn.execute(sql, params)
+    columns = [d[0] for d in cur.description]
+
+    def chunks():
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                return
+            yield rows
+    return columns, chunks()
+
+
+def _write_csv(columns, chunks, out):
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows(rows)
+    text.flush()
+    text.detach()
+
+
+def _write_xlsx(columns, chunks, out):
+    from openpyxl import Workbook
+
+    # write_only workbooks stream rows to a temp file instead of building cells in memory
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Report")
+    sheet.append(columns)
+    for rows in chunks:
+        for row in rows:
+            sheet.append(row)
+    workbook.save(out)
+
+
+def _write_parquet(columns, chunks, out):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {int: pa.int64(), float: pa.float64(), str: pa.string(), bytes: pa.binary()}
+    types = [None] * len(columns)
+    pending, writer = [], None
+
+    def write(rows):
+        arrays = [pa.array([row[i] for row in rows], type=types[i]) for i in range(len(columns))]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    # SQLite has no column types on a result set, so the schema is taken from
+    # the first non-NULL value of each column; chunks are held back only until
+    # every column has one.
+    for rows in chunks:
+        if writer is None:
+            for i, column_type in enumerate(types):
+                if column_type is None:
+                    value = next((row[i] for row in rows if row[i] is not None), None)
+                    if value is not None:
+                        types[i] = arrow_types.get(type(value), pa.string())
+            pending.append(rows)
+            if None in types:
+                continue
+            schema = pa.schema(list(zip(columns, types)))
+            writer = pq.ParquetWriter(out, schema)
+            for held in pending:
+                write(held)
+            pending = []
+        else:
+            write(rows)
+
+    if writer is None:
+        types = [t or pa.string() for t in types]
+        schema = pa.schema(list(zip(columns, types)))
+        writer = pq.ParquetWriter(out, schema)
+        for held in pending:
+            write(held)
+    writer.close()
+
+
+WRITERS = {'CSV': _write_csv, 'Excel': _write_xlsx, 'Parquet': _write_parquet}
+
+
+def export_query(conn, sql, params, fmt, out, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Write the result of ``sql`` to the binary file ``out`` in format ``fmt``."""
+    columns, chunks = iter_query_chunks(conn, sql, params, chunk_rows)
+    WRITERS[fmt](columns, chunks, out)
+
+
+@contextmanager
+def export_file(conn, sql, params, fmt, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Export to a temporary file and yield it opened for reading; the file is removed afterwards."""
+    fd, path = tempfile.mkstemp(suffix='.' + EXPORT_FORMATS[fmt][0])
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            export_query(conn, sql, params, fmt, out, chunk_rows)
+        with open(path, 'rb') as exported:
+            yield exported
+    finally:
+        os.remove(path)
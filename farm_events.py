@@ -0,0 +1,68 @@
+"""Unified farm event timeline.
+
+Expected calvings, vaccinations due, health follow-ups, recorded heats and
+calf weaning are copied into ``farm_events`` by triggers on their source
+tables (migration 13), so any calendar window is one range scan on the
+table's ``(user_id, event_date, type)`` key instead of a BETWEEN query per
+table. Predicted heats from ``heat_cycles`` are kept there as
+``heat_expected`` events. The alert engine stores them from the same
+prediction that drives its heat alerts: for one animal when its heat or
+breeding records are written, and for the herd in the daily sweep.
+"""
+import json
+from datetime import datetime, timedelta
+
+EVENT_TYPES = {
+    'calving': "Expected calving",
+    'vaccination': "Vaccination due",
+    'health_follow_up': "Health follow-up",
+    'heat': "Heat observed",
+    'heat_expected': "Heat expected",
+    'weaning': "Calf weaning",
+}
+EVENT_TABLES = ('buffalo_inventory', 'breeding_records', 'vaccination_records', 'health_records',
+                'heat_detection', 'calf_records')
+
+
+def events_between(conn, user_id, start, end, types=None, limit=None):
+    """Events dated ``start`` through ``end``, in date order, optionally only of ``types``."""
+    sql = """SELECT fe.event_date, fe.type, fe.buffalo_id, bi.tag_number, bi.name, fe.detail
+             FROM farm_events fe
+             LEFT JOIN buffalo_inventory bi ON bi.id = fe.buffalo_id
+             WHERE fe.user_id=? AND fe.event_date BETWEEN ? AND ?"""
+    params = [user_id, str(start), str(end)]
+    if types is not None:
+        sql += " AND fe.type IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(list(types)))
+    sql += " ORDER BY fe.event_date, fe.type"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    rows = conn.execute(sql, params).fetchall()
+    return [{'date': r[0], 'type': r[1], 'label': EVENT_TYPES.get(r[1], r[1]), 'buffalo_id': r[2],
+             'tag_number': r[3], 'name': r[4], 'detail': r[5]} for r in rows]
+
+
+def upcoming_events(conn, user_id, days, today=None, types=None, limit=None):
+    """Events due from today through the next ``days`` days."""
+    today = today or datetime.now().date()
+    return events_between(conn, user_id, today, today + timedelta(days=days), types, limit)
+
+
+def store_predicted_heats(conn, user_id, predictions, buffalo_id=None):
+    """Replace the ``heat_expected`` events of the herd, or of one animal, with ``predictions``.
+
+    ``predictions`` is a ``heat_cycles.predict_heats`` frame for the same
+    scope. Returns the number of events written.
+    """
+    if buffalo_id is None:
+        conn.execute("DELETE FROM farm_events WHERE user_id=? AND type='heat_expected'", (user_id,))
+    else:
+        conn.execute("DELETE FROM farm_events WHERE source_table='heat_cycles' AND source_id=?", (buffalo_id,))
+    conn.executemany(
+        """INSERT INTO farm_events (user_id, event_date, type, source_table, source_id, buffalo_id, detail)
+           VALUES (?, ?, 'heat_expected', 'heat_cycles', ?, ?, ?)""",
+        [(user_id, str(row.expected.date()), int(row.buffalo_id), int(row.buffalo_id),
+          f"window {row.window_start:%d %b} - {row.window_end:%d %b}")
+         for row in predictions.itertuples()])
+    return len(predictions)
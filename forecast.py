@@ -0,0 +1,365 @@
+"""Herd milk forecast for the next 30 and 90 days.
+
+Each active animal's daily litres are projected along its fitted Wood curve
+(``lactation``), scaled to how it actually milked over the last RECENT_DAYS
+days. A pregnant animal is dried off DRY_PERIOD_DAYS before its expected
+calving and starts a new lactation on that date, and a monthly seasonal
+index learnt from the farm's own history bends the whole projection. The
+herd is projected as one animals x days matrix, cached until a milk,
+breeding or inventory write. ``python forecast.py`` backtests the model.
+"""
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from lactation import (DRY_GAP_DAYS, LACTATION_TABLES, START_LOOKBACK_DAYS, fit_wood, record_stats,
+                       refresh_lactation_fits)
+from querycache import cached_value
+
+HORIZONS = (30, 90)
+RECENT_DAYS = 14
+# How far an animal's recent milk may pull its curve up or down
+LEVEL_LIMITS = (0.5, 1.5)
+DRY_PERIOD_DAYS = 60
+# A seasonal index needs a full year of history; thin months are shrunk
+# toward 1 as if they had this many extra days at the yearly average
+SEASON_MIN_HISTORY_DAYS = 365
+SEASON_PRIOR_DAYS = 60
+# Herd-typical curve shape needs this many fitted animals
+MIN_HERD_FITS = 3
+PRICE_WINDOW_DAYS = 30
+FORECAST_TABLES = LACTATION_TABLES + ('milk_buyers',)
+
+_EPOCH = pd.Timestamp('1970-01-01')
+
+
+def _day_numbers(values):
+    """Days since 1970-01-01 as floats, NaN where there is no date."""
+    days = pd.to_datetime(pd.Series(values, dtype=object), errors='coerce')
+    return (days - _EPOCH).dt.days.to_numpy(dtype=float)
+
+
+def _wood(a, b, c, t):
+    with np.errstate(invalid='ignore', over='ignore'):
+        return a * t ** b * np.exp(-c * t)
+
+
+def seasonal_index(daily):
+    """Relative litres per milked animal for months 1-12 from a ``milk_daily_summary`` frame.
+
+    All ones until the farm has SEASON_MIN_HISTORY_DAYS of history.
+    """
+    index = np.ones(12)
+    if daily.empty:
+        return index
+    days = pd.to_datetime(daily['date'])
+    if (days.max() - days.min()).days < SEASON_MIN_HISTORY_DAYS:
+        return index
+    per_animal = daily['total_litres'] / daily['animals_milked'].where(daily['animals_milked'] > 0)
+    by_month = per_animal.groupby(days.dt.month).agg(['mean', 'count']).dropna()
+    raw = by_month['mean'] / by_month['mean'].mean()
+    weight = by_month['count'] / (by_month['count'] + SEASON_PRIOR_DAYS)
+    index[by_month.index.to_numpy() - 1] = 1 + weight * (raw - 1)
+    return index
+
+
+def project(today, horizon, animals, recent, calvings, seasonal):
+    """Daily litres for days 1..``horizon`` after ``today``, one row per animal.
+
+    ``animals`` has ``buffalo_id``, ``start`` (day number of the current
+    lactation or NaN) and Wood parameters (NaN where unfitted); ``recent``
+    holds ``buffalo_id``, ``day``, ``total_yield`` of the last RECENT_DAYS;
+    ``calvings`` maps buffalo ids to expected calving day numbers. Returns
+    the litres matrix and each animal's recent level against its curve.
+    """
+    today = float(today)
+    ids = animals['buffalo_id'].to_numpy()
+    start = animals['start'].to_numpy(dtype=float)
+    params = animals[['wood_a', 'wood_b', 'wood_c']].to_numpy(dtype=float)
+    fitted = ~np.isnan(params).any(axis=1)
+    herd = np.median(params[fitted], axis=0) if fitted.sum() >= MIN_HERD_FITS else None
+
+    # Unfitted animals follow the herd's curve shape, or hold their recent
+    # average when there is none; the level below fixes the height
+    flat = np.array([1.0, 0.0, 0.0])
+    current = np.where(fitted[:, None], params, herd if herd is not None else flat)
+    current[np.isnan(start)] = flat
+    t_now = np.where(np.isnan(start), 1.0, today - start + 1)
+
+    position = pd.Series(np.arange(len(ids)), index=ids)
+    pos = position.reindex(recent['buffalo_id']).to_numpy()
+    known = ~np.isnan(pos)
+    pos = pos[known].astype(np.int64)
+    days, litres = recent['day'].to_numpy(dtype=float)[known], recent['total_yield'].to_numpy(dtype=float)[known]
+    a, b, c = current[pos].T
+    t_recent = np.where(np.isnan(start[pos]), 1.0, days - start[pos] + 1)
+    actual = np.bincount(pos, weights=litres, minlength=len(ids))
+    expected = np.bincount(pos, weights=_wood(a, b, c, np.maximum(t_recent, 1)), minlength=len(ids))
+    counts = np.bincount(pos, minlength=len(ids))
+    milking = counts > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        level = np.where(expected > 0, actual / expected, 1.0)
+    level = np.where(current[:, 1:].any(axis=1), np.clip(level, *LEVEL_LIMITS), level)
+    level = np.where(milking, level, 0.0)
+
+    k = np.arange(1, horizon + 1, dtype=float)
+    a, b, c = (current[:, i:i + 1] for i in range(3))
+    matrix = level[:, None] * _wood(a, b, c, t_now[:, None] + k)
+
+    calving = pd.Series(calvings, dtype=float).reindex(ids).to_numpy() - today
+    due = ~np.isnan(calving)
+    if due.any():
+        # A new lactation follows the animal's own curve, else the herd's,
+        # else the herd's average daily yield
+        average = actual.sum() / counts.sum() if counts.sum() else 0.0
+        fresh = np.where(fitted[:, None], params, herd if herd is not None else [average, 0.0, 0.0])
+        offset = k - calving[due][:, None]
+        a, b, c = (fresh[due][:, i:i + 1] for i in range(3))
+        new = _wood(a, b, c, np.maximum(offset + 1, 1))
+        rows = matrix[due]
+        rows = np.where(offset >= -DRY_PERIOD_DAYS, 0.0, rows)
+        matrix[due] = np.where(offset >= 0, new, rows)
+
+    months = (_EPOCH + pd.to_timedelta(today + k, unit='D')).month.to_numpy()
+    today_month = (_EPOCH + pd.Timedelta(days=today)).month
+    matrix *= seasonal[months - 1] / seasonal[today_month - 1]
+    return np.nan_to_num(matrix), level
+
+
+def _price(conn, user_id, today):
+    """Realised price per litre over the last PRICE_WINDOW_DAYS, else the active buyers' average."""
+    row = conn.execute("""SELECT SUM(revenue) / NULLIF(SUM(total_litres), 0) FROM milk_daily_summary
+                          WHERE user_id=? AND date > date(?, ?) AND date <= ? AND revenue > 0""",
+                       (user_id, today, f"-{PRICE_WINDOW_DAYS} days", today)).fetchone()
+    if row[0] is None:
+        row = conn.execute("""SELECT AVG(price_per_liter) FROM milk_buyers
+                              WHERE user_id=? AND active=1 AND price_per_liter > 0""", (user_id,)).fetchone()
+    return row[0]
+
+
+def forecast_milk(conn, user_id, today=None, horizon=max(HORIZONS)):
+    """Daily herd litres and revenue, and per-animal totals for each of HORIZONS.
+
+    Returns ``{'daily', 'animals', 'price'}``; revenue is NaN when the farm
+    has no recorded milk price and no active buyer.
+    """
+    today = str(today or datetime.now().date())
+    refresh_lactation_fits(conn, user_id, today)
+    animals = pd.read_sql_query("""SELECT bi.id AS buffalo_id, bi.tag_number, bi.name, lf.lactation_start,
+                                          lf.wood_a, lf.wood_b, lf.wood_c
+                                   FROM buffalo_inventory bi
+                                   LEFT JOIN lactation_fits lf ON lf.buffalo_id = bi.id
+                                   WHERE bi.user_id=? AND bi.status='Active'
+                                   ORDER BY bi.tag_number""", conn, params=(user_id,))
+    recent = pd.read_sql_query("""SELECT buffalo_id, date, total_yield FROM milk_production
+                                  WHERE user_id=? AND date > date(?, ?) AND date <= ? AND total_yield > 0""",
+                               conn, params=(user_id, today, f"-{RECENT_DAYS} days", today))
+    calvings = dict(conn.execute("""SELECT buffalo_id, MIN(expected_calving_date) FROM breeding_records
+                                    WHERE user_id=? AND pregnancy_status='Pregnant' AND expected_calving_date > ?
+                                    GROUP BY buffalo_id""", (user_id, today)).fetchall())
+    daily = pd.read_sql_query("""SELECT date, total_litres, animals_milked FROM milk_daily_summary
+                                 WHERE user_id=? AND date <= ?""", conn, params=(user_id, today))
+    price = _price(conn, user_id, today)
+
+    day = _day_numbers([today])[0]
+    matrix, level = project(day, horizon,
+                            animals.assign(start=_day_numbers(animals['lactation_start'])),
+                            recent.assign(day=_day_numbers(recent['date'])),
+                            dict(zip(calvings, _day_numbers(list(calvings.values())))),
+                            seasonal_index(daily))
+    revenue_per_litre = price if price is not None else np.nan
+
+    dates = pd.date_range(pd.Timestamp(today) + pd.Timedelta(days=1), periods=horizon)
+    litres = matrix.sum(axis=0)
+    herd = pd.DataFrame({'date': dates, 'litres': litres, 'revenue': litres * revenue_per_litre})
+
+    status = np.where(level > 0, 'milking', 'dry')
+    expected_calving = animals['buffalo_id'].map(calvings)
+    last_day = str(dates[-1].date())
+    status = np.where(expected_calving.fillna('9999') <= last_day, 'calving due', status)
+    per_animal = animals[['tag_number', 'name']].assign(
+        status=status, level=np.where(level > 0, level, np.nan),
+        expected_calving=expected_calving)
+    for days in HORIZONS:
+        total = matrix[:, :days].sum(axis=1)
+        per_animal[f'litres_{days}'] = total
+        per_animal[f'revenue_{days}'] = total * revenue_per_litre
+    return {'daily': herd, 'animals': per_animal, 'price': price}
+
+
+def herd_forecast(conn, user_id):
+    """Cached forecast; recomputed only after a write to one of FORECAST_TABLES."""
+    return cached_value(conn, user_id, 'milk_forecast', FORECAST_TABLES, lambda: forecast_milk(conn, user_id))
+
+
+def _history(conn, user_id):
+    """Everything the backtest replays, read once: records, calvings, pregnancies, daily rollup."""
+    records = pd.read_sql_query("""SELECT buffalo_id, date, total_yield FROM milk_production
+                                   WHERE user_id=? AND total_yield > 0""", conn, params=(user_id,))
+    calved = pd.read_sql_query("""SELECT buffalo_id, actual_calving_date AS date FROM breeding_records
+                                  WHERE user_id=? AND actual_calving_date IS NOT NULL
+                                  UNION ALL
+                                  SELECT mother_buffalo_id, date_of_birth FROM calf_records
+                                  WHERE user_id=? AND mother_buffalo_id IS NOT NULL""",
+                               conn, params=(user_id, user_id))
+    bred = pd.read_sql_query("""SELECT buffalo_id, breeding_date, expected_calving_date FROM breeding_records
+                                WHERE user_id=? AND pregnancy_status IN ('Pregnant', 'Calved')
+                                AND expected_calving_date IS NOT NULL""", conn, params=(user_id,))
+    daily = pd.read_sql_query("""SELECT date, total_litres, animals_milked FROM milk_daily_summary
+                                 WHERE user_id=?""", conn, params=(user_id,))
+    return (records.assign(day=_day_numbers(records['date'])), calved.assign(day=_day_numbers(calved['date'])),
+            bred.assign(bred=_day_numbers(bred['breeding_date']), due=_day_numbers(bred['expected_calving_date'])),
+            daily.assign(day=_day_numbers(daily['date'])))
+
+
+def _inputs_at(cutoff, records, calved, bred, daily):
+    """``project`` inputs as they would have been on day ``cutoff``, refitting every curve in one batch."""
+    seen = records[records['day'] <= cutoff]
+    ids = np.sort(seen.loc[seen['day'] > cutoff - START_LOOKBACK_DAYS, 'buffalo_id'].unique())
+
+    # Same start rule as refresh_lactation_fits: last calving, else the
+    # first record after the latest dry gap
+    window = seen[seen['buffalo_id'].isin(ids) & (seen['day'] >= cutoff - START_LOOKBACK_DAYS)]
+    window = window.sort_values(['buffalo_id', 'day'])
+    gap = window.groupby('buffalo_id')['day'].diff()
+    gap_start = window.loc[gap.isna() | (gap > DRY_GAP_DAYS)].groupby('buffalo_id')['day'].max()
+    calving_start = calved[calved['day'] <= cutoff].groupby('buffalo_id')['day'].max()
+    start = calving_start.reindex(ids).fillna(gap_start.reindex(ids)).to_numpy()
+
+    started = seen['buffalo_id'].map(pd.Series(start, index=ids))
+    in_lactation = seen[seen['day'] >= started]
+    group = pd.Series(np.arange(len(ids)), index=ids)
+    stats = record_stats(group[in_lactation['buffalo_id']].to_numpy(), len(ids),
+                         (in_lactation['day'] - started[in_lactation.index] + 1).to_numpy(),
+                         in_lactation['total_yield'].to_numpy())
+    a, b, c = fit_wood(stats)
+
+    animals = pd.DataFrame({'buffalo_id': ids, 'start': start, 'wood_a': a, 'wood_b': b, 'wood_c': c})
+    recent = seen[seen['day'] > cutoff - RECENT_DAYS]
+    pregnant = bred[(bred['bred'] <= cutoff) & (bred['due'] > cutoff)]
+    calvings = pregnant.groupby('buffalo_id')['due'].min().to_dict()
+    return animals, recent, calvings, seasonal_index(daily[daily['day'] <= cutoff])
+
+
+def backtest(conn, user_id, cutoffs, horizons=HORIZONS):
+    """Forecast from each past ``cutoff`` date and score it against what was actually recorded.
+
+    One row per cutoff and horizon: actual and forecast herd litres, the
+    error of the total, the daily herd WAPE, the per-animal WAPE of horizon
+    totals, the same total error for a naive "last RECENT_DAYS average held
+    flat" forecast, and the time taken to build inputs and project.
+    """
+    records, calved, bred, daily = _history(conn, user_id)
+    horizon = max(horizons)
+    rows = []
+    for cutoff in cutoffs:
+        day = _day_numbers([cutoff])[0]
+        started = time.perf_counter()
+        animals, recent, calvings, seasonal = _inputs_at(day, records, calved, bred, daily)
+        matrix, _ = project(day, horizon, animals, recent, calvings, seasonal)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        ids = animals['buffalo_id'].to_numpy()
+        future = records[(records['day'] > day) & (records['day'] <= day + horizon)]
+        offset = (future['day'] - day - 1).astype(int).to_numpy()
+        naive_daily = recent.groupby('buffalo_id')['total_yield'].mean().sum()
+        for days in horizons:
+            upto = offset < days
+            actual_daily = np.bincount(offset[upto], weights=future['total_yield'].to_numpy()[upto],
+                                       minlength=days)
+            forecast_daily = matrix[:, :days].sum(axis=0)
+            actual_animal = future[upto].groupby('buffalo_id')['total_yield'].sum().reindex(ids, fill_value=0)
+            actual = actual_daily.sum()
+            if actual <= 0:
+                continue
+            rows.append({
+                'cutoff': str(cutoff), 'horizon': days, 'actual_litres': actual,
+                'forecast_litres': forecast_daily.sum(),
+                'total_error': (forecast_daily.sum() - actual) / actual,
+                'daily_wape': np.abs(forecast_daily - actual_daily).sum() / actual,
+                'animal_wape': np.abs(matrix[:, :days].sum(axis=1) - actual_animal.to_numpy()).sum() / actual,
+                'naive_error': (naive_daily * days - actual) / actual,
+                'ms': elapsed_ms,
+            })
+    return pd.DataFrame(rows)
+
+
+def _simulate_herd(conn, animals, days, seed=1):
+    """Synthetic farm for the backtest: Wood lactations, 13-16 month calving intervals, a seasonal swing."""
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp(datetime.now().date())
+    first = end - pd.Timedelta(days=days)
+    conn.execute("""INSERT INTO users (id, username, password_hash, full_name, mobile)
+                    VALUES (1, 'backtest', '-', 'Backtest Farm', '-')""")
+    milk, breeding = [], []
+    for i in range(animals):
+        buffalo_id = conn.execute("""INSERT INTO buffalo_inventory (user_id, tag_number, name, status)
+                                     VALUES (1, ?, ?, 'Active')""", (f"SIM{i:04d}", f"Sim {i}")).lastrowid
+        a, b, c = rng.uniform(5, 8), rng.uniform(0.15, 0.3), rng.uniform(0.003, 0.005)
+        calving = first - pd.Timedelta(days=int(rng.integers(0, 400)))
+        while calving <= end:
+            interval = int(rng.integers(400, 480))
+            expected = calving + pd.Timedelta(days=interval)
+            actual = expected + pd.Timedelta(days=int(rng.integers(-7, 8)))
+            bred = expected - pd.Timedelta(days=310)
+            if bred <= end:
+                breeding.append((buffalo_id, str(bred.date()), str(expected.date()),
+                                 str(actual.date()) if actual <= end else None,
+                                 'Calved' if actual <= end else 'Pregnant'))
+            dry_off = min(actual - pd.Timedelta(days=DRY_PERIOD_DAYS), end + pd.Timedelta(days=1))
+            for day in pd.date_range(max(calving, first), dry_off - pd.Timedelta(days=1)):
+                t = (day - calving).days + 1
+                season = 1 + 0.1 * np.cos(2 * np.pi * (day.dayofyear - 15) / 365)
+                litres = a * t ** b * np.exp(-c * t) * season * rng.lognormal(0, 0.08)
+                milk.append((buffalo_id, str(day.date()), litres * 0.55, litres * 0.45, litres))
+            calving = actual
+    conn.executemany("""INSERT INTO milk_production
+                        (user_id, buffalo_id, date, morning_yield, evening_yield, total_yield, price_per_liter)
+                        VALUES (1, ?, ?, ?, ?, ?, 60)""", milk)
+    conn.executemany("""INSERT INTO breeding_records
+                        (user_id, buffalo_id, breeding_date, expected_calving_date, actual_calving_date,
+                         pregnancy_status)
+                        VALUES (1, ?, ?, ?, ?, ?)""", breeding)
+    return len(milk)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from database import connect, migrate
+
+    parser = argparse.ArgumentParser(description="Backtest the milk forecast against recorded production")
+    parser.add_argument('--user-id', type=int, help="farm to replay from the BuffaloMitra database")
+    parser.add_argument('--synthetic', type=int, metavar='ANIMALS', default=200,
+                        help="replay a simulated herd of this size instead (default)")
+    parser.add_argument('--days', type=int, default=730, help="simulated history")
+    parser.add_argument('--cutoffs', type=int, default=6)
+    parser.add_argument('--step', type=int, default=30, help="days between cutoffs")
+    args = parser.parse_args()
+
+    if args.user_id is None:
+        conn, user_id = connect(':memory:'), 1
+        migrate(conn)
+        started = time.perf_counter()
+        count = _simulate_herd(conn, args.synthetic, args.days)
+        print(f"simulated {args.synthetic} animals, {count} records in {time.perf_counter() - started:.1f} s")
+    else:
+        conn, user_id = connect(), args.user_id
+        migrate(conn)
+
+    last = conn.execute("SELECT MAX(date) FROM milk_production WHERE user_id=?", (user_id,)).fetchone()[0]
+    last = pd.Timestamp(last)
+    cutoffs = [(last - pd.Timedelta(days=max(HORIZONS) + args.step * i)).date() for i in range(args.cutoffs)]
+    results = backtest(conn, user_id, cutoffs)
+    print(results.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+    for days, group in results.groupby('horizon'):
+        print(f"{days} days: total error {group['total_error'].abs().mean():.1%} "
+              f"(naive {group['naive_error'].abs().mean():.1%}), daily WAPE {group['daily_wape'].mean():.1%}, "
+              f"per-animal WAPE {group['animal_wape'].mean():.1%}")
+    print(f"inputs + projection: {results['ms'].mean():.1f} ms per cutoff")
+
+    started = time.perf_counter()
+    forecast_milk(conn, user_id)
+    print(f"live forecast (stored fits): {(time.perf_counter() - started) * 1000:.0f} ms")
@@ -0,0 +1,102 @@
+"""Herd-wide heat cycle prediction from recorded heats.
+
+Every open animal's cycle length is estimated from the intervals between
+its recorded heats: an interval spanning a missed heat or two counts as that
+many cycles, implausible intervals are ignored, and the estimate is shrunk
+toward the species norm of CYCLE_DAYS so an animal with little history gets
+the norm. The next heat window is projected from the last recorded heat.
+All animals come from one query and are predicted in one NumPy pass.
+"""
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from querycache import cached_value
+
+# Species norm: buffalo cycle every 18-24 days, 21 on average
+CYCLE_DAYS = 21.0
+CYCLE_SD_DAYS = 2.0
+# A single-cycle interval estimate further than this from the norm is ignored
+CYCLE_TOLERANCE_DAYS = 4.0
+# Intervals of up to this many cycles (missed heats) still inform the length
+MAX_SKIPPED_CYCLES = 3
+# Weight of the norm, in intervals, when shrinking an animal's own estimate
+PRIOR_INTERVALS = 2.0
+WINDOW_DAYS = (1, 3)     # half-width of a predicted window: at least, at most
+HISTORY_DAYS = 365
+# Heats older than this many cycles no longer anchor a prediction
+MAX_CYCLES_AHEAD = 6
+HEAT_TABLES = ('buffalo_inventory', 'heat_detection', 'breeding_records')
+
+
+def cycle_estimates(groups, count, days):
+    """Per group, the cycle length, its spread and the number of usable intervals.
+
+    ``days`` must be sorted within each group. Each interval of about k
+    cycles (k up to MAX_SKIPPED_CYCLES) gives the estimate interval / k.
+    """
+    same = groups[1:] == groups[:-1]
+    interval = np.diff(days)[same]
+    owner = groups[1:][same]
+    cycles = np.clip(np.round(interval / CYCLE_DAYS), 1, None)
+    estimate = interval / cycles
+    usable = (cycles <= MAX_SKIPPED_CYCLES) & (np.abs(estimate - CYCLE_DAYS) <= CYCLE_TOLERANCE_DAYS)
+    owner, estimate = owner[usable], estimate[usable]
+
+    n = np.bincount(owner, minlength=count).astype(float)
+    total = np.bincount(owner, weights=estimate, minlength=count)
+    length = (total + PRIOR_INTERVALS * CYCLE_DAYS) / (n + PRIOR_INTERVALS)
+    squares = np.bincount(owner, weights=(estimate - length[owner]) ** 2, minlength=count)
+    spread = np.sqrt((squares + PRIOR_INTERVALS * CYCLE_SD_DAYS ** 2) / (n + PRIOR_INTERVALS))
+    return length, spread, n
+
+
+def predict_heats(conn, user_id, today=None, buffalo_id=None):
+    """Next heat window of every open animal with a recorded heat, soonest first.
+
+    Open means active and not carrying a recorded pregnancy: a pregnant
+    breeding record stops counting once its calving is recorded, as for the
+    expected calvings in ``farm_events``. With ``buffalo_id`` only that
+    animal is predicted.
+    """
+    today = pd.Timestamp(today or datetime.now().date())
+    sql = """SELECT bi.id, bi.tag_number, bi.name, h.heat_date
+             FROM heat_detection h
+             JOIN buffalo_inventory bi ON bi.id = h.buffalo_id
+             WHERE h.user_id=? AND h.heat_date >= date(?, ?) AND bi.status='Active'
+             AND bi.id NOT IN (SELECT buffalo_id FROM breeding_records
+                               WHERE user_id=? AND pregnancy_status='Pregnant'
+                               AND actual_calving_date IS NULL)"""
+    params = [user_id, str(today.date()), f"-{HISTORY_DAYS} days", user_id]
+    if buffalo_id is not None:
+        sql += " AND bi.id=?"
+        params.append(buffalo_id)
+    heats = pd.read_sql_query(sql + " ORDER BY bi.id, h.heat_date", conn, params=params)
+    days = (pd.to_datetime(heats['heat_date']) - today).dt.days.to_numpy(dtype=float)
+    ids, groups = np.unique(heats['id'].to_numpy(), return_inverse=True)
+    length, spread, _ = cycle_estimates(groups, len(ids), days)
+    last = np.full(len(ids), -np.inf)
+    np.maximum.at(last, groups, days)
+
+    # Roll past windows forward a whole cycle at a time: a heat that went
+    # unrecorded still moves the next one on
+    half = np.clip(np.round(spread), *WINDOW_DAYS)
+    ahead = np.maximum(np.ceil((-half - last) / length), 1)
+    expected = np.round(last + ahead * length)
+    keep = ahead <= MAX_CYCLES_AHEAD
+
+    def dates(offsets):
+        return today + pd.to_timedelta(offsets, unit='D')
+
+    first = heats.drop_duplicates('id').set_index('id').loc[ids]
+    return pd.DataFrame({
+        'buffalo_id': ids, 'tag_number': first['tag_number'].to_numpy(), 'name': first['name'].to_numpy(),
+        'last_heat': dates(last), 'heats': np.bincount(groups, minlength=len(ids)), 'cycle_days': length,
+        'window_start': dates(expected - half), 'expected': dates(expected), 'window_end': dates(expected + half),
+    })[keep].sort_values('expected', ignore_index=True)
+
+
+def herd_heats(conn, user_id):
+    """Cached predictions; recomputed only after a write to one of HEAT_TABLES."""
+    return cached_value(conn, user_id, 'heat_predictions', HEAT_TABLES, lambda: predict_heats(conn, user_id))
@@ -0,0 +1,115 @@
+"""Compact text snapshot of a farmer's herd for grounding AI answers.
+
+The snapshot is a handful of short lines (herd size and breeds, milk trend
+overall and per animal, open treatments, due vaccinations, pregnancies)
+built mostly from the milk rollup and the materialized alerts. It is kept
+in the query cache against the write versions of the tables it reads, so a
+question costs one version lookup until the farmer records something new.
+"""
+from datetime import datetime
+
+from querycache import cached_value
+
+TREND_DAYS = 30
+MAX_ANIMAL_LINES = 25
+MAX_EVENT_LINES = 8
+HEALTH_LOOKBACK_DAYS = 30
+
+SNAPSHOT_TABLES = ('buffalo_inventory', 'milk_production', 'health_records', 'breeding_records', 'alerts')
+
+
+def _change(current, previous):
+    if not previous:
+        return "new"
+    return f"{(current - previous) / previous:+.0%}"
+
+
+def _listed(items, limit):
+    shown = items[:limit]
+    if len(items) > limit:
+        shown.append(f"+{len(items) - limit} more")
+    return '; '.join(shown)
+
+
+def build_herd_snapshot(conn, user_id, today=None):
+    """Summarize the herd in a few lines of plain text; empty string for an empty farm."""
+    today = str(today or datetime.now().date())
+    params = {'u': user_id, 'today': today, 'days': f"-{TREND_DAYS} days", 'days2': f"-{2 * TREND_DAYS} days"}
+
+    breeds = conn.execute("""SELECT COALESCE(breed, 'Unknown'), COUNT(*), SUM(current_lactation > 0)
+                             FROM buffalo_inventory WHERE user_id=:u AND status='Active'
+                             GROUP BY 1 ORDER BY 2 DESC""", params).fetchall()
+    if not breeds:
+        return ""
+    total = sum(b[1] for b in breeds)
+    in_milk = sum(b[2] or 0 for b in breeds)
+    lines = [f"Herd: {total} active buffaloes ({in_milk} in milk). Breeds: "
+             + ', '.join(f"{breed} {count}" for breed, count, _ in breeds) + "."]
+
+    farm = conn.execute("""SELECT SUM(CASE WHEN date > date(:today, :days) THEN total_litres END),
+                                  COUNT(CASE WHEN date > date(:today, :days) THEN 1 END),
+                                  SUM(CASE WHEN date <= date(:today, :days) THEN total_litres END),
+                                  COUNT(CASE WHEN date <= date(:today, :days) THEN 1 END),
+                                  SUM(CASE WHEN date > date(:today, :days) THEN fat_litres END)
+                           FROM milk_daily_summary
+                           WHERE user_id=:u AND date > date(:today, :days2) AND date <= :today""",
+                        params).fetchone()
+    if farm[1]:
+        recent = farm[0] / farm[1]
+        previous = farm[2] / farm[3] if farm[3] else None
+        fat = f", avg fat {farm[4] / farm[0]:.1f}%" if farm[0] and farm[4] else ""
+        lines.append(f"Milk, last {TREND_DAYS} days: {recent:.1f} L/day ({_change(recent, previous)} "
+                     f"vs previous {TREND_DAYS} days){fat}.")
+
+    animals = conn.execute("""SELECT bi.tag_number,
+                                     SUM(CASE WHEN mp.date > date(:today, :days) THEN mp.total_yield END)
+                                     / NULLIF(COUNT(DISTINCT CASE WHEN mp.date > date(:today, :days)
+                                                                 THEN mp.date END), 0),
+                                     SUM(CASE WHEN mp.date <= date(:today, :days) THEN mp.total_yield END)
+                                     / NULLIF(COUNT(DISTINCT CASE WHEN mp.date <= date(:today, :days)
+                                                                 THEN mp.date END), 0)
+                              FROM milk_production mp
+                              JOIN buffalo_inventory bi ON bi.id = mp.buffalo_id
+                              WHERE mp.user_id=:u AND mp.date > date(:today, :days2) AND mp.date <= :today
+                              GROUP BY mp.buffalo_id
+                              ORDER BY 2 DESC""", params).fetchall()
+    per_animal = [f"{tag} {recent:.1f} ({_change(recent, previous)})"
+                  for tag, recent, previous in animals if recent is not None]
+    if per_animal:
+        lines.append(f"Per animal, L/day over last {TREND_DAYS} days (change): "
+                     + _listed(per_animal, MAX_ANIMAL_LINES) + ".")
+
+    health = conn.execute("""SELECT bi.tag_number, COALESCE(hr.disease_name, hr.record_type), hr.date
+                             FROM health_records hr
+                             JOIN buffalo_inventory bi ON bi.id = hr.buffalo_id
+                             WHERE hr.user_id=:u AND (hr.follow_up_date >= :today
+                                   OR (hr.record_type='Treatment' AND hr.date >= date(:today, :health)))
+                             ORDER BY hr.date DESC""",
+                          {**params, 'health': f"-{HEALTH_LOOKBACK_DAYS} days"}).fetchall()
+    if health:
+        lines.append("Open health issues: "
+                     + _listed([f"{tag} {issue} since {since}" for tag, issue, since in health],
+                               MAX_EVENT_LINES) + ".")
+
+    vaccinations = conn.execute("""SELECT message FROM alerts
+                                   WHERE user_id=:u AND resolved=0 AND alert_type='vaccination'
+                                   ORDER BY alert_date""", params).fetchall()
+    if vaccinations:
+        lines.append("Vaccinations due: " + _listed([m[0] for m in vaccinations], MAX_EVENT_LINES) + ".")
+
+    pregnancies = conn.execute("""SELECT bi.tag_number, br.expected_calving_date
+                                  FROM breeding_records br
+                                  JOIN buffalo_inventory bi ON bi.id = br.buffalo_id
+                                  WHERE br.user_id=:u AND br.pregnancy_status='Pregnant'
+                                  ORDER BY br.expected_calving_date""", params).fetchall()
+    if pregnancies:
+        lines.append("Pregnant: " + _listed([f"{tag} due {due}" for tag, due in pregnancies],
+                                            MAX_EVENT_LINES) + ".")
+
+    return "Farmer's herd (from their records):\n" + '\n'.join(f"- {line}" for line in lines)
+
+
+def herd_snapshot(conn, user_id):
+    """The cached snapshot, rebuilt only after a write to one of SNAPSHOT_TABLES."""
+    return cached_value(conn, user_id, 'herd_snapshot', SNAPSHOT_TABLES,
+                        lambda: build_herd_snapshot(conn, user_id))
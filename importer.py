@@ -0,0 +1,283 @@
+"""Streaming bulk import of farm records from CSV or Excel files.
+
+Files are read row by row (csv module, or openpyxl in read-only mode) and
+processed in fixed-size chunks: each chunk is validated, de-duplicated against
+the database and bulk-inserted with one executemany and one commit, so memory
+stays flat however many years of paper registers or analyser exports a farm
+brings in.
+"""
+import codecs
+import csv
+import math
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from itertools import islice
+
+from database import notify_write
+
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 500
+DATE_FORMATS = ('%Y-%m-%d', '%d-%m-%Y', '%d/%m/%Y', '%d.%m.%Y', '%Y/%m/%d')
+
+# Common header spellings in registers and analyser exports
+COLUMN_ALIASES = {
+    'tag': 'tag_number', 'tag_no': 'tag_number', 'tag_id': 'tag_number',
+    'morning': 'morning_yield', 'evening': 'evening_yield', 'total': 'total_yield',
+    'fat': 'fat_percentage', 'fat_%': 'fat_percentage', 'price': 'price_per_liter',
+    'rate': 'price_per_liter', 'dob': 'date_of_birth', 'type': 'transaction_type',
+    'disease': 'disease_name', 'lactation': 'current_lactation',
+}
+
+
+def _text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _number(value):
+    if isinstance(value, (int, float)):
+        number = float(value)
+    else:
+        value = _text(value)
+        if value is None:
+            return None
+        try:
+            number = float(value.replace(',', ''))
+        except ValueError:
+            raise ValueError(f"'{value}' is not a number")
+    # float() accepts "inf" and "nan"; neither is a reading, and int() of inf overflows
+    if not math.isfinite(number):
+        raise ValueError(f"'{value}' is not a number")
+    return number
+
+
+def _integer(value):
+    number = _number(value)
+    return None if number is None else int(number)
+
+
+def _date(value):
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    value = _text(value)
+    if value is None:
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value[:10], fmt).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"'{value}' is not a recognised date")
+
+
+def _prepare_milk(row):
+    if row['total_yield'] is None:
+        if row['morning_yield'] is None and row['evening_yield'] is None:
+            raise ValueError("no morning, evening or total yield")
+        row['total_yield'] = (row['morning_yield'] or 0) + (row['evening_yield'] or 0)
+    for column in ('morning_yield', 'evening_yield', 'total_yield'):
+        if row[column] is not None and row[column] < 0:
+            raise ValueError(f"{column} cannot be negative")
+    if row['fat_percentage'] is not None and not 0 <= row['fat_percentage'] <= 15:
+        raise ValueError("fat_percentage must be between 0 and 15")
+
+
+def _prepare_buffalo(row):
+    row['current_lactation'] = row['current_lactation'] or 0
+    row['status'] = row['status'] or 'Active'
+
+
+def _prepare_financial(row):
+    kind = row['transaction_type'].capitalize()
+    if kind not in ('Income', 'Expense'):
+        raise ValueError("transaction_type must be Income or Expense")
+    row['transaction_type'] = kind
+
+
+# For each importable table: column converters, required columns, whether rows
+# reference an animal by tag_number, and the columns that identify a duplicate.
+IMPORT_SPECS = {
+    'milk_production': {
+        'label': "Milk Production",
+        'fields': {'date': _date, 'morning_yield': _number, 'evening_yield': _number,
+                   'total_yield': _number, 'fat_percentage': _number,
+                   'price_per_liter': _number, 'notes': _text},
+        'required': ('tag_number', 'date'),
+        'needs_buffalo': True,
+        'key': ('buffalo_id', 'date'),
+        'prepare': _prepare_milk,
+    },
+    'buffalo_inventory': {
+        'label': "Buffalo Inventory",
+        'fields': {'tag_number': _text, 'name': _text, 'breed': _text, 'date_of_birth': _date,
+                   'purchase_date': _date, 'purchase_price': _number,
+                   'current_lactation': _integer, 'status': _text},
+        'required': ('tag_number',),
+        'needs_buffalo': False,
+        'key': ('tag_number',),
+        'prepare': _prepare_buffalo,
+    },
+    'health_records': {
+        'label': "Health Records",
+        'fields': {'date': _date, 'record_type': _text, 'disease_name': _text, 'symptoms': _text,
+                   'treatment': _text, 'medicine': _text, 'veterinarian': _text,
+                   'cost': _number, 'follow_up_date': _date, 'notes': _text},
+        'required': ('tag_number', 'date'),
+        'needs_buffalo': True,
+        'key': ('buffalo_id', 'date', 'record_type', 'disease_name'),
+        'prepare': None,
+    },
+    'financial_records': {
+        'label': "Financial Records",
+        'fields': {'date': _date, 'category': _text, 'transaction_type': _text,
+                   'amount': _number, 'description': _text},
+        'required': ('date', 'category', 'transaction_type', 'amount'),
+        'needs_buffalo': False,
+        'key': ('date', 'category', 'transaction_type', 'amount', 'description'),
+        'prepare': _prepare_financial,
+    },
+}
+
+
+@dataclass
+class ImportReport:
+    rows_read: int = 0
+    inserted: int = 0
+    duplicates: int = 0
+    error_count: int = 0
+    errors: list = field(default_factory=list)
+    fraction_done: float = None
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+
+def _normalize_header(name):
+    name = str(name or '').strip().lower().replace(' ', '_')
+    return COLUMN_ALIASES.get(name, name)
+
+
+def _iter_csv(file):
+    reader = csv.reader(codecs.getreader('utf-8-sig')(file))
+    header = [_normalize_header(h) for h in next(reader, [])]
+    for line, values in enumerate(reader, start=2):
+        if any(v.strip() for v in values):
+            yield line, dict(zip(header, values))
+
+
+def _iter_xlsx(file):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError("Excel import needs the openpyxl package. Check requirements.txt")
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [_normalize_header(h) for h in next(rows, ())]
+        for line, values in enumerate(rows, start=2):
+            if any(v is not None and str(v).strip() for v in values):
+                yield line, dict(zip(header, values))
+    finally:
+        workbook.close()
+
+
+def iter_file_rows(file, filename):
+    """Yield ``(line_number, {column: raw value})`` from a CSV or XLSX file, one row at a time."""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        return _iter_xlsx(file)
+    return _iter_csv(file)
+
+
+def _load_tag_index(conn, user_id):
+    return dict(conn.execute("SELECT tag_number, id FROM buffalo_inventory WHERE user_id=?", (user_id,)))
+
+
+def _convert(spec, raw, tag_index):
+    missing = [c for c in spec['required'] if _text(raw.get(c)) is None]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+
+    row = {column: convert(raw.get(column)) for column, convert in spec['fields'].items()}
+    if spec['needs_buffalo']:
+        tag = _text(raw.get('tag_number'))
+        if tag not in tag_index:
+            raise ValueError(f"unknown tag_number '{tag}'")
+        row['buffalo_id'] = tag_index[tag]
+    if spec['prepare']:
+        spec['prepare'](row)
+    return row
+
+
+def _is_duplicate(conn, table, spec, user_id, row):
+    if table == 'buffalo_inventory':
+        # Tags are unique across all farms, not just this user's
+        return conn.execute("SELECT user_id FROM buffalo_inventory WHERE tag_number=?",
+                            (row['tag_number'],)).fetchone()
+    where = ' AND '.join(f"{column} IS ?" for column in spec['key'])
+    return conn.execute(f"SELECT user_id FROM {table} WHERE user_id=? AND {where} LIMIT 1",
+                        (user_id, *(row[column] for column in spec['key']))).fetchone()
+
+
+def import_records(conn, user_id, table, file, filename, chunk_size=CHUNK_SIZE, progress=None):
+    """Stream ``file`` into ``table`` for ``user_id`` and return an ImportReport.
+
+    Every chunk is committed on its own, so a failure part-way through keeps
+    the chunks already imported; re-running the same file skips them as
+    duplicates. ``progress`` is called with the running report after each chunk.
+    """
+    spec = IMPORT_SPECS[table]
+    report = ImportReport()
+    tag_index = _load_tag_index(conn, user_id)
+    columns = ['user_id'] + list(spec['fields']) + (['buffalo_id'] if spec['needs_buffalo'] else [])
+    insert_sql = (f"INSERT INTO {table} ({', '.join(columns)}) "
+                  f"VALUES ({', '.join('?' for _ in columns)})")
+    size = getattr(file, 'size', None)
+
+    rows = iter_file_rows(file, filename)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        batch, seen = [], set()
+        for line, raw in chunk:
+            report.rows_read += 1
+            try:
+                row = _convert(spec, raw, tag_index)
+            except ValueError as e:
+                report.add_error(line, str(e))
+                continue
+
+            key = tuple(row[column] for column in spec['key'])
+            owner = None if key in seen else _is_duplicate(conn, table, spec, user_id, row)
+            if key in seen or (owner is not None and owner[0] == user_id):
+                report.duplicates += 1
+                continue
+            if owner is not None:
+                report.add_error(line, f"tag_number '{row['tag_number']}' belongs to another farm")
+                continue
+            seen.add(key)
+            row['user_id'] = user_id
+            batch.append(tuple(row[column] for column in columns))
+
+        if batch:
+            conn.executemany(insert_sql, batch)
+            if table == 'buffalo_inventory':
+                tag_index = _load_tag_index(conn, user_id)
+            notify_write(conn, user_id, table)
+            conn.commit()
+            report.inserted += len(batch)
+
+        if size and hasattr(file, 'tell') and not filename.lower().endswith(('.xlsx', '.xlsm')):
+            report.fraction_done = min(file.tell() / size, 1.0)
+        if progress:
+            progress(report)
+
+    report.fraction_done = 1.0
+    return report
@@ -0,0 +1,101 @@
+"""Herd inventory listing with indexed search.
+
+The inventory page lists one page of animals at a time, found by tag or
+name prefix through NOCASE indexes (migrations 6 and 14) and paged on a
+``(tag, id)`` keyset. Age, days in milk and last yield are computed for the
+whole page at once instead of per animal, and the full record of an animal
+is read only when it is opened.
+"""
+from datetime import datetime
+
+import pandas as pd
+
+INVENTORY_PAGE_SIZE = 100
+# Sorts after any character a tag or name can contain, closing the prefix range
+_PREFIX_END = '\U0010ffff'
+
+
+def _prefix_range(prefix):
+    return prefix, prefix + _PREFIX_END
+
+
+def inventory_page(conn, user_id, prefix='', after=None, page_size=INVENTORY_PAGE_SIZE, today=None):
+    """One page of the herd ordered by tag, optionally filtered by tag/name prefix.
+
+    Returns ``(DataFrame, next_cursor)``. The frame has id, tag_number, name,
+    breed, date_of_birth, current_lactation, status, last_calving, last_yield,
+    last_milked, age_years and days_in_milk. ``after`` is the cursor returned
+    with the previous page, a ``(tag_number, id)`` pair.
+    """
+    today = pd.Timestamp(today or datetime.now().date())
+    clauses, params = ["bi.user_id=:u"], {'u': user_id, 'limit': page_size + 1}
+    prefix = (prefix or '').strip()
+    if prefix:
+        # Range predicates rather than LIKE so each side can seek its index
+        params['lo'], params['hi'] = _prefix_range(prefix)
+        clauses.append("""(bi.tag_number COLLATE NOCASE >= :lo AND bi.tag_number COLLATE NOCASE < :hi
+                           OR bi.name COLLATE NOCASE >= :lo AND bi.name COLLATE NOCASE < :hi)""")
+    if after is not None:
+        # Ties on the case-folded tag are broken by id; untagged animals sort
+        # first, so a cursor inside them continues by id before the tagged ones.
+        # The separate >= bound is what lets SQLite seek the index: it does not
+        # seek on the row-value comparison alone.
+        params['after_tag'], params['after_id'] = after
+        if after[0] is None:
+            clauses.append("(bi.tag_number IS NULL AND bi.id > :after_id OR bi.tag_number IS NOT NULL)")
+        else:
+            clauses.append("""bi.tag_number COLLATE NOCASE >= :after_tag
+                              AND (bi.tag_number COLLATE NOCASE, bi.id) > (:after_tag, :after_id)""")
+
+    df = pd.read_sql_query(
+        f"""SELECT bi.id, bi.tag_number, bi.name, bi.breed, bi.date_of_birth,
+                   bi.current_lactation, bi.status,
+                   NULLIF(MAX(COALESCE((SELECT MAX(actual_calving_date) FROM breeding_records
+                                        WHERE buffalo_id = bi.id), ''),
+                              COALESCE((SELECT MAX(date_of_birth) FROM calf_records
+                                        WHERE mother_buffalo_id = bi.id), '')), '') AS last_calving,
+                   last.total_yield AS last_yield, last.date AS last_milked
+            FROM buffalo_inventory bi
+            LEFT JOIN milk_production last ON last.id = (
+                SELECT id FROM milk_production WHERE buffalo_id = bi.id
+                ORDER BY date DESC, id DESC LIMIT 1)
+            WHERE {' AND '.join(clauses)}
+            ORDER BY bi.tag_number COLLATE NOCASE, bi.id
+            LIMIT :limit""",
+        conn, params=params)
+
+    next_cursor = None
+    if len(df) > page_size:
+        df = df.iloc[:page_size]
+        last = df.iloc[-1]
+        next_cursor = (None if pd.isna(last['tag_number']) else last['tag_number'], int(last['id']))
+
+    dob = pd.to_datetime(df['date_of_birth'], errors='coerce')
+    calved = pd.to_datetime(df['last_calving'], errors='coerce')
+    df = df.assign(
+        age_years=((today - dob).dt.days // 365).astype('Int64'),
+        days_in_milk=(today - calved).dt.days.where(df['current_lactation'] > 0).astype('Int64'),
+    )
+    return df, next_cursor
+
+
+def buffalo_detail(conn, user_id, buffalo_id):
+    """Full record of one animal with its recent milk, breeding and health history."""
+    animal = pd.read_sql_query("""SELECT * FROM buffalo_inventory WHERE user_id=? AND id=?""",
+                               conn, params=(user_id, buffalo_id))
+    if animal.empty:
+        return None
+    milk = pd.read_sql_query("""SELECT date, morning_yield, evening_yield, total_yield, fat_percentage
+                                FROM milk_production WHERE buffalo_id=?
+                                ORDER BY date DESC, id DESC LIMIT 30""",
+                             conn, params=(buffalo_id,))
+    breeding = pd.read_sql_query("""SELECT breeding_date, breeding_type, expected_calving_date,
+                                           actual_calving_date, pregnancy_status
+                                    FROM breeding_records WHERE buffalo_id=?
+                                    ORDER BY breeding_date DESC LIMIT 10""",
+                                 conn, params=(buffalo_id,))
+    health = pd.read_sql_query("""SELECT date, record_type, disease_name, treatment, cost
+                                  FROM health_records WHERE buffalo_id=?
+                                  ORDER BY date DESC LIMIT 10""",
+                               conn, params=(buffalo_id,))
+    return {'animal': animal.iloc[0], 'milk': milk, 'breeding': breeding, 'health': health}
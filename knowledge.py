@@ -0,0 +1,96 @@
+"""Local BM25 retrieval over BuffaloMitra's reference data.
+
+The breed, disease, feed and scheme tables are flattened into one short
+snippet per entry and indexed once per process. For each question only the
+best few snippets are handed to the model, so answers can quote the app's
+own figures without the whole knowledge base riding along in every prompt.
+Pure Python, no network: the corpus is a few dozen entries.
+"""
+import math
+import re
+from collections import Counter, defaultdict
+
+TOP_K = 3
+# BM25 term-frequency saturation and length normalisation
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Share of the best score a lower-ranked snippet needs to be worth sending
+MIN_RELATIVE_SCORE = 0.3
+
+_WORD = re.compile(r'[a-z0-9]+')
+# English filler plus words nearly every farmer's question contains, which would
+# otherwise pull in whichever entries happen to mention dairy farming
+STOPWORDS = frozenset("""a an and are as at be by can do does for from how i in is it my of on or per
+should the their there this to what when which who why will with you your
+buffalo buffaloes dairy farm farming farmer farmers""".split())
+
+
+def tokenize(text):
+    """Lower-case words without stopwords, crudely stemmed (buffaloes, bloated, feeding)."""
+    tokens = []
+    for word in _WORD.findall(text.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 5 and word.endswith('ing'):
+            word = word[:-3]
+        elif len(word) > 5 and word.endswith('ed'):
+            word = word[:-2]
+        elif len(word) > 4 and word.endswith('es') and not word.endswith('ses'):
+            word = word[:-2]
+        elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def _field(name, value):
+    if isinstance(value, bool):
+        value = 'yes' if value else 'no'
+    elif isinstance(value, (list, tuple)):
+        value = ', '.join(map(str, value))
+    return f"{name.replace('_', ' ')}: {value}"
+
+
+def knowledge_documents(kind, entries):
+    """One ``(title, text)`` snippet per entry of a reference table such as BUFFALO_BREEDS."""
+    documents = []
+    for key, fields in entries.items():
+        title = f"{kind} - {fields.get('name') or key.replace('_', ' ')}"
+        text = '; '.join(_field(name, value) for name, value in fields.items() if name != 'name')
+        documents.append((title, text))
+    return documents
+
+
+class KnowledgeIndex:
+    """BM25 index over ``(title, text)`` snippets; titles count twice."""
+
+    def __init__(self, documents):
+        self.documents = list(documents)
+        self._postings = defaultdict(list)    # term -> [(doc index, term frequency)]
+        self._lengths = []
+        for i, (title, text) in enumerate(self.documents):
+            terms = tokenize(title) * 2 + tokenize(text)
+            self._lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                self._postings[term].append((i, tf))
+        count = len(self.documents)
+        self._avg_length = sum(self._lengths) / count if count else 0.0
+        self._idf = {term: math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                     for term, postings in self._postings.items()}
+
+    def search(self, query, k=TOP_K):
+        """Best ``k`` ``(score, title, text)`` hits, dropping those far below the best."""
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            for i, tf in self._postings.get(term, ()):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[i] / self._avg_length)
+                scores[i] += self._idf[term] * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: -item[1])[:k]
+        if not ranked:
+            return []
+        floor = ranked[0][1] * MIN_RELATIVE_SCORE
+        return [(score, *self.documents[i]) for i, score in ranked if score >= floor]
+
+    def reference_notes(self, query, k=TOP_K):
+        """The hits for ``query`` as prompt text; empty when nothing matches."""
+        return '\n'.join(f"- {title}: {text}" for _, title, text in self.search(query, k))
@@ -0,0 +1,254 @@
+"""Wood's lactation curves for the whole herd.
+
+Each active animal's current lactation is fitted with Wood's curve
+``y(t) = a * t**b * exp(-c * t)`` (``t`` = day of lactation) by least
+squares on ``ln y = ln a + b ln t - c t``. Only the nine sums of the normal
+equations are kept per animal (``lactation_fits``, migration 11), so new
+milk records are folded in by adding their sums and every animal is solved
+in one batched NumPy call; an animal is refit from scratch only when it
+calves again or one of its records is edited or deleted.
+"""
+import json
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from querycache import cached_value
+
+LACTATION_DAYS = 305
+# Without a recorded calving, a lactation is taken to start after a gap this long
+DRY_GAP_DAYS = 60
+START_LOOKBACK_DAYS = LACTATION_DAYS + DRY_GAP_DAYS
+MIN_RECORDS = 10
+MIN_DAY_SPREAD = 7.0     # standard deviation of record days needed for a stable fit
+STAGES = ((100, 'early'), (200, 'mid'), (LACTATION_DAYS, 'late'))
+
+STAT_COLUMNS = ('n', 'sum_l', 'sum_t', 'sum_ll', 'sum_lt', 'sum_tt', 'sum_z', 'sum_zl', 'sum_zt')
+LACTATION_TABLES = ('buffalo_inventory', 'milk_production', 'breeding_records', 'calf_records')
+
+
+def record_stats(groups, count, t, y):
+    """Normal-equation sums per group for records at lactation day ``t`` with yield ``y``."""
+    l, z = np.log(t), np.log(y)
+    weights = (np.ones_like(t), l, t, l * l, l * t, t * t, z, z * l, z * t)
+    return np.stack([np.bincount(groups, weights=w, minlength=count) for w in weights], axis=1)
+
+
+def fit_wood(stats):
+    """Wood parameters ``(a, b, c)`` per row of sums; NaN where the data cannot support a fit."""
+    n, L, T, LL, LT, TT, Z, ZL, ZT = stats.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spread = np.sqrt(np.maximum(TT / n - (T / n) ** 2, 0))
+    ok = (n >= MIN_RECORDS) & (spread >= MIN_DAY_SPREAD)
+    A = np.stack([np.stack([n, L, T], -1), np.stack([L, LL, LT], -1), np.stack([T, LT, TT], -1)], axis=1)
+    rhs = np.stack([Z, ZL, ZT], -1)
+    beta = np.full((len(stats), 3), np.nan)
+    if ok.any():
+        beta[ok] = (np.linalg.pinv(A[ok]) @ rhs[ok][..., None])[..., 0]
+    a, b, c = np.exp(beta[:, 0]), beta[:, 1], -beta[:, 2]
+    # A curve that never turns down cannot be projected over a lactation
+    bad = ~(c > 0)
+    return np.where(bad, np.nan, a), np.where(bad, np.nan, b), np.where(bad, np.nan, c)
+
+
+def wood_curves(a, b, c, days=LACTATION_DAYS):
+    """Daily litres for lactation days 1..``days``, one row per animal."""
+    t = np.arange(1, days + 1, dtype=float)
+    return a[:, None] * t ** b[:, None] * np.exp(-c[:, None] * t)
+
+
+def _calving_starts(conn, user_id):
+    """Active animal ids, and ``{buffalo_id: date}`` of the last recorded calving of those that have one."""
+    active, calved = [], {}
+    for buffalo_id, calving in conn.execute(
+            """SELECT bi.id,
+                      NULLIF(MAX(COALESCE((SELECT MAX(actual_calving_date) FROM breeding_records
+                                           WHERE buffalo_id = bi.id), ''),
+                                 COALESCE((SELECT MAX(date_of_birth) FROM calf_records
+                                           WHERE mother_buffalo_id = bi.id), '')), '')
+               FROM buffalo_inventory bi
+               WHERE bi.user_id=? AND bi.status='Active'""", (user_id,)):
+        active.append(buffalo_id)
+        if calving:
+            calved[buffalo_id] = calving
+    return active, calved
+
+
+def _gap_starts(conn, since, today):
+    """Per animal, the first record after its latest dry gap of more than DRY_GAP_DAYS.
+
+    ``since`` maps buffalo ids to their last recorded calving, or None. Only
+    a gap that began after that calving counts: the dry period before it
+    does not. Records are searched back START_LOOKBACK_DAYS; an animal with
+    nothing in the first DRY_GAP_DAYS of that window is taken to have been
+    dry before its first record unless its calving falls inside the window.
+    Without a calving the first record of the window serves as a last resort.
+    """
+    if not since:
+        return {}
+    return dict(conn.execute(
+        """SELECT buffalo_id, MAX(date) FROM (
+               SELECT mp.buffalo_id, mp.date, json_extract(w.value, '$[1]') AS since,
+                      LAG(mp.date) OVER (PARTITION BY mp.buffalo_id ORDER BY mp.date) AS previous
+               FROM json_each(:animals) w
+               JOIN milk_production mp ON mp.buffalo_id = json_extract(w.value, '$[0]')
+               WHERE mp.date >= date(:today, :lookback) AND mp.total_yield > 0)
+           WHERE CASE WHEN previous IS NULL
+                      THEN since IS NULL OR (since < date(:today, :lookback) AND date >= date(:today, :silent))
+                      ELSE julianday(date) - julianday(previous) > :gap AND previous >= COALESCE(since, '')
+                 END
+           GROUP BY buffalo_id""",
+        {'animals': json.dumps([[buffalo_id, calving] for buffalo_id, calving in since.items()]), 'today': today,
+         'lookback': f"-{START_LOOKBACK_DAYS} days", 'silent': f"-{START_LOOKBACK_DAYS - DRY_GAP_DAYS} days",
+         'gap': DRY_GAP_DAYS}))
+
+
+def refresh_lactation_fits(conn, user_id, today=None):
+    """Fold new milk records into the stored fits and re-solve the animals they touch.
+
+    Returns the number of animals refit. The current lactation starts at the
+    last recorded calving, unless a dry gap of more than DRY_GAP_DAYS follows
+    it: then, as for an animal without a recorded calving, at the first
+    record after the latest such gap. All new records of the herd are read
+    with one query and all fits are solved in one batch.
+    """
+    today = str(today or datetime.now().date())
+    active, calved = _calving_starts(conn, user_id)
+    conn.execute("""DELETE FROM lactation_fits WHERE user_id=?
+                    AND buffalo_id NOT IN (SELECT value FROM json_each(?))""", (user_id, json.dumps(active)))
+    stored = {row[0]: row for row in conn.execute(
+        f"""SELECT buffalo_id, lactation_start, start_source, through_id, last_day, {', '.join(STAT_COLUMNS)}
+            FROM lactation_fits WHERE user_id=?""", (user_id,))}
+
+    # A stored start stays valid while no later calving has been recorded;
+    # only animals seen for the first time, or newly calved, are searched for
+    # a dry gap. A gap after the last recorded calving means the animal calved
+    # again unrecorded, so the calving is used only when no such gap exists.
+    starts, missing = {}, {}
+    for buffalo_id in active:
+        row, calving = stored.get(buffalo_id), calved.get(buffalo_id)
+        if row is not None and (row[1:3] == (calving, 'calving')
+                                or row[2] == 'first record' and (calving is None or row[1] > calving)):
+            starts[buffalo_id] = (row[1], row[2])
+        else:
+            missing[buffalo_id] = calving
+    gaps = _gap_starts(conn, missing, today)
+    for buffalo_id, calving in missing.items():
+        if buffalo_id in gaps:
+            starts[buffalo_id] = (gaps[buffalo_id], 'first record')
+        elif calving is not None:
+            starts[buffalo_id] = (calving, 'calving')
+    if not starts:
+        return 0
+
+    ids = list(starts)
+    stats = np.zeros((len(ids), len(STAT_COLUMNS)))
+    through = np.zeros(len(ids), dtype=np.int64)
+    last_day = np.zeros(len(ids))
+    restarted = np.ones(len(ids), dtype=bool)
+    for i, buffalo_id in enumerate(ids):
+        row = stored.get(buffalo_id)
+        if row is not None and row[1:3] == starts[buffalo_id]:
+            through[i], last_day[i], stats[i], restarted[i] = row[3], row[4], row[5:], False
+
+    # One seek per animal on idx_milk_buffalo_id, driven by a JSON array; the
+    # unary + keeps the planner off the date indexes, which would walk the
+    # whole lactation to find the few new ids
+    wanted = json.dumps([[buffalo_id, starts[buffalo_id][0], int(after)] for buffalo_id, after in zip(ids, through)])
+    rows = conn.execute("""SELECT w.key, mp.id, julianday(mp.date) - julianday(json_extract(w.value, '$[1]')),
+                                  mp.total_yield
+                           FROM json_each(?) w
+                           JOIN milk_production mp
+                             ON mp.buffalo_id = json_extract(w.value, '$[0]')
+                            AND mp.id > json_extract(w.value, '$[2]')
+                           WHERE +mp.date >= json_extract(w.value, '$[1]') AND mp.total_yield > 0""",
+                        (wanted,)).fetchall()
+    touched = restarted.copy()
+    if rows:
+        new = np.array(rows, dtype=float)
+        groups, t = new[:, 0].astype(np.int64), new[:, 2] + 1
+
+        # A long gap before a new record means the animal dried off and calved
+        # again without a recorded calving: find its new start and refit it
+        order = np.lexsort((t, groups))
+        g, days = groups[order], t[order]
+        first = np.r_[True, g[1:] != g[:-1]]
+        previous = np.where(first, last_day[g], np.r_[0.0, days[:-1]])
+        gapped = np.zeros(len(ids), dtype=bool)
+        gapped[g[(previous > 0) & (days - previous > DRY_GAP_DAYS)]] = True
+        # A start just found by the search stands, even where its window missed an older gap
+        gapped &= ~np.isin(ids, list(missing))
+        if gapped.any():
+            conn.executemany("DELETE FROM lactation_fits WHERE buffalo_id=?",
+                             [(ids[i],) for i in np.flatnonzero(gapped)])
+            return refresh_lactation_fits(conn, user_id, today)
+
+        stats += record_stats(groups, len(ids), t, new[:, 3])
+        np.maximum.at(through, groups, new[:, 1].astype(np.int64))
+        np.maximum.at(last_day, groups, t)
+        touched |= np.bincount(groups, minlength=len(ids)) > 0
+    if not touched.any():
+        return 0
+
+    index = np.flatnonzero(touched)
+    a, b, c = fit_wood(stats[index])
+    curves = wood_curves(np.nan_to_num(a), np.nan_to_num(b), np.nan_to_num(c, nan=1.0))
+    fitted = ~np.isnan(a)
+    peak_day = np.where(fitted, curves.argmax(axis=1) + 1, 0)
+    peak_yield = np.where(fitted, curves.max(axis=1), np.nan)
+    yield_305 = np.where(fitted, curves.sum(axis=1), np.nan)
+
+    def value(x):
+        return None if np.isnan(x) else float(x)
+
+    now = time.time()
+    conn.executemany(
+        f"""INSERT OR REPLACE INTO lactation_fits
+            (buffalo_id, user_id, lactation_start, start_source, through_id, last_day, {', '.join(STAT_COLUMNS)},
+             wood_a, wood_b, wood_c, peak_day, peak_yield, yield_305, fitted_at)
+            VALUES ({', '.join('?' * (6 + len(STAT_COLUMNS) + 7))})""",
+        [(ids[i], user_id, *starts[ids[i]], int(through[i]), float(last_day[i]), *map(float, stats[i]),
+          value(a[k]), value(b[k]), value(c[k]), int(peak_day[k]) or None, value(peak_yield[k]),
+          value(yield_305[k]), now)
+         for k, i in enumerate(index)])
+    return len(index)
+
+
+def _stage(days_in_milk):
+    for limit, name in STAGES:
+        if days_in_milk <= limit:
+            return name
+    return 'extended'
+
+
+def load_lactation(conn, user_id, today=None):
+    """Refresh the fits, then one row per animal with its lactation stage and projection."""
+    refresh_lactation_fits(conn, user_id, today)
+    today = pd.Timestamp(today or datetime.now().date())
+    df = pd.read_sql_query("""SELECT bi.tag_number, bi.name, bi.breed, lf.lactation_start, lf.start_source,
+                                     CAST(lf.n AS INTEGER) AS records, lf.wood_a, lf.wood_b, lf.wood_c,
+                                     lf.peak_day, lf.peak_yield, lf.yield_305
+                              FROM lactation_fits lf
+                              JOIN buffalo_inventory bi ON bi.id = lf.buffalo_id
+                              WHERE lf.user_id=?
+                              ORDER BY bi.tag_number""", conn, params=(user_id,))
+    days_in_milk = (today - pd.to_datetime(df['lactation_start'])).dt.days + 1
+    expected = df['wood_a'] * days_in_milk ** df['wood_b'] * np.exp(-df['wood_c'] * days_in_milk)
+    return df.assign(days_in_milk=days_in_milk, stage=days_in_milk.map(_stage), expected_today=expected)
+
+
+def herd_lactation(conn, user_id):
+    """Cached lactation table; refit only after a write to one of LACTATION_TABLES."""
+    return cached_value(conn, user_id, 'lactation', LACTATION_TABLES, lambda: load_lactation(conn, user_id))
+
+
+def lactation_curve_points(lactation, days=LACTATION_DAYS):
+    """Long-form fitted daily litres (tag_number, day, litres) of every fitted animal, for plotting."""
+    fitted = lactation.dropna(subset=['wood_a'])
+    curves = wood_curves(fitted['wood_a'].to_numpy(), fitted['wood_b'].to_numpy(), fitted['wood_c'].to_numpy(),
+                         days)
+    return pd.DataFrame({'tag_number': np.repeat(fitted['tag_number'].to_numpy(), days),
+                         'day': np.tile(np.arange(1, days + 1), len(fitted)),
+                         'litres': curves.ravel()})
@@ -0,0 +1,660 @@
+"""Ordered schema migrations for the BuffaloMitra database.
+
+Each entry is ``(version, description, steps)``. A step is either a SQL
+statement or a callable taking the open connection. Migrations are applied in
+order by ``database.migrate()`` and recorded in the ``schema_version`` table;
+never edit a migration that has shipped, append a new one instead.
+"""
+
+BASELINE_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS users
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              username TEXT UNIQUE NOT NULL,
+              password_hash TEXT NOT NULL,
+              full_name TEXT NOT NULL,
+              mobile TEXT NOT NULL,
+              email TEXT,
+              district TEXT,
+              village TEXT,
+              user_type TEXT DEFAULT 'Dairy Farmer',
+              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    '''CREATE TABLE IF NOT EXISTS buffalo_inventory
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              tag_number TEXT UNIQUE,
+              name TEXT,
+              breed TEXT,
+              date_of_birth DATE,
+              purchase_date DATE,
+              purchase_price REAL,
+              current_lactation INTEGER DEFAULT 0,
+              status TEXT DEFAULT 'Active',
+              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+              FOREIGN KEY(user_id) REFERENCES users(id))''',
+    '''CREATE TABLE IF NOT EXISTS milk_production
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              buffalo_id INTEGER,
+              date DATE,
+              morning_yield REAL,
+              evening_yield REAL,
+              total_yield REAL,
+              fat_percentage REAL,
+              price_per_liter REAL,
+              notes TEXT,
+              FOREIGN KEY(user_id) REFERENCES users(id),
+              FOREIGN KEY(buffalo_id) REFERENCES buffalo_inventory(id))''',
+    '''CREATE TABLE IF NOT EXISTS breeding_records
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              buffalo_id INTEGER,
+              breeding_date DATE,
+              breeding_type TEXT,
+              bull_details TEXT,
+              expected_calving_date DATE,
+              actual_calving_date DATE,
+              calf_gender TEXT,
+              pregnancy_status TEXT DEFAULT 'Bred',
+              notes TEXT,
+              FOREIGN KEY(user_id) REFERENCES users(id),
+              FOREIGN KEY(buffalo_id) REFERENCES buffalo_inventory(id))''',
+    '''CREATE TABLE IF NOT EXISTS health_records
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              buffalo_id INTEGER,
+              date DATE,
+              record_type TEXT,
+              disease_name TEXT,
+              symptoms TEXT,
+              treatment TEXT,
+              medicine TEXT,
+              veterinarian TEXT,
+              cost REAL,
+              follow_up_date DATE,
+              notes TEXT,
+              FOREIGN KEY(user_id) REFERENCES users(id),
+              FOREIGN KEY(buffalo_id) REFERENCES buffalo_inventory(id))''',
+    '''CREATE TABLE IF NOT EXISTS feed_management
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              date DATE,
+              feed_type TEXT,
+              quantity_kg REAL,
+              cost_per_kg REAL,
+              total_cost REAL,
+              supplier TEXT,
+              notes TEXT,
+              FOREIGN KEY(user_id) REFERENCES users(id))''',
+    '''CREATE TABLE IF NOT EXISTS financial_records
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              date DATE,
+              category TEXT,
+              transaction_type TEXT,
+              amount REAL,
+              description TEXT,
+              FOREIGN KEY(user_id) REFERENCES users(id))''',
+    '''CREATE TABLE IF NOT EXISTS milk_buyers
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              buyer_name TEXT,
+              contact TEXT,
+              price_per_liter REAL,
+              payment_terms TEXT,
+              active BOOLEAN DEFAULT 1,
+              FOREIGN KEY(user_id) REFERENCES users(id))''',
+    '''CREATE TABLE IF NOT EXISTS calf_records
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              mother_buffalo_id INTEGER,
+              tag_number TEXT UNIQUE,
+              name TEXT,
+              date_of_birth DATE,
+              gender TEXT,
+              birth_weight REAL,
+              breed TEXT,
+              status TEXT DEFAULT 'Active',
+              weaning_date DATE,
+              sale_date DATE,
+              sale_price REAL,
+              notes TEXT,
+              FOREIGN KEY(user_id) REFERENCES users(id),
+              FOREIGN KEY(mother_buffalo_id) REFERENCES buffalo_inventory(id))''',
+    '''CREATE TABLE IF NOT EXISTS heat_detection
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              buffalo_id INTEGER,
+              heat_date DATE,
+              heat_intensity TEXT,
+              bred BOOLEAN DEFAULT 0,
+              breeding_id INTEGER,
+              notes TEXT,
+              FOREIGN KEY(user_id) REFERENCES users(id),
+              FOREIGN KEY(buffalo_id) REFERENCES buffalo_inventory(id))''',
+    '''CREATE TABLE IF NOT EXISTS vaccination_records
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              buffalo_id INTEGER,
+              vaccination_type TEXT,
+              date DATE,
+              next_due_date DATE,
+              veterinarian TEXT,
+              cost REAL,
+              batch_number TEXT,
+              notes TEXT,
+              FOREIGN KEY(user_id) REFERENCES users(id),
+              FOREIGN KEY(buffalo_id) REFERENCES buffalo_inventory(id))''',
+    '''CREATE TABLE IF NOT EXISTS feed_inventory
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              feed_name TEXT,
+              feed_type TEXT,
+              current_stock_kg REAL,
+              reorder_level_kg REAL,
+              last_purchase_date DATE,
+              last_purchase_quantity REAL,
+              last_purchase_cost REAL,
+              supplier TEXT,
+              FOREIGN KEY(user_id) REFERENCES users(id))''',
+    '''CREATE TABLE IF NOT EXISTS alerts
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              alert_type TEXT,
+              buffalo_id INTEGER,
+              alert_date DATE,
+              message TEXT,
+              priority TEXT,
+              resolved BOOLEAN DEFAULT 0,
+              created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+              FOREIGN KEY(user_id) REFERENCES users(id))''',
+    '''CREATE TABLE IF NOT EXISTS labor_records
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER,
+              worker_name TEXT,
+              contact TEXT,
+              role TEXT,
+              monthly_salary REAL,
+              join_date DATE,
+              active BOOLEAN DEFAULT 1,
+              FOREIGN KEY(user_id) REFERENCES users(id))''',
+]
+
+# Composite indexes follow the app's query shapes: every page filters on
+# user_id first, then on a status or date column. Trailing columns make the
+# hottest aggregates (daily milk totals, selectbox lists, finance summaries)
+# covering, so they never touch the table rows.
+ACCESS_PATH_INDEXES = [
+    """CREATE INDEX IF NOT EXISTS idx_buffalo_user_status
+       ON buffalo_inventory(user_id, status, current_lactation, tag_number, name, breed)""",
+    """CREATE INDEX IF NOT EXISTS idx_buffalo_user_tag
+       ON buffalo_inventory(user_id, tag_number)""",
+    """CREATE INDEX IF NOT EXISTS idx_milk_user_date
+       ON milk_production(user_id, date, total_yield, fat_percentage, price_per_liter, buffalo_id)""",
+    """CREATE INDEX IF NOT EXISTS idx_milk_buffalo_date
+       ON milk_production(buffalo_id, date, total_yield, fat_percentage)""",
+    """CREATE INDEX IF NOT EXISTS idx_breeding_user_status_calving
+       ON breeding_records(user_id, pregnancy_status, expected_calving_date)""",
+    """CREATE INDEX IF NOT EXISTS idx_breeding_user_date
+       ON breeding_records(user_id, breeding_date)""",
+    """CREATE INDEX IF NOT EXISTS idx_health_user_date
+       ON health_records(user_id, date)""",
+    """CREATE INDEX IF NOT EXISTS idx_health_user_follow_up
+       ON health_records(user_id, follow_up_date)""",
+    """CREATE INDEX IF NOT EXISTS idx_vaccination_user_due
+       ON vaccination_records(user_id, next_due_date)""",
+    """CREATE INDEX IF NOT EXISTS idx_vaccination_user_date
+       ON vaccination_records(user_id, date)""",
+    """CREATE INDEX IF NOT EXISTS idx_heat_user_date
+       ON heat_detection(user_id, heat_date)""",
+    """CREATE INDEX IF NOT EXISTS idx_heat_buffalo_date
+       ON heat_detection(buffalo_id, heat_date)""",
+    """CREATE INDEX IF NOT EXISTS idx_calf_user_status
+       ON calf_records(user_id, status)""",
+    """CREATE INDEX IF NOT EXISTS idx_calf_user_dob
+       ON calf_records(user_id, date_of_birth)""",
+    """CREATE INDEX IF NOT EXISTS idx_feed_inventory_user_type
+       ON feed_inventory(user_id, feed_type, feed_name)""",
+    """CREATE INDEX IF NOT EXISTS idx_feed_management_user_date
+       ON feed_management(user_id, date)""",
+    """CREATE INDEX IF NOT EXISTS idx_financial_user_date
+       ON financial_records(user_id, date, transaction_type, category, amount)""",
+    """CREATE INDEX IF NOT EXISTS idx_financial_user_type
+       ON financial_records(user_id, transaction_type, amount)""",
+    """CREATE INDEX IF NOT EXISTS idx_buyers_user_active
+       ON milk_buyers(user_id, active)""",
+    """CREATE INDEX IF NOT EXISTS idx_labor_user_active
+       ON labor_records(user_id, active, worker_name)""",
+    """CREATE INDEX IF NOT EXISTS idx_alerts_user_open
+       ON alerts(user_id, resolved, priority)""",
+    "ANALYZE",
+]
+
+# Materialized alerts: each open alert points back at the row that raised it,
+# and alert_counts keeps a per-user open/high tally current via triggers so the
+# sidebar badge is a single primary-key read.
+MATERIALIZED_ALERTS = [
+    "ALTER TABLE alerts ADD COLUMN source_id INTEGER",
+    "DROP INDEX IF EXISTS idx_alerts_user_open",
+    """CREATE UNIQUE INDEX IF NOT EXISTS idx_alerts_source
+       ON alerts(user_id, alert_type, source_id)""",
+    """CREATE INDEX IF NOT EXISTS idx_alerts_user_open
+       ON alerts(user_id, resolved, priority, alert_date)""",
+    '''CREATE TABLE IF NOT EXISTS alert_counts
+             (user_id INTEGER PRIMARY KEY,
+              open_count INTEGER NOT NULL DEFAULT 0,
+              high_count INTEGER NOT NULL DEFAULT 0,
+              FOREIGN KEY(user_id) REFERENCES users(id))''',
+    '''CREATE TABLE IF NOT EXISTS alert_sweeps
+             (user_id INTEGER PRIMARY KEY,
+              swept_on DATE,
+              FOREIGN KEY(user_id) REFERENCES users(id))''',
+    """CREATE TRIGGER IF NOT EXISTS trg_alerts_count_insert AFTER INSERT ON alerts
+       BEGIN
+           INSERT INTO alert_counts (user_id, open_count, high_count)
+           VALUES (NEW.user_id, NEW.resolved = 0, NEW.resolved = 0 AND NEW.priority = 'high')
+           ON CONFLICT(user_id) DO UPDATE SET
+               open_count = open_count + excluded.open_count,
+               high_count = high_count + excluded.high_count;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_alerts_count_update AFTER UPDATE OF resolved, priority ON alerts
+       BEGIN
+           UPDATE alert_counts SET
+               open_count = open_count - (OLD.resolved = 0),
+               high_count = high_count - (OLD.resolved = 0 AND OLD.priority = 'high')
+           WHERE user_id = OLD.user_id;
+           INSERT INTO alert_counts (user_id, open_count, high_count)
+           VALUES (NEW.user_id, NEW.resolved = 0, NEW.resolved = 0 AND NEW.priority = 'high')
+           ON CONFLICT(user_id) DO UPDATE SET
+               open_count = open_count + excluded.open_count,
+               high_count = high_count + excluded.high_count;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_alerts_count_delete AFTER DELETE ON alerts
+       BEGIN
+           UPDATE alert_counts SET
+               open_count = open_count - (OLD.resolved = 0),
+               high_count = high_count - (OLD.resolved = 0 AND OLD.priority = 'high')
+           WHERE user_id = OLD.user_id;
+       END""",
+    """INSERT OR REPLACE INTO alert_counts (user_id, open_count, high_count)
+       SELECT user_id, SUM(resolved = 0), SUM(resolved = 0 AND priority = 'high')
+       FROM alerts GROUP BY user_id""",
+]
+
+
+def _apply_milk_delta(ref, sign):
+    """Trigger statements adding (sign=1) or removing (sign=-1) one record's share of its day."""
+    duplicate = f"""EXISTS (SELECT 1 FROM milk_production
+                            WHERE buffalo_id={ref}.buffalo_id AND date={ref}.date AND id<>{ref}.id)"""
+    statements = f"""INSERT INTO milk_daily_summary
+               (user_id, date, total_litres, animals_milked, record_count, fat_litres, avg_fat, revenue)
+           VALUES ({ref}.user_id, {ref}.date,
+                   {sign} * COALESCE({ref}.total_yield, 0),
+                   {sign} * (NOT {duplicate}),
+                   {sign},
+                   {sign} * COALESCE({ref}.fat_percentage * {ref}.total_yield, 0),
+                   {ref}.fat_percentage,
+                   {sign} * COALESCE({ref}.total_yield * {ref}.price_per_liter, 0))
+           ON CONFLICT(user_id, date) DO UPDATE SET
+               total_litres = total_litres + excluded.total_litres,
+               animals_milked = animals_milked + excluded.animals_milked,
+               record_count = record_count + excluded.record_count,
+               fat_litres = fat_litres + excluded.fat_litres,
+               avg_fat = (fat_litres + excluded.fat_litres)
+                         / NULLIF(total_litres + excluded.total_litres, 0),
+               revenue = revenue + excluded.revenue;"""
+    if sign < 0:
+        statements += f"""
+           DELETE FROM milk_daily_summary
+           WHERE user_id={ref}.user_id AND date={ref}.date AND record_count <= 0;"""
+    return statements
+
+
+# Per-farm daily milk rollup, maintained in O(1) per written record: triggers
+# add or subtract the record's share of its day instead of re-aggregating it,
+# so bulk loads stay linear. The duplicate check (same animal, same day) is an
+# index seek on idx_milk_buffalo_date. Dashboards and reports read one row per
+# farm-day instead of one row per animal per day.
+MILK_DAILY_SUMMARY = [
+    '''CREATE TABLE IF NOT EXISTS milk_daily_summary
+             (user_id INTEGER NOT NULL,
+              date DATE NOT NULL,
+              total_litres REAL NOT NULL DEFAULT 0,
+              animals_milked INTEGER NOT NULL DEFAULT 0,
+              record_count INTEGER NOT NULL DEFAULT 0,
+              fat_litres REAL NOT NULL DEFAULT 0,
+              avg_fat REAL,
+              revenue REAL NOT NULL DEFAULT 0,
+              PRIMARY KEY (user_id, date),
+              FOREIGN KEY(user_id) REFERENCES users(id)) WITHOUT ROWID''',
+    f"""CREATE TRIGGER IF NOT EXISTS trg_milk_summary_insert AFTER INSERT ON milk_production
+        WHEN NEW.user_id IS NOT NULL AND NEW.date IS NOT NULL
+        BEGIN
+           {_apply_milk_delta('NEW', 1)}
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_milk_summary_delete AFTER DELETE ON milk_production
+        WHEN OLD.user_id IS NOT NULL AND OLD.date IS NOT NULL
+        BEGIN
+           {_apply_milk_delta('OLD', -1)}
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_milk_summary_update_old AFTER UPDATE ON milk_production
+        WHEN OLD.user_id IS NOT NULL AND OLD.date IS NOT NULL
+        BEGIN
+           {_apply_milk_delta('OLD', -1)}
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_milk_summary_update_new AFTER UPDATE ON milk_production
+        WHEN NEW.user_id IS NOT NULL AND NEW.date IS NOT NULL
+        BEGIN
+           {_apply_milk_delta('NEW', 1)}
+        END""",
+    """INSERT OR REPLACE INTO milk_daily_summary
+           (user_id, date, total_litres, animals_milked, record_count, fat_litres, avg_fat, revenue)
+       SELECT user_id, date, COALESCE(SUM(total_yield), 0), COUNT(DISTINCT buffalo_id), COUNT(*),
+              COALESCE(SUM(fat_percentage * total_yield), 0),
+              SUM(fat_percentage * total_yield) / NULLIF(SUM(total_yield), 0),
+              COALESCE(SUM(total_yield * price_per_liter), 0)
+       FROM milk_production
+       WHERE user_id IS NOT NULL AND date IS NOT NULL
+       GROUP BY user_id, date""",
+]
+
+# (date, id) keysets for paging through milk records; the trailing id keeps
+# same-day rows in index order so neither sort needs a temp B-tree.
+MILK_KEYSET_INDEXES = [
+    """CREATE INDEX IF NOT EXISTS idx_milk_user_keyset
+       ON milk_production(user_id, date, id)""",
+    """CREATE INDEX IF NOT EXISTS idx_milk_buffalo_keyset
+       ON milk_production(buffalo_id, date, id)""",
+    "ANALYZE milk_production",
+]
+
+# Prefix search on tag/name and the per-animal lookups behind the inventory page
+INVENTORY_SEARCH_INDEXES = [
+    """CREATE INDEX IF NOT EXISTS idx_buffalo_user_tag_nocase
+       ON buffalo_inventory(user_id, tag_number COLLATE NOCASE)""",
+    """CREATE INDEX IF NOT EXISTS idx_buffalo_user_name_nocase
+       ON buffalo_inventory(user_id, name COLLATE NOCASE)""",
+    """CREATE INDEX IF NOT EXISTS idx_breeding_buffalo_calving
+       ON breeding_records(buffalo_id, actual_calving_date)""",
+    """CREATE INDEX IF NOT EXISTS idx_calf_mother_dob
+       ON calf_records(mother_buffalo_id, date_of_birth)""",
+    """CREATE INDEX IF NOT EXISTS idx_health_buffalo_date
+       ON health_records(buffalo_id, date)""",
+    "ANALYZE",
+]
+
+VERSIONED_TABLES = (
+    'buffalo_inventory', 'milk_production', 'breeding_records', 'health_records',
+    'feed_management', 'financial_records', 'milk_buyers', 'calf_records', 'heat_detection',
+    'vaccination_records', 'feed_inventory', 'alerts', 'labor_records',
+)
+
+
+def _bump_version(table, event, ref):
+    return f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()} AFTER {event} ON {table}
+        WHEN {ref}.user_id IS NOT NULL
+        BEGIN
+            INSERT INTO table_versions (user_id, table_name, version) VALUES ({ref}.user_id, '{table}', 1)
+            ON CONFLICT(user_id, table_name) DO UPDATE SET version = version + 1;
+        END"""
+
+
+# Per-user write counter for every farm table, bumped inside the writer's own
+# transaction so that any write path (forms, imports, another process)
+# invalidates what the query cache holds for that user and table.
+TABLE_VERSIONS = [
+    '''CREATE TABLE IF NOT EXISTS table_versions
+             (user_id INTEGER NOT NULL,
+              table_name TEXT NOT NULL,
+              version INTEGER NOT NULL DEFAULT 0,
+              PRIMARY KEY (user_id, table_name)) WITHOUT ROWID''',
+    *(_bump_version(table, event, ref)
+      for table in VERSIONED_TABLES
+      for event, ref in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD'))),
+]
+
+AI_RESPONSE_CACHE = [
+    '''CREATE TABLE IF NOT EXISTS ai_response_cache
+             (cache_key TEXT PRIMARY KEY,
+              question TEXT NOT NULL,
+              district TEXT,
+              model TEXT NOT NULL,
+              response TEXT NOT NULL,
+              created_at REAL NOT NULL,
+              last_used_at REAL NOT NULL,
+              hits INTEGER NOT NULL DEFAULT 0)''',
+    """CREATE INDEX IF NOT EXISTS idx_ai_cache_last_used
+       ON ai_response_cache(last_used_at)""",
+    '''CREATE TABLE IF NOT EXISTS ai_cache_stats
+             (id INTEGER PRIMARY KEY CHECK (id = 1),
+              hits INTEGER NOT NULL DEFAULT 0,
+              misses INTEGER NOT NULL DEFAULT 0)''',
+    "INSERT OR IGNORE INTO ai_cache_stats (id, hits, misses) VALUES (1, 0, 0)",
+]
+
+# One row per answer the assistant produced or failed to produce; the view
+# rolls them up per day and model for quick budget checks.
+AI_USAGE_METRICS = [
+    '''CREATE TABLE IF NOT EXISTS ai_usage
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              created_at REAL NOT NULL,
+              user_id INTEGER,
+              district TEXT,
+              kind TEXT NOT NULL,
+              model TEXT NOT NULL,
+              status TEXT NOT NULL,
+              error_class TEXT,
+              attempts INTEGER NOT NULL DEFAULT 1,
+              tool_calls INTEGER NOT NULL DEFAULT 0,
+              queue_s REAL,
+              ttft_s REAL,
+              duration_s REAL,
+              input_tokens INTEGER NOT NULL DEFAULT 0,
+              output_tokens INTEGER NOT NULL DEFAULT 0,
+              cache_read_tokens INTEGER NOT NULL DEFAULT 0,
+              cache_write_tokens INTEGER NOT NULL DEFAULT 0,
+              cost_usd REAL NOT NULL DEFAULT 0)''',
+    """CREATE INDEX IF NOT EXISTS idx_ai_usage_created
+       ON ai_usage(created_at)""",
+    """CREATE INDEX IF NOT EXISTS idx_ai_usage_user_created
+       ON ai_usage(user_id, created_at)""",
+    '''CREATE VIEW IF NOT EXISTS ai_usage_daily AS
+       SELECT date(created_at, 'unixepoch') AS day, model, kind,
+              COUNT(*) AS calls,
+              SUM(status != 'completed') AS errors,
+              AVG(ttft_s) AS avg_ttft_s,
+              AVG(duration_s) AS avg_duration_s,
+              SUM(input_tokens) AS input_tokens,
+              SUM(output_tokens) AS output_tokens,
+              SUM(cache_read_tokens) AS cache_read_tokens,
+              SUM(cache_write_tokens) AS cache_write_tokens,
+              SUM(cost_usd) AS cost_usd
+       FROM ai_usage
+       GROUP BY day, model, kind''',
+]
+
+# Chat history per farmer. Exchanges are written as a user/assistant pair in
+# one transaction; the summary row holds the running summary of every
+# message up to through_id, so only the tail after it is ever reloaded.
+CHAT_MESSAGES = [
+    '''CREATE TABLE IF NOT EXISTS chat_messages
+             (id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER NOT NULL,
+              role TEXT NOT NULL CHECK (role IN ('user', 'assistant')),
+              content TEXT NOT NULL,
+              created_at REAL NOT NULL,
+              FOREIGN KEY(user_id) REFERENCES users(id))''',
+    """CREATE INDEX IF NOT EXISTS idx_chat_messages_user
+       ON chat_messages(user_id, id)""",
+    '''CREATE TABLE IF NOT EXISTS chat_summaries
+             (user_id INTEGER PRIMARY KEY,
+              summary TEXT NOT NULL,
+              through_id INTEGER NOT NULL,
+              FOREIGN KEY(user_id) REFERENCES users(id))''',
+]
+
+# Per-animal least-squares sufficient statistics of the current lactation's
+# Wood curve. New milk records are folded in by id; editing or deleting a
+# record drops the animal's row so it is refit from its lactation start.
+LACTATION_FITS = [
+    '''CREATE TABLE IF NOT EXISTS lactation_fits
+             (buffalo_id INTEGER PRIMARY KEY,
+              user_id INTEGER NOT NULL,
+              lactation_start DATE NOT NULL,
+              start_source TEXT NOT NULL,
+              through_id INTEGER NOT NULL,
+              n REAL NOT NULL, sum_l REAL NOT NULL, sum_t REAL NOT NULL,
+              sum_ll REAL NOT NULL, sum_lt REAL NOT NULL, sum_tt REAL NOT NULL,
+              sum_z REAL NOT NULL, sum_zl REAL NOT NULL, sum_zt REAL NOT NULL,
+              last_day REAL NOT NULL,
+              wood_a REAL, wood_b REAL, wood_c REAL,
+              peak_day INTEGER, peak_yield REAL, yield_305 REAL,
+              fitted_at REAL NOT NULL,
+              FOREIGN KEY(buffalo_id) REFERENCES buffalo_inventory(id))''',
+    """CREATE INDEX IF NOT EXISTS idx_lactation_fits_user
+       ON lactation_fits(user_id)""",
+    # Records of an animal added after a known id, without walking its history
+    """CREATE INDEX IF NOT EXISTS idx_milk_buffalo_id
+       ON milk_production(buffalo_id, id)""",
+    """CREATE TRIGGER IF NOT EXISTS trg_lactation_fits_update AFTER UPDATE ON milk_production
+        BEGIN
+            DELETE FROM lactation_fits WHERE buffalo_id IN (OLD.buffalo_id, NEW.buffalo_id);
+        END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_lactation_fits_delete AFTER DELETE ON milk_production
+        BEGIN
+            DELETE FROM lactation_fits WHERE buffalo_id = OLD.buffalo_id;
+        END""",
+    "ANALYZE milk_production",
+]
+
+# Streaming per-animal baselines behind the milk anomaly alerts (anomalies.py).
+# Exponentially weighted mean and variance per reading, plus the deviation
+# that is currently open; editing or deleting a folded record drops the
+# baseline so it is seeded again from the latest records.
+YIELD_BASELINES = [
+    '''CREATE TABLE IF NOT EXISTS yield_baselines
+             (buffalo_id INTEGER PRIMARY KEY,
+              user_id INTEGER NOT NULL,
+              through_id INTEGER NOT NULL,
+              last_date DATE,
+              morning_yield_n REAL NOT NULL, morning_yield_mean REAL NOT NULL, morning_yield_var REAL NOT NULL,
+              evening_yield_n REAL NOT NULL, evening_yield_mean REAL NOT NULL, evening_yield_var REAL NOT NULL,
+              fat_percentage_n REAL NOT NULL, fat_percentage_mean REAL NOT NULL, fat_percentage_var REAL NOT NULL,
+              alert_date DATE,
+              alert_metric TEXT,
+              alert_value REAL,
+              alert_expected REAL,
+              alert_z REAL,
+              updated_at REAL NOT NULL,
+              FOREIGN KEY(buffalo_id) REFERENCES buffalo_inventory(id))''',
+    """CREATE INDEX IF NOT EXISTS idx_yield_baselines_user_alert
+       ON yield_baselines(user_id, alert_date)""",
+    """CREATE TRIGGER IF NOT EXISTS trg_yield_baselines_update AFTER UPDATE ON milk_production
+        BEGIN
+            DELETE FROM yield_baselines WHERE buffalo_id IN (OLD.buffalo_id, NEW.buffalo_id);
+        END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_yield_baselines_delete AFTER DELETE ON milk_production
+        BEGIN
+            DELETE FROM yield_baselines WHERE buffalo_id = OLD.buffalo_id;
+        END""",
+]
+
+# A calf without a recorded weaning date is expected to be weaned at this age
+CALF_WEANING_DAYS = 90
+
+# source table -> (event type, date, animal, detail, condition), written
+# against the row alias {r}: NEW in triggers, the table itself for the backfill
+EVENT_SOURCES = {
+    'breeding_records': ('calving', "{r}.expected_calving_date", "{r}.buffalo_id", "NULL",
+                         "{r}.pregnancy_status = 'Pregnant' AND {r}.actual_calving_date IS NULL"),
+    'vaccination_records': ('vaccination', "{r}.next_due_date", "{r}.buffalo_id", "{r}.vaccination_type", "1"),
+    'health_records': ('health_follow_up', "{r}.follow_up_date", "{r}.buffalo_id",
+                       "COALESCE({r}.disease_name, {r}.record_type)", "1"),
+    'heat_detection': ('heat', "{r}.heat_date", "{r}.buffalo_id", "{r}.heat_intensity", "1"),
+    'calf_records': ('weaning', f"COALESCE({{r}}.weaning_date, date({{r}}.date_of_birth, '+{CALF_WEANING_DAYS} days'))",
+                     "{r}.mother_buffalo_id", "'Calf ' || COALESCE({r}.tag_number, {r}.name, {r}.id)",
+                     "({r}.weaning_date IS NOT NULL OR {r}.status = 'Active')"),
+}
+
+
+def _event_rows(table, ref):
+    """SELECT producing the farm_events row of one source row (ref NEW) or of every row (ref = table)."""
+    event_type, event_date, buffalo, detail, condition = EVENT_SOURCES[table]
+    event_date, buffalo, detail, condition = (part.format(r=ref) for part in (event_date, buffalo, detail, condition))
+    source = "" if ref == 'NEW' else f" FROM {table}"
+    return f"""INSERT INTO farm_events (user_id, event_date, type, source_table, source_id, buffalo_id, detail)
+               SELECT {ref}.user_id, {event_date}, '{event_type}', '{table}', {ref}.id, {buffalo}, {detail}{source}
+               WHERE {ref}.user_id IS NOT NULL AND {event_date} IS NOT NULL AND {condition}"""
+
+
+def _event_triggers(table):
+    forget = f"DELETE FROM farm_events WHERE source_table = '{table}' AND source_id = OLD.id;"
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_events_insert AFTER INSERT ON {table}
+            BEGIN
+                {_event_rows(table, 'NEW')};
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_events_update AFTER UPDATE ON {table}
+            BEGIN
+                {forget}
+                {_event_rows(table, 'NEW')};
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{table}_events_delete AFTER DELETE ON {table}
+            BEGIN
+                {forget}
+            END""",
+    ]
+
+
+# One timeline of upcoming and past farm events, kept current on write by
+# triggers on every source table. Clustered on (user_id, event_date, type),
+# so "what is due in the next N days" is a single primary-key range scan;
+# the source index serves the triggers. Predicted heats ('heat_expected')
+# are written by farm_events.py from the heat cycle engine.
+FARM_EVENTS = [
+    '''CREATE TABLE IF NOT EXISTS farm_events
+             (user_id INTEGER NOT NULL,
+              event_date DATE NOT NULL,
+              type TEXT NOT NULL,
+              source_table TEXT NOT NULL,
+              source_id INTEGER NOT NULL,
+              buffalo_id INTEGER,
+              detail TEXT,
+              PRIMARY KEY (user_id, event_date, type, source_table, source_id)) WITHOUT ROWID''',
+    """CREATE INDEX IF NOT EXISTS idx_farm_events_source
+       ON farm_events(source_table, source_id)""",
+    *(statement for table in EVENT_SOURCES for statement in _event_triggers(table)),
+    *(_event_rows(table, table) for table in EVENT_SOURCES),
+]
+
+# Inventory pages seek on (tag, id): tags differing only in case, and animals
+# without a tag, no longer fall between pages. Supersedes the tag-only index.
+INVENTORY_KEYSET_INDEX = [
+    """CREATE INDEX IF NOT EXISTS idx_buffalo_user_tag_id_nocase
+       ON buffalo_inventory(user_id, tag_number COLLATE NOCASE, id)""",
+    "DROP INDEX IF EXISTS idx_buffalo_user_tag_nocase",
+    "ANALYZE buffalo_inventory",
+]
+
+# Fits started from a calving that a later dry gap superseded are dropped, so
+# every animal is refit under the corrected start rule (lactation.py)
+LACTATION_START_REFIT = [
+    "DELETE FROM lactation_fits",
+]
+
+MIGRATIONS = [
+    (1, "baseline schema", BASELINE_TABLES),
+    (2, "composite and covering indexes on user/date access paths", ACCESS_PATH_INDEXES),
+    (3, "materialized alerts with per-user open counts", MATERIALIZED_ALERTS),
+    (4, "daily per-farm milk rollup", MILK_DAILY_SUMMARY),
+    (5, "keyset indexes for paging milk records", MILK_KEYSET_INDEXES),
+    (6, "indexes for inventory search and animal details", INVENTORY_SEARCH_INDEXES),
+    (7, "per-user table write versions for the query cache", TABLE_VERSIONS),
+    (8, "shared cache of AI answers to quick-action questions", AI_RESPONSE_CACHE),
+    (9, "per-call AI latency, token and cost metrics", AI_USAGE_METRICS),
+    (10, "persistent per-farmer chat history", CHAT_MESSAGES),
+    (11, "incremental per-animal lactation curve fits", LACTATION_FITS),
+    (12, "streaming per-animal milk baselines for anomaly alerts", YIELD_BASELINES),
+    (13, "unified farm event timeline maintained by triggers", FARM_EVENTS),
+    (14, "composite tag/id keyset index for inventory pages", INVENTORY_KEYSET_INDEX),
+    (15, "refit lactations whose calving predates a dry gap", LACTATION_START_REFIT),
+]
@@ -0,0 +1,307 @@
+"""Milk production data access built on the milk_daily_summary rollup.
+
+The rollup is kept current by triggers on milk_production (see migration 4)
+and the reads here touch one row per farm-day instead of one row per animal
+per day. ``python milk.py`` measures herd-sheet save throughput.
+"""
+import math
+from datetime import datetime
+
+
+def rebuild_daily_summary(conn, user_id=None):
+    """Recompute the rollup from raw records, for one user or the whole database.
+
+    Triggers keep the rollup current incrementally; this is the repair path
+    for rows written with triggers bypassed and for clearing float drift.
+    Returns the number of farm-days written.
+    """
+    if user_id is None:
+        conn.execute("DELETE FROM milk_daily_summary")
+        where, params = "WHERE user_id IS NOT NULL", ()
+    else:
+        conn.execute("DELETE FROM milk_daily_summary WHERE user_id=?", (user_id,))
+        where, params = "WHERE user_id=?", (user_id,)
+
+    cur = conn.execute(f"""INSERT INTO milk_daily_summary
+                           (user_id, date, total_litres, animals_milked, record_count,
+                            fat_litres, avg_fat, revenue)
+                           SELECT user_id, date, COALESCE(SUM(total_yield), 0),
+                                  COUNT(DISTINCT buffalo_id), COUNT(*),
+                                  COALESCE(SUM(fat_percentage * total_yield), 0),
+                                  SUM(fat_percentage * total_yield) / NULLIF(SUM(total_yield), 0),
+                                  COALESCE(SUM(total_yield * price_per_liter), 0)
+                           FROM milk_production
+                           {where} AND date IS NOT NULL
+                           GROUP BY user_id, date""", params)
+    return cur.rowcount
+
+
+def dashboard_kpis(conn, user_id, today=None):
+    """All dashboard headline numbers in a single read."""
+    today = today or datetime.now().date()
+    row = conn.execute(
+        """SELECT
+               (SELECT COUNT(*) FROM buffalo_inventory WHERE user_id=:u AND status='Active'),
+               (SELECT COUNT(*) FROM buffalo_inventory
+                WHERE user_id=:u AND current_lactation>0 AND status='Active'),
+               (SELECT total_litres FROM milk_daily_summary WHERE user_id=:u AND date=:today),
+               (SELECT SUM(total_litres) / SUM(record_count) FROM milk_daily_summary
+                WHERE user_id=:u AND date >= date(:today, '-30 days')),
+               (SELECT COUNT(*) FROM calf_records WHERE user_id=:u AND status='Active')""",
+        {'u': user_id, 'today': str(today)}).fetchone()
+    return {
+        'total_buffalo': row[0],
+        'lactating': row[1],
+        'today_milk': row[2] or 0,
+        'avg_daily': row[3] or 0,
+        'active_calves': row[4],
+    }
+
+
+MILK_PAGE_SIZE = 50
+
+# sort name -> (ORDER BY direction, keyset comparison)
+MILK_SORTS = {
+    'Newest first': ('DESC', '<'),
+    'Oldest first': ('ASC', '>'),
+}
+
+
+def _milk_filters(user_id, buffalo_id, start_date, end_date):
+    clauses, params = ["mp.user_id=?"], [user_id]
+    if buffalo_id is not None:
+        clauses.append("mp.buffalo_id=?")
+        params.append(buffalo_id)
+    if start_date is not None:
+        clauses.append("mp.date >= ?")
+        params.append(str(start_date))
+    if end_date is not None:
+        clauses.append("mp.date <= ?")
+        params.append(str(end_date))
+    return clauses, params
+
+
+def milk_records_page(conn, user_id, buffalo_id=None, start_date=None, end_date=None,
+                      sort='Newest first', after=None, page_size=MILK_PAGE_SIZE):
+    """One page of milk records, keyset-paginated on (date, id).
+
+    ``after`` is the cursor returned with the previous page (None for the
+    first). Seeking past the cursor through the user/date or buffalo/date
+    index costs the same on page 1 as on page 1,000, unlike OFFSET. Returns
+    ``(rows, next_cursor)``; ``next_cursor`` is None on the last page.
+    """
+    direction, op = MILK_SORTS[sort]
+    if after is not None:
+        # The cursor already lies inside the date range; leaving the bound it
+        # supersedes out lets SQLite seek straight to it instead of skipping
+        # every row between that bound and the cursor.
+        if direction == 'DESC':
+            end_date = None
+        else:
+            start_date = None
+    clauses, params = _milk_filters(user_id, buffalo_id, start_date, end_date)
+    if after is not None:
+        clauses.append(f"(mp.date, mp.id) {op} (?, ?)")
+        params.extend(after)
+
+    rows = conn.execute(f"""SELECT mp.id, mp.date, bi.tag_number, bi.name, mp.morning_yield,
+                                   mp.evening_yield, mp.total_yield, mp.fat_percentage, mp.price_per_liter
+                            FROM milk_production mp
+                            JOIN buffalo_inventory bi ON mp.buffalo_id = bi.id
+                            WHERE {' AND '.join(clauses)}
+                            ORDER BY mp.date {direction}, mp.id {direction}
+                            LIMIT ?""", (*params, page_size + 1)).fetchall()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = (rows[-1][1], rows[-1][0])
+    return rows, next_cursor
+
+
+def milk_records_totals(conn, user_id, buffalo_id=None, start_date=None, end_date=None):
+    """Litres, fat-weighted average fat % and value over every record matching the filters."""
+    if buffalo_id is None:
+        clauses, params = _milk_filters(user_id, None, start_date, end_date)
+        sql = f"""SELECT SUM(total_litres), SUM(fat_litres) / NULLIF(SUM(total_litres), 0), SUM(revenue)
+                  FROM milk_daily_summary mp WHERE {' AND '.join(clauses)}"""
+    else:
+        clauses, params = _milk_filters(user_id, buffalo_id, start_date, end_date)
+        sql = f"""SELECT SUM(total_yield),
+                         SUM(fat_percentage * total_yield) / NULLIF(SUM(total_yield), 0),
+                         SUM(total_yield * price_per_liter)
+                  FROM milk_production mp WHERE {' AND '.join(clauses)}"""
+    litres, avg_fat, value = conn.execute(sql, params).fetchone()
+    return {'total_milk': litres or 0, 'avg_fat': avg_fat, 'total_value': value or 0}
+
+
+MAX_SESSION_YIELD = 40.0
+MAX_FAT_PERCENTAGE = 15.0
+
+
+def herd_sheet_entries(conn, user_id, date):
+    """Existing yields for one day keyed by buffalo_id: (morning, evening, fat %)."""
+    rows = conn.execute("""SELECT buffalo_id, SUM(morning_yield), SUM(evening_yield),
+                                  SUM(fat_percentage * total_yield) / NULLIF(SUM(total_yield), 0)
+                           FROM milk_production
+                           WHERE user_id=? AND date=?
+                           GROUP BY buffalo_id""", (user_id, date)).fetchall()
+    return {r[0]: (r[1] or 0.0, r[2] or 0.0, r[3]) for r in rows}
+
+
+def _number(value):
+    # data_editor hands back NaN for cleared cells
+    if value is None or value != value:
+        return None
+    return float(value)
+
+
+def validate_herd_sheet(rows):
+    """Check herd-sheet rows before writing anything.
+
+    ``rows`` are dicts with buffalo_id, tag_number, morning_yield,
+    evening_yield and fat_percentage. Returns ``(valid_rows, errors)`` where
+    errors are ``(tag_number, message)`` pairs; animals with no yield in either
+    session are treated as not milked rather than as errors.
+    """
+    valid, errors = [], []
+    for row in rows:
+        tag = row.get('tag_number') or row['buffalo_id']
+        morning = _number(row.get('morning_yield')) or 0.0
+        evening = _number(row.get('evening_yield')) or 0.0
+        fat = _number(row.get('fat_percentage'))
+
+        problems = []
+        for label, value in (("Morning yield", morning), ("Evening yield", evening)):
+            if value < 0 or value > MAX_SESSION_YIELD:
+                problems.append(f"{label} must be between 0 and {MAX_SESSION_YIELD:.0f} L")
+        if morning + evening > 0 and (fat is None or not 0 < fat <= MAX_FAT_PERCENTAGE):
+            problems.append(f"Fat % must be between 0 and {MAX_FAT_PERCENTAGE:.0f}")
+
+        if problems:
+            errors.extend((tag, problem) for problem in problems)
+        else:
+            valid.append({'buffalo_id': int(row['buffalo_id']), 'morning_yield': morning,
+                          'evening_yield': evening, 'fat_percentage': fat})
+    return valid, errors
+
+
+def _same(stored, entered):
+    # Prefilled values come back through a float round trip and a fat-weighted average
+    if stored is None or entered is None:
+        return stored is None and entered is None
+    return math.isclose(stored, entered, abs_tol=1e-6)
+
+
+def save_herd_sheet(conn, user_id, date, rows, price_per_liter):
+    """Write one day's sheet in a single transaction, touching only the animals whose entry changed.
+
+    An animal's record for the day is updated in place, keeping its notes,
+    and extra records of the same day are folded into it. Animals with zero
+    yield have theirs deleted. Unchanged animals are not written at all:
+    every update or delete drops the animal's lactation fit and yield
+    baseline (migrations 11 and 12), forcing a refit and a reseed. Returns
+    the number of animals milked on the sheet.
+    """
+    existing = {}
+    for record in conn.execute("""SELECT id, buffalo_id, morning_yield, evening_yield, fat_percentage,
+                                         price_per_liter
+                                  FROM milk_production WHERE user_id=? AND date=? ORDER BY id""",
+                               (user_id, date)):
+        existing.setdefault(record[1], []).append(record)
+
+    inserts, updates, deletes, milked = [], [], [], 0
+    for row in rows:
+        records = existing.get(row['buffalo_id'], [])
+        morning, evening = row['morning_yield'], row['evening_yield']
+        if morning + evening <= 0:
+            deletes.extend((record[0],) for record in records)
+            continue
+        milked += 1
+        values = (morning, evening, row['fat_percentage'], price_per_liter)
+        if len(records) == 1 and all(map(_same, records[0][2:], values)):
+            continue
+        if not records:
+            inserts.append((user_id, row['buffalo_id'], date, morning, evening, morning + evening,
+                            row['fat_percentage'], price_per_liter))
+        else:
+            updates.append((morning, evening, morning + evening, row['fat_percentage'], price_per_liter,
+                            records[0][0]))
+            deletes.extend((record[0],) for record in records[1:])
+
+    conn.executemany("DELETE FROM milk_production WHERE id=?", deletes)
+    conn.executemany("""UPDATE milk_production
+                        SET morning_yield=?, evening_yield=?, total_yield=?, fat_percentage=?, price_per_liter=?
+                        WHERE id=?""", updates)
+    conn.executemany("""INSERT INTO milk_production
+                        (user_id, buffalo_id, date, morning_yield, evening_yield,
+                         total_yield, fat_percentage, price_per_liter)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", inserts)
+    return milked
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import random
+    import sqlite3
+    import tempfile
+    import time
+    from datetime import timedelta
+
+    from database import bench_database, connect
+
+    parser = argparse.ArgumentParser(description="Herd-sheet save throughput against one insert and commit per animal")
+    parser.add_argument('--animals', type=int, default=60)
+    parser.add_argument('--days', type=int, default=30, help="sheets saved per mode")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+
+    def sheet(buffalo_ids):
+        return [{'buffalo_id': buffalo_id, 'tag_number': f"B{buffalo_id:05d}",
+                 'morning_yield': round(rng.uniform(3, 7), 1), 'evening_yield': round(rng.uniform(2, 6), 1),
+                 'fat_percentage': round(rng.uniform(6, 8), 1)}
+                for buffalo_id in buffalo_ids]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        bench_database(path, args.animals, 0)
+        ids = list(range(1, args.animals + 1))
+        first = datetime.now().date()
+        rows = args.animals * args.days
+
+        # The old form: a connection, one insert and a commit for every animal
+        started = time.perf_counter()
+        for day in range(args.days):
+            for row in sheet(ids):
+                single = sqlite3.connect(path)
+                single.execute("""INSERT INTO milk_production
+                                  (user_id, buffalo_id, date, morning_yield, evening_yield, total_yield,
+                                   fat_percentage, price_per_liter)
+                                  VALUES (1, ?, ?, ?, ?, ?, ?, 60)""",
+                               (row['buffalo_id'], str(first - timedelta(days=day)), row['morning_yield'],
+                                row['evening_yield'], row['morning_yield'] + row['evening_yield'],
+                                row['fat_percentage']))
+                single.commit()
+                single.close()
+        per_animal = rows / (time.perf_counter() - started)
+
+        conn = connect(path)
+        sheets = [(str(first + timedelta(days=day + 1)), sheet(ids)) for day in range(args.days)]
+        timings = {}
+        for mode, edit in (('new day', None), ('unchanged re-save', 0), ('re-save, one animal edited', 1)):
+            if edit:
+                for _, entries in sheets:
+                    entries[0]['morning_yield'] += 0.5
+            started = time.perf_counter()
+            for day, entries in sheets:
+                valid, _ = validate_herd_sheet(entries)
+                save_herd_sheet(conn, 1, day, valid, 60)
+                conn.commit()
+            timings[mode] = rows / (time.perf_counter() - started)
+        conn.close()
+
+    print(f"{args.animals}-animal sheet, {args.days} days, WAL database")
+    print(f"  {'one connect/insert/commit per animal:':<42}{per_animal:10,.0f} rows/s")
+    for mode, rate in timings.items():
+        print(f"  {'herd sheet, ' + mode + ':':<42}{rate:10,.0f} rows/s ({rate / per_animal:.0f}x)")
@@ -0,0 +1,139 @@
+"""Write-versioned cache for per-user read queries.
+
+Streamlit reruns the whole page script on every interaction, so the same
+buffalo lists and analytics aggregates are queried again and again while
+nothing has changed. Results cached here are tagged with the write versions
+(``table_versions``, migration 7) of every table the query reads; a lookup
+re-reads those counters with one primary-key query and serves the stored
+result if none has moved.
+"""
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import pandas as pd
+
+CACHE_MAX_ENTRIES = 512
+# Larger results are returned but not kept, so a few wide reports cannot crowd out the hot lists
+CACHE_MAX_ROWS = 5000
+
+# Tables maintained by triggers on another table share that table's version
+DERIVED_TABLES = {
+    'milk_daily_summary': 'milk_production',
+    'alert_counts': 'alerts',
+}
+
+_TABLE_REF = re.compile(r'\b(?:FROM|JOIN)\s+([A-Za-z_]\w*)', re.IGNORECASE)
+
+
+def tables_read(sql):
+    """Versioned tables a query reads, from its FROM/JOIN clauses."""
+    return tuple(sorted({DERIVED_TABLES.get(t, t) for t in _TABLE_REF.findall(sql)}))
+
+
+class QueryCache:
+    """Bounded LRU of query results, validated against per-user table write versions."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_rows=CACHE_MAX_ROWS):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.bypasses = 0
+
+    def _versions(self, conn, user_id, tables):
+        marks = ', '.join('?' for _ in tables)
+        found = dict(conn.execute(f"""SELECT table_name, version FROM table_versions
+                                      WHERE user_id=? AND table_name IN ({marks})""",
+                                  (user_id, *tables)))
+        return tuple(found.get(t, 0) for t in tables)
+
+    def get(self, conn, user_id, sql, params, load):
+        """Return the cached result of ``sql`` or compute it with ``load()`` and keep it."""
+        return self.get_versioned(conn, user_id, (sql, tuple(params)), tables_read(sql), load, size=len)
+
+    def get_versioned(self, conn, user_id, name, tables, load, size=None):
+        """Return the value cached under ``name`` while none of ``tables`` has been written.
+
+        ``size(result)`` is checked against the row limit before keeping a
+        result. The key includes today's date so values relative to today
+        roll over at midnight even without a write. Inside an open write
+        transaction the value is loaded but neither served from nor kept in
+        the cache: it may read uncommitted rows under version numbers that a
+        rollback would hand to a later, different write.
+        """
+        if conn.in_transaction:
+            with self._lock:
+                self.bypasses += 1
+            return load()
+        tables = tuple(sorted(tables))
+        key = (user_id, name, datetime.now().date())
+        # Read the versions before the data: a write landing in between makes
+        # the stored result newer than its versions, never staler.
+        versions = self._versions(conn, user_id, tables)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == versions:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            if entry is not None:
+                self.invalidations += 1
+
+        result = load()
+        if size is None or size(result) <= self.max_rows:
+            with self._lock:
+                self._entries[key] = (versions, result)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'evictions': self.evictions,
+            'bypasses': self.bypasses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+_cache = QueryCache()
+
+
+def cached_rows(conn, user_id, sql, params=()):
+    """``conn.execute(sql, params).fetchall()`` served from the cache between writes."""
+    return list(_cache.get(conn, user_id, sql, params,
+                           lambda: tuple(conn.execute(sql, params).fetchall())))
+
+
+def cached_frame(conn, user_id, sql, params=()):
+    """``pd.read_sql_query`` served from the cache between writes; returns a copy the caller may modify."""
+    return _cache.get(conn, user_id, sql, params,
+                      lambda: pd.read_sql_query(sql, conn, params=params)).copy()
+
+
+def cached_value(conn, user_id, name, tables, load):
+    """Any value derived from ``tables``, rebuilt with ``load()`` only after one of them is written."""
+    return _cache.get_versioned(conn, user_id, name, tables, load)
+
+
+def cache_stats():
+    """Hit/miss counters and size of the process-wide query cache."""
+    return _cache.stats()
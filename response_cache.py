@@ -0,0 +1,65 @@
+"""Shared SQLite cache of AI answers to the quick-action questions.
+
+The quick-action buttons ask every farmer the same few questions and the
+answers only depend on the district, so one paid model call can serve a
+whole district. Entries expire after ``RESPONSE_CACHE_TTL_DAYS`` and the
+least recently used are evicted beyond ``RESPONSE_CACHE_MAX_ENTRIES``.
+"""
+import hashlib
+import re
+import time
+
+from assistant import MODEL
+
+RESPONSE_CACHE_TTL_DAYS = 30
+RESPONSE_CACHE_MAX_ENTRIES = 2000
+
+_NOT_WORD = re.compile(r'[^\w\s]')
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_question(question):
+    """Lower-case, drop punctuation and collapse whitespace."""
+    return _SPACES.sub(' ', _NOT_WORD.sub(' ', question.lower())).strip()
+
+
+def cache_key(question, district, model=MODEL):
+    parts = (normalize_question(question), normalize_question(district or ''), model)
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_cached_response(conn, question, district, model=MODEL, now=None):
+    """Return the stored answer if one is still fresh, counting a hit or a miss."""
+    now = now or time.time()
+    key = cache_key(question, district, model)
+    row = conn.execute("SELECT response, created_at FROM ai_response_cache WHERE cache_key=?",
+                       (key,)).fetchone()
+    if row is not None and now - row[1] < RESPONSE_CACHE_TTL_DAYS * 86400:
+        conn.execute("UPDATE ai_response_cache SET last_used_at=?, hits=hits+1 WHERE cache_key=?", (now, key))
+        conn.execute("UPDATE ai_cache_stats SET hits=hits+1 WHERE id=1")
+        return row[0]
+    conn.execute("UPDATE ai_cache_stats SET misses=misses+1 WHERE id=1")
+    return None
+
+
+def store_response(conn, question, district, response, model=MODEL, now=None):
+    """Keep an answer, then drop expired entries and the least recently used overflow."""
+    now = now or time.time()
+    conn.execute("""INSERT OR REPLACE INTO ai_response_cache
+                    (cache_key, question, district, model, response, created_at, last_used_at, hits)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, 0)""",
+                 (cache_key(question, district, model), question, district, model, response, now, now))
+    conn.execute("DELETE FROM ai_response_cache WHERE created_at < ?",
+                 (now - RESPONSE_CACHE_TTL_DAYS * 86400,))
+    conn.execute("""DELETE FROM ai_response_cache WHERE cache_key IN
+                    (SELECT cache_key FROM ai_response_cache
+                     ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)""",
+                 (RESPONSE_CACHE_MAX_ENTRIES,))
+
+
+def response_cache_stats(conn):
+    hits, misses = conn.execute("SELECT hits, misses FROM ai_cache_stats WHERE id=1").fetchone()
+    entries = conn.execute("SELECT COUNT(*) FROM ai_response_cache").fetchone()[0]
+    lookups = hits + misses
+    return {'entries': entries, 'hits': hits, 'misses': misses,
+            'hit_rate': hits / lookups if lookups else 0.0}
@@ -6,7 +6,29 @@ from datetime import datetime, timedelta
 import sqlite3
 import hashlib
 import json
-from io import BytesIO
+import time
+
+from ai_dispatcher import POLL_INTERVAL_S, AIDispatcher, DispatcherBusy
+from ai_metrics import record_ai_call, record_job
+from ai_tools import TOOLS, ToolRunner
+from alerts import open_alert_count, open_alerts, sweep_alerts
+from assistant import MODEL, build_conversation, build_system_prompt, question_turn
+from chat_history import (CHAT_MAX_LOADED, CHAT_PAGE_SIZE, clear_history, load_conversation, recent_messages,
+                          save_exchange, summary_record)
+from database import SCHEMA_VERSION, get_connection, migrate, notify_write
+from exports import EXPORT_FORMATS, REPORT_PREVIEW_ROWS, available_formats, export_file
+from farm_events import EVENT_TYPES, upcoming_events
+from forecast import DRY_PERIOD_DAYS, HORIZONS, PRICE_WINDOW_DAYS, herd_forecast
+from heat_cycles import CYCLE_DAYS, herd_heats
+from herd_snapshot import herd_snapshot
+from importer import IMPORT_SPECS, import_records
+from inventory import buffalo_detail, inventory_page
+from knowledge import KnowledgeIndex, knowledge_documents
+from lactation import herd_lactation, lactation_curve_points
+from milk import (MAX_FAT_PERCENTAGE, MAX_SESSION_YIELD, MILK_SORTS, dashboard_kpis, herd_sheet_entries,
+                  milk_records_page, milk_records_totals, save_herd_sheet, validate_herd_sheet)
+from querycache import cached_frame, cached_rows
+from response_cache import get_cached_response, store_response
 
 # Page configuration
 st.set_page_config(
@@ -42,6 +64,12 @@ def get_anthropic_client():
         st.error(f"Error initializing AI: {str(e)}")
         return None
 
+@st.cache_resource
+def get_ai_dispatcher():
+    """One pool of AI workers per server process, shared by every session."""
+    client = get_anthropic_client()
+    return AIDispatcher(client, on_finish=record_job) if client else None
+
 # Enhanced Custom CSS
 st.markdown("""
     <style>
@@ -390,214 +418,36 @@ VACCINATION_SCHEDULE = {
     "Deworming": {"frequency_months": 4, "name": "Deworming", "critical": True}
 }
 
-# Database initialization
-def init_database():
-    conn = sqlite3.connect('buffalomitra.db', check_same_thread=False)
-    c = conn.cursor()
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  username TEXT UNIQUE NOT NULL,
-                  password_hash TEXT NOT NULL,
-                  full_name TEXT NOT NULL,
-                  mobile TEXT NOT NULL,
-                  email TEXT,
-                  district TEXT,
-                  village TEXT,
-                  user_type TEXT DEFAULT 'Dairy Farmer',
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS buffalo_inventory
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  tag_number TEXT UNIQUE,
-                  name TEXT,
-                  breed TEXT,
-                  date_of_birth DATE,
-                  purchase_date DATE,
-                  purchase_price REAL,
-                  current_lactation INTEGER DEFAULT 0,
-                  status TEXT DEFAULT 'Active',
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY(user_id) REFERENCES users(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS milk_production
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  buffalo_id INTEGER,
-                  date DATE,
-                  morning_yield REAL,
-                  evening_yield REAL,
-                  total_yield REAL,
-                  fat_percentage REAL,
-                  price_per_liter REAL,
-                  notes TEXT,
-                  FOREIGN KEY(user_id) REFERENCES users(id),
-                  FOREIGN KEY(buffalo_id) REFERENCES buffalo_inventory(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS breeding_records
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  buffalo_id INTEGER,
-                  breeding_date DATE,
-                  breeding_type TEXT,
-                  bull_details TEXT,
-                  expected_calving_date DATE,
-                  actual_calving_date DATE,
-                  calf_gender TEXT,
-                  pregnancy_status TEXT DEFAULT 'Bred',
-                  notes TEXT,
-                  FOREIGN KEY(user_id) REFERENCES users(id),
-                  FOREIGN KEY(buffalo_id) REFERENCES buffalo_inventory(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS health_records
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  buffalo_id INTEGER,
-                  date DATE,
-                  record_type TEXT,
-                  disease_name TEXT,
-                  symptoms TEXT,
-                  treatment TEXT,
-                  medicine TEXT,
-                  veterinarian TEXT,
-                  cost REAL,
-                  follow_up_date DATE,
-                  notes TEXT,
-                  FOREIGN KEY(user_id) REFERENCES users(id),
-                  FOREIGN KEY(buffalo_id) REFERENCES buffalo_inventory(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS feed_management
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  date DATE,
-                  feed_type TEXT,
-                  quantity_kg REAL,
-                  cost_per_kg REAL,
-                  total_cost REAL,
-                  supplier TEXT,
-                  notes TEXT,
-                  FOREIGN KEY(user_id) REFERENCES users(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS financial_records
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  date DATE,
-                  category TEXT,
-                  transaction_type TEXT,
-                  amount REAL,
-                  description TEXT,
-                  FOREIGN KEY(user_id) REFERENCES users(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS milk_buyers
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  buyer_name TEXT,
-                  contact TEXT,
-                  price_per_liter REAL,
-                  payment_terms TEXT,
-                  active BOOLEAN DEFAULT 1,
-                  FOREIGN KEY(user_id) REFERENCES users(id))''')
-    
-    # NEW TABLES
-    c.execute('''CREATE TABLE IF NOT EXISTS calf_records
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  mother_buffalo_id INTEGER,
-                  tag_number TEXT UNIQUE,
-                  name TEXT,
-                  date_of_birth DATE,
-                  gender TEXT,
-                  birth_weight REAL,
-                  breed TEXT,
-                  status TEXT DEFAULT 'Active',
-                  weaning_date DATE,
-                  sale_date DATE,
-                  sale_price REAL,
-                  notes TEXT,
-                  FOREIGN KEY(user_id) REFERENCES users(id),
-                  FOREIGN KEY(mother_buffalo_id) REFERENCES buffalo_inventory(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS heat_detection
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  buffalo_id INTEGER,
-                  heat_date DATE,
-                  heat_intensity TEXT,
-                  bred BOOLEAN DEFAULT 0,
-                  breeding_id INTEGER,
-                  notes TEXT,
-                  FOREIGN KEY(user_id) REFERENCES users(id),
-                  FOREIGN KEY(buffalo_id) REFERENCES buffalo_inventory(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS vaccination_records
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  buffalo_id INTEGER,
-                  vaccination_type TEXT,
-                  date DATE,
-                  next_due_date DATE,
-                  veterinarian TEXT,
-                  cost REAL,
-                  batch_number TEXT,
-                  notes TEXT,
-                  FOREIGN KEY(user_id) REFERENCES users(id),
-                  FOREIGN KEY(buffalo_id) REFERENCES buffalo_inventory(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS feed_inventory
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  feed_name TEXT,
-                  feed_type TEXT,
-                  current_stock_kg REAL,
-                  reorder_level_kg REAL,
-                  last_purchase_date DATE,
-                  last_purchase_quantity REAL,
-                  last_purchase_cost REAL,
-                  supplier TEXT,
-                  FOREIGN KEY(user_id) REFERENCES users(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS alerts
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  alert_type TEXT,
-                  buffalo_id INTEGER,
-                  alert_date DATE,
-                  message TEXT,
-                  priority TEXT,
-                  resolved BOOLEAN DEFAULT 0,
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                  FOREIGN KEY(user_id) REFERENCES users(id))''')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS labor_records
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  worker_name TEXT,
-                  contact TEXT,
-                  role TEXT,
-                  monthly_salary REAL,
-                  join_date DATE,
-                  active BOOLEAN DEFAULT 1,
-                  FOREIGN KEY(user_id) REFERENCES users(id))''')
-    
-    conn.commit()
-    conn.close()
+# Reference-data retrieval index - built once per process
+@st.cache_resource
+def get_knowledge_index():
+    return KnowledgeIndex(knowledge_documents("Breed", BUFFALO_BREEDS)
+                          + knowledge_documents("Disease", DISEASE_DATABASE)
+                          + knowledge_documents("Feed", FEED_DATABASE)
+                          + knowledge_documents("Government scheme", GOVERNMENT_SCHEMES))
+
+# Database initialization - runs once per process and schema version, so
+# reruns never touch the schema or take a write lock
+@st.cache_resource
+def init_database(schema_version):
+    with get_connection() as conn:
+        migrate(conn)
+    return schema_version
 
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 def create_user(username, password, full_name, mobile, email, district, village, user_type='Dairy Farmer'):
     try:
-        conn = sqlite3.connect('buffalomitra.db')
-        c = conn.cursor()
-        password_hash = hash_password(password)
-        c.execute('''INSERT INTO users (username, password_hash, full_name, mobile, email, 
-                     district, village, user_type)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                  (username, password_hash, full_name, mobile, email, district, village, user_type))
-        conn.commit()
-        user_id = c.lastrowid
-        conn.close()
+        with get_connection() as conn:
+            c = conn.cursor()
+            password_hash = hash_password(password)
+            c.execute('''INSERT INTO users (username, password_hash, full_name, mobile, email, 
+                         district, village, user_type)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                      (username, password_hash, full_name, mobile, email, district, village, user_type))
+            conn.commit()
+            user_id = c.lastrowid
         return True, user_id
     except sqlite3.IntegrityError:
         return False, "Username already exists"
@@ -605,14 +455,13 @@ def create_user(username, password, full_name, mobile, email, district, village,
         return False, str(e)
 
 def authenticate_user(username, password):
-    conn = sqlite3.connect('buffalomitra.db')
-    c = conn.cursor()
-    password_hash = hash_password(password)
-    c.execute('''SELECT id, username, full_name, mobile, email, district, village, user_type
-                 FROM users WHERE username=? AND password_hash=?''',
-              (username, password_hash))
-    user = c.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        c = conn.cursor()
+        password_hash = hash_password(password)
+        c.execute('''SELECT id, username, full_name, mobile, email, district, village, user_type
+                     FROM users WHERE username=? AND password_hash=?''',
+                  (username, password_hash))
+        user = c.fetchone()
     if user:
         return {
             'id': user[0], 'username': user[1], 'full_name': user[2],
@@ -621,118 +470,118 @@ def authenticate_user(username, password):
         }
     return None
 
-def get_ai_response(user_message, context=""):
-    client = get_anthropic_client()
-    if not client:
-        return "AI Assistant is not configured. Please add ANTHROPIC_API_KEY to secrets."
-    
-    try:
-        user_data = st.session_state.get('user_data', {})
-        location = f"{user_data.get('village', 'Unknown')}, {user_data.get('district', 'India')}"
-        
-        system_prompt = f"""You are BuffaloMitra AI, an expert buffalo dairy farming advisor.
+def _record_ai_exchange(question, answer, summary=None):
+    with get_connection() as conn:
+        save_exchange(conn, st.session_state.user_data['id'], question, answer, summary)
 
-Current farmer context:
-- Location: {location}
+def ask_ai(question, context="", shared=False):
+    """Queue a question with the AI dispatcher; follow_ai_job shows the answer as it arrives.
 
-You provide:
-1. Buffalo breed selection and management advice
-2. Feeding and nutrition recommendations
-3. Breeding and reproduction guidance
-4. Disease prevention and treatment advice
-5. Milk production optimization
-6. Financial and business advice for dairy farming
-7. Government schemes and subsidies information
+    ``shared`` answers depend only on the farmer's district and go through the
+    response cache, so a district's farmers share one model call.
+    """
+    user = st.session_state.user_data
+    district = user.get('district')
+    if shared:
+        started = time.perf_counter()
+        with get_connection() as conn:
+            answer = get_cached_response(conn, question, district)
+            if answer is not None:
+                elapsed = time.perf_counter() - started
+                record_ai_call(conn, user['id'], district, 'response_cache', MODEL, 'completed',
+                               ttft_s=elapsed, duration_s=elapsed)
+        if answer is not None:
+            _record_ai_exchange(question, answer)
+            st.rerun()
+            return
+    
+    dispatcher = get_ai_dispatcher()
+    if dispatcher is None:
+        _record_ai_exchange(question, "AI Assistant is not configured. Please add ANTHROPIC_API_KEY to secrets.")
+        st.rerun()
+        return
+    
+    # Only the few reference entries that match the question are sent along
+    reference = get_knowledge_index().reference_notes(question)
+    if shared:
+        system_prompt = build_system_prompt({'district': district}, context)
+        messages, summary = [question_turn(question, reference)], None
+        tools, run_tool = None, None
+    else:
+        with get_connection() as conn:
+            tail, summary_state = load_conversation(conn, user['id'])
+        messages, summary_state = build_conversation(tail, question, summary_state, reference=reference)
+        summary = summary_record(tail, summary_state)
+        system_prompt = build_system_prompt(user, context, summary['text'])
+        tools, run_tool = TOOLS, ToolRunner(user['id'])
+    try:
+        job = dispatcher.submit(user['id'], system_prompt, messages, tools=tools, run_tool=run_tool, shared=shared,
+                                labels={'district': district, 'kind': 'shared' if shared else 'chat'})
+    except DispatcherBusy:
+        st.warning("The assistant is still busy with your earlier questions. Please try again in a moment.")
+        return
+    st.session_state.ai_job = {'id': job.id, 'question': question, 'shared': shared,
+                               'district': district, 'summary': summary}
 
-Always be:
-- Practical and actionable
-- Specific to Indian dairy farming conditions
-- Supportive and encouraging
-- Data-driven with realistic expectations
+def follow_ai_job():
+    """Poll the pending answer into the page and save the exchange once it ends.
 
-{context}"""
-        
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=1500,
-            system=system_prompt,
-            messages=[
-                {"role": "user", "content": user_message}
-            ]
-        )
-        
-        return message.content[0].text
-    except Exception as e:
-        return f"Sorry, I encountered an error: {str(e)}"
+    The model call runs on a dispatcher worker, so leaving the page does not
+    lose it: polling resumes on the next visit. Stop cancels the request; a
+    cancelled answer is discarded rather than saved.
+    """
+    pending = st.session_state.ai_job
+    dispatcher = get_ai_dispatcher()
+    job = dispatcher.get(pending['id']) if dispatcher else None
+    if job is None or st.session_state.get('stop_ai'):
+        if job is not None:
+            dispatcher.cancel(job.id)
+        st.session_state.ai_job = None
+        return
+    
+    st.markdown(f'<div class="info-card"><strong>You:</strong> {pending["question"]}</div>', unsafe_allow_html=True)
+    placeholder = st.empty()
+    st.button("⏹ Stop", key="stop_ai")
+    while not job.wait(POLL_INTERVAL_S):
+        text = job.text or ("<em>Waiting for a free slot…</em>" if job.status == 'queued' else "")
+        placeholder.markdown(f'<div class="ai-card"><strong>BuffaloMitra AI:</strong> {text}▌</div>',
+                             unsafe_allow_html=True)
+    
+    st.session_state.ai_job = None
+    if job.status == 'cancelled':
+        return
+    summary = None
+    if job.status == 'completed':
+        answer = job.text
+        summary = pending['summary']
+        if pending['shared']:
+            with get_connection() as conn:
+                store_response(conn, pending['question'], pending['district'], answer)
+    elif job.status == 'timed_out':
+        answer = "Sorry, the answer is taking too long right now. Please try again in a few minutes."
+    else:
+        answer = f"Sorry, I encountered an error: {str(job.error)}"
+    _record_ai_exchange(pending['question'], answer, summary)
+    st.rerun()
 
 def generate_alerts(user_id):
-    """Generate alerts for upcoming events"""
-    conn = sqlite3.connect('buffalomitra.db')
-    c = conn.cursor()
-    today = datetime.now().date()
-    
-    # Check for upcoming calvings
-    c.execute("""SELECT br.id, bi.name, bi.tag_number, br.expected_calving_date
-                 FROM breeding_records br
-                 JOIN buffalo_inventory bi ON br.buffalo_id = bi.id
-                 WHERE br.user_id=? AND br.pregnancy_status='Pregnant' 
-                 AND br.expected_calving_date BETWEEN ? AND ?""",
-              (user_id, today, today + timedelta(days=30)))
-    calvings = c.fetchall()
-    
-    # Check for vaccination due
-    c.execute("""SELECT vr.id, bi.name, bi.tag_number, vr.vaccination_type, vr.next_due_date
-                 FROM vaccination_records vr
-                 JOIN buffalo_inventory bi ON vr.buffalo_id = bi.id
-                 WHERE vr.user_id=? AND vr.next_due_date BETWEEN ? AND ?""",
-              (user_id, today, today + timedelta(days=15)))
-    vaccinations = c.fetchall()
-    
-    # Check for low feed stock
-    c.execute("""SELECT feed_name, current_stock_kg, reorder_level_kg
-                 FROM feed_inventory
-                 WHERE user_id=? AND current_stock_kg <= reorder_level_kg""",
-              (user_id,))
-    low_stock = c.fetchall()
-    
-    conn.close()
-    
-    alerts = []
-    for calving in calvings:
-        days_until = (calving[3] - today).days
-        alerts.append({
-            'type': 'calving',
-            'priority': 'high' if days_until <= 7 else 'medium',
-            'message': f"{calving[1]} ({calving[2]}) - Expected calving in {days_until} days"
-        })
-    
-    for vacc in vaccinations:
-        days_until = (vacc[4] - today).days
-        alerts.append({
-            'type': 'vaccination',
-            'priority': 'high' if days_until <= 3 else 'medium',
-            'message': f"{vacc[1]} ({vacc[2]}) - {vacc[3]} due in {days_until} days"
-        })
-    
-    for stock in low_stock:
-        alerts.append({
-            'type': 'feed',
-            'priority': 'high',
-            'message': f"Low stock: {stock[0]} - Only {stock[1]:.1f} kg remaining"
-        })
-    
-    return alerts
+    """Open alerts for upcoming events, read from the materialized alerts table"""
+    with get_connection() as conn:
+        sweep_alerts(conn, user_id)
+        return open_alerts(conn, user_id)
 
 # Session state initialization
 if 'user_data' not in st.session_state:
     st.session_state.user_data = None
 if 'current_page' not in st.session_state:
     st.session_state.current_page = "Dashboard"
-if 'chat_history' not in st.session_state:
-    st.session_state.chat_history = []
+if 'chat_limit' not in st.session_state:
+    st.session_state.chat_limit = CHAT_PAGE_SIZE
+if 'ai_job' not in st.session_state:
+    st.session_state.ai_job = None
 
 def main():
-    init_database()
+    init_database(SCHEMA_VERSION)
     st.markdown('<div class="main-header">🐃 BuffaloMitra - AI Powered Dairy Management</div>', unsafe_allow_html=True)
     st.markdown("### संपूर्ण म्हैस व्यवस्थापन प्रणाली | Complete Buffalo Dairy Management System")
     
@@ -804,9 +653,11 @@ def show_main_app():
         st.markdown("---")
         
         # Show alerts count
-        alerts = generate_alerts(user['id'])
-        if alerts:
-            st.markdown(f"### ⚠️ Alerts ({len(alerts)})")
+        with get_connection() as conn:
+            sweep_alerts(conn, user['id'])
+            alert_count = open_alert_count(conn, user['id'])
+        if alert_count:
+            st.markdown(f"### ⚠️ Alerts ({alert_count})")
         
         pages = [
             "Dashboard",
@@ -832,7 +683,8 @@ def show_main_app():
             "Feed Inventory",
             "Labor Management",
             "Advanced Analytics",
-            "Reports Generator"
+            "Reports Generator",
+            "Data Import"
         ]
         
         st.markdown("### Navigation")
@@ -846,6 +698,8 @@ def show_main_app():
         if st.button("Logout", use_container_width=True):
             st.session_state.user_data = None
             st.session_state.current_page = "Dashboard"
+            st.session_state.ai_job = None
+            st.session_state.chat_limit = CHAT_PAGE_SIZE
             st.rerun()
     
     # Page routing
@@ -897,6 +751,8 @@ def show_main_app():
         show_advanced_analytics()
     elif page == "Reports Generator":
         show_reports_generator()
+    elif page == "Data Import":
+        show_data_import()
 
 def show_dashboard():
     user = st.session_state.user_data
@@ -912,27 +768,13 @@ def show_dashboard():
             st.markdown(f'<div class="alert-card">{alert["message"]}</div>', unsafe_allow_html=True)
     
     # Get statistics
-    conn = sqlite3.connect('buffalomitra.db')
-    c = conn.cursor()
-    
-    c.execute("SELECT COUNT(*) FROM buffalo_inventory WHERE user_id=? AND status='Active'", (user['id'],))
-    total_buffalo = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM buffalo_inventory WHERE user_id=? AND current_lactation>0 AND status='Active'", (user['id'],))
-    lactating = c.fetchone()[0]
-    
-    c.execute("""SELECT SUM(total_yield) FROM milk_production 
-                 WHERE user_id=? AND date=?""", (user['id'], datetime.now().date()))
-    today_milk = c.fetchone()[0] or 0
-    
-    c.execute("""SELECT AVG(total_yield) FROM milk_production 
-                 WHERE user_id=? AND date >= date('now', '-30 days')""", (user['id'],))
-    avg_daily = c.fetchone()[0] or 0
-    
-    c.execute("SELECT COUNT(*) FROM calf_records WHERE user_id=? AND status='Active'", (user['id'],))
-    active_calves = c.fetchone()[0]
-    
-    conn.close()
+    with get_connection() as conn:
+        kpis = dashboard_kpis(conn, user['id'])
+    total_buffalo = kpis['total_buffalo']
+    lactating = kpis['lactating']
+    today_milk = kpis['today_milk']
+    avg_daily = kpis['avg_daily']
+    active_calves = kpis['active_calves']
     
     col1, col2, col3, col4, col5 = st.columns(5)
     with col1:
@@ -972,14 +814,13 @@ def show_dashboard():
     
     # Recent milk production chart
     st.markdown("### Milk Production Trend (Last 30 Days)")
-    conn = sqlite3.connect('buffalomitra.db')
-    df = pd.read_sql_query(
-        """SELECT date, SUM(total_yield) as total 
-           FROM milk_production 
-           WHERE user_id=? AND date >= date('now', '-30 days')
-           GROUP BY date ORDER BY date""",
-        conn, params=(user['id'],))
-    conn.close()
+    with get_connection() as conn:
+        df = cached_frame(conn, user['id'],
+            """SELECT date, total_litres as total 
+               FROM milk_daily_summary 
+               WHERE user_id=? AND date >= date('now', '-30 days')
+               ORDER BY date""",
+            (user['id'],))
     
     if not df.empty:
         fig = px.line(df, x='date', y='total', title='Daily Milk Production',
@@ -992,7 +833,15 @@ def show_ai_assistant():
     st.markdown("### AI Dairy Assistant")
     st.markdown("Ask me anything about buffalo dairy farming!")
     
-    for message in st.session_state.chat_history:
+    # Only the latest messages are read; older ones are paged in on request
+    with get_connection() as conn:
+        history, has_more = recent_messages(conn, st.session_state.user_data['id'], st.session_state.chat_limit)
+    if has_more and st.session_state.chat_limit < CHAT_MAX_LOADED:
+        if st.button("Show earlier messages", key="chat_earlier"):
+            st.session_state.chat_limit = min(st.session_state.chat_limit + CHAT_PAGE_SIZE, CHAT_MAX_LOADED)
+            st.rerun()
+    
+    for message in history:
         if message["role"] == "user":
             st.markdown(f'<div class="info-card"><strong>You:</strong> {message["content"]}</div>', 
                        unsafe_allow_html=True)
@@ -1001,46 +850,43 @@ def show_ai_assistant():
                        unsafe_allow_html=True)
     
     st.markdown("### Quick Questions")
+    # Quick questions are the same for every farmer in a district, so their answers are shared
+    pending_question, shared = None, False
+    busy = st.session_state.ai_job is not None
     col1, col2, col3 = st.columns(3)
     with col1:
-        if st.button("Best buffalo breed for my area", use_container_width=True):
-            question = f"What is the best buffalo breed for {st.session_state.user_data['district']}?"
-            with st.spinner("Thinking..."):
-                response = get_ai_response(question)
-                st.session_state.chat_history.append({"role": "user", "content": question})
-                st.session_state.chat_history.append({"role": "assistant", "content": response})
-                st.rerun()
+        if st.button("Best buffalo breed for my area", use_container_width=True, disabled=busy):
+            pending_question, shared = f"What is the best buffalo breed for {st.session_state.user_data['district']}?", True
     with col2:
-        if st.button("How to increase milk yield", use_container_width=True):
-            question = "What are the best practices to increase milk yield in buffaloes?"
-            with st.spinner("Analyzing..."):
-                response = get_ai_response(question)
-                st.session_state.chat_history.append({"role": "user", "content": question})
-                st.session_state.chat_history.append({"role": "assistant", "content": response})
-                st.rerun()
+        if st.button("How to increase milk yield", use_container_width=True, disabled=busy):
+            pending_question, shared = "What are the best practices to increase milk yield in buffaloes?", True
     with col3:
-        if st.button("Disease prevention tips", use_container_width=True):
-            question = "What are essential disease prevention practices for buffalo dairy farming?"
-            with st.spinner("Searching..."):
-                response = get_ai_response(question)
-                st.session_state.chat_history.append({"role": "user", "content": question})
-                st.session_state.chat_history.append({"role": "assistant", "content": response})
-                st.rerun()
+        if st.button("Disease prevention tips", use_container_width=True, disabled=busy):
+            pending_question, shared = "What are essential disease prevention practices for buffalo dairy farming?", True
     
     with st.form("chat_form", clear_on_submit=True):
         user_input = st.text_area("Your question:", placeholder="E.g., How much concentrate feed should I give?", height=100)
-        submitted = st.form_submit_button("Send", use_container_width=True, type="primary")
+        submitted = st.form_submit_button("Send", use_container_width=True, type="primary", disabled=busy)
         
         if submitted and user_input:
-            with st.spinner("Getting answer..."):
-                response = get_ai_response(user_input)
-                st.session_state.chat_history.append({"role": "user", "content": user_input})
-                st.session_state.chat_history.append({"role": "assistant", "content": response})
-                st.rerun()
-    
-    if st.session_state.chat_history:
+            pending_question = user_input
+    
+    # Answered outside the form, which cannot contain the Stop button
+    if pending_question and not busy:
+        context = ""
+        if not shared:
+            # Ground personal questions in the farmer's own records
+            with get_connection() as conn:
+                context = herd_snapshot(conn, st.session_state.user_data['id'])
+        ask_ai(pending_question, context, shared=shared)
+    if st.session_state.ai_job is not None:
+        follow_ai_job()
+    
+    if history:
         if st.button("Clear Chat History"):
-            st.session_state.chat_history = []
+            with get_connection() as conn:
+                clear_history(conn, st.session_state.user_data['id'])
+            st.session_state.chat_limit = CHAT_PAGE_SIZE
             st.rerun()
 
 def show_buffalo_inventory():
@@ -1050,26 +896,75 @@ def show_buffalo_inventory():
     tab1, tab2 = st.tabs(["My Buffaloes", "Add New Buffalo"])
     
     with tab1:
-        conn = sqlite3.connect('buffalomitra.db')
-        c = conn.cursor()
-        c.execute("""SELECT id, tag_number, name, breed, date_of_birth, current_lactation, status 
-                     FROM buffalo_inventory WHERE user_id=? ORDER BY tag_number""", (user['id'],))
-        buffaloes = c.fetchall()
-        conn.close()
+        search = st.text_input("Search by tag or name", placeholder="Start typing a tag number or name",
+                               key="inventory_search")
         
-        if buffaloes:
-            for buf in buffaloes:
-                age = (datetime.now().date() - datetime.strptime(str(buf[4]), '%Y-%m-%d').date()).days // 365
-                with st.expander(f"🐃 {buf[2]} (Tag: {buf[1]}) - {buf[3]}"):
+        # Cursor stack for Previous/Next; a new search starts again at page 1
+        browser = st.session_state.get('inventory_browser')
+        if browser is None or browser['search'] != search:
+            browser = st.session_state['inventory_browser'] = {'search': search, 'cursors': [None]}
+        
+        with get_connection() as conn:
+            herd, next_cursor = inventory_page(conn, user['id'], search, after=browser['cursors'][-1])
+        
+        if not herd.empty:
+            st.dataframe(
+                herd[['tag_number', 'name', 'breed', 'age_years', 'current_lactation',
+                      'days_in_milk', 'last_yield', 'last_milked', 'status']],
+                column_config={
+                    'tag_number': "Tag", 'name': "Name", 'breed': "Breed", 'age_years': "Age (years)",
+                    'current_lactation': "Lactation", 'days_in_milk': "Days in Milk",
+                    'last_yield': st.column_config.NumberColumn("Last Yield (L)", format="%.1f"),
+                    'last_milked': "Last Milked", 'status': "Status",
+                },
+                hide_index=True, use_container_width=True)
+            
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col1:
+                if st.button("← Previous", disabled=len(browser['cursors']) == 1,
+                             use_container_width=True, key="inventory_prev"):
+                    browser['cursors'].pop()
+                    st.rerun()
+            with col2:
+                st.caption(f"Page {len(browser['cursors'])}")
+            with col3:
+                if st.button("Next →", disabled=next_cursor is None,
+                             use_container_width=True, key="inventory_next"):
+                    browser['cursors'].append(next_cursor)
+                    st.rerun()
+            
+            animal_options = {"—": None}
+            animal_options.update({f"{r.tag_number} - {r.name}": r.id for r in herd.itertuples()})
+            selected = animal_options[st.selectbox("Show details for", list(animal_options.keys()))]
+            
+            if selected is not None:
+                with get_connection() as conn:
+                    detail = buffalo_detail(conn, user['id'], selected)
+                if detail is not None:
+                    animal = detail['animal']
+                    st.markdown(f"#### 🐃 {animal['name']} (Tag: {animal['tag_number']}) - {animal['breed']}")
                     col1, col2, col3 = st.columns(3)
                     with col1:
-                        st.write(f"**Age:** {age} years")
-                        st.write(f"**Breed:** {buf[3]}")
+                        st.write(f"**DOB:** {animal['date_of_birth']}")
+                        st.write(f"**Breed:** {animal['breed']}")
                     with col2:
-                        st.write(f"**Lactation:** {buf[5]}")
-                        st.write(f"**Status:** {buf[6]}")
+                        st.write(f"**Lactation:** {animal['current_lactation']}")
+                        st.write(f"**Status:** {animal['status']}")
                     with col3:
-                        st.write(f"**DOB:** {buf[4]}")
+                        st.write(f"**Purchased:** {animal['purchase_date']}")
+                        st.write(f"**Price:** ₹{animal['purchase_price'] or 0:,.0f}")
+                    
+                    if not detail['milk'].empty:
+                        st.markdown("**Recent Milk**")
+                        st.dataframe(detail['milk'], hide_index=True, use_container_width=True)
+                    if not detail['breeding'].empty:
+                        st.markdown("**Breeding History**")
+                        st.dataframe(detail['breeding'], hide_index=True, use_container_width=True)
+                    if not detail['health'].empty:
+                        st.markdown("**Health History**")
+                        st.dataframe(detail['health'], hide_index=True, use_container_width=True)
+        elif search:
+            st.info(f"No buffalo with a tag or name starting with '{search}'")
         else:
             st.info("No buffaloes added yet. Add your first buffalo below!")
     
@@ -1090,36 +985,32 @@ def show_buffalo_inventory():
             submitted = st.form_submit_button("Add Buffalo", use_container_width=True, type="primary")
             
             if submitted and tag_number and breed:
-                conn = sqlite3.connect('buffalomitra.db')
-                c = conn.cursor()
-                try:
-                    c.execute("""INSERT INTO buffalo_inventory 
-                                (user_id, tag_number, name, breed, date_of_birth, 
-                                 purchase_date, purchase_price, current_lactation, status)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'Active')""",
-                             (user['id'], tag_number, name, breed, dob, 
-                              purchase_date, purchase_price, current_lactation))
-                    conn.commit()
-                    st.success(f"Buffalo {name or tag_number} added successfully!")
-                    st.rerun()
-                except sqlite3.IntegrityError:
-                    st.error("Tag number already exists!")
-                finally:
-                    conn.close()
+                with get_connection() as conn:
+                    c = conn.cursor()
+                    try:
+                        c.execute("""INSERT INTO buffalo_inventory 
+                                    (user_id, tag_number, name, breed, date_of_birth, 
+                                     purchase_date, purchase_price, current_lactation, status)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'Active')""",
+                                 (user['id'], tag_number, name, breed, dob, 
+                                  purchase_date, purchase_price, current_lactation))
+                        conn.commit()
+                        st.success(f"Buffalo {name or tag_number} added successfully!")
+                        st.rerun()
+                    except sqlite3.IntegrityError:
+                        st.error("Tag number already exists!")
 
 def show_milk_production():
     st.markdown("### Milk Production Tracker")
     user = st.session_state.user_data
     
-    tab1, tab2, tab3 = st.tabs(["Record Production", "View Records", "Analysis"])
+    tab1, tab2, tab3, tab4 = st.tabs(["Record Production", "Herd Sheet", "View Records", "Analysis"])
     
     with tab1:
-        conn = sqlite3.connect('buffalomitra.db')
-        c = conn.cursor()
-        c.execute("""SELECT id, tag_number, name, breed FROM buffalo_inventory 
-                     WHERE user_id=? AND current_lactation>0 AND status='Active'""", (user['id'],))
-        buffaloes = c.fetchall()
-        conn.close()
+        with get_connection() as conn:
+            buffaloes = cached_rows(conn, user['id'],
+                                    """SELECT id, tag_number, name, breed FROM buffalo_inventory 
+                                       WHERE user_id=? AND current_lactation>0 AND status='Active'""", (user['id'],))
         
         if buffaloes:
             with st.form("record_milk"):
@@ -1141,61 +1032,140 @@ def show_milk_production():
                 
                 if submitted:
                     total_yield = morning_yield + evening_yield
-                    conn = sqlite3.connect('buffalomitra.db')
-                    c = conn.cursor()
-                    c.execute("""INSERT INTO milk_production 
-                                (user_id, buffalo_id, date, morning_yield, evening_yield, 
-                                 total_yield, fat_percentage, price_per_liter, notes)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                             (user['id'], buffalo_id, date, morning_yield, evening_yield,
-                              total_yield, fat_percentage, price_per_liter, notes))
-                    conn.commit()
-                    conn.close()
+                    with get_connection() as conn:
+                        c = conn.cursor()
+                        c.execute("""INSERT INTO milk_production 
+                                    (user_id, buffalo_id, date, morning_yield, evening_yield, 
+                                     total_yield, fat_percentage, price_per_liter, notes)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                 (user['id'], buffalo_id, date, morning_yield, evening_yield,
+                                  total_yield, fat_percentage, price_per_liter, notes))
+                        notify_write(conn, user['id'], 'milk_production', c.lastrowid)
+                        conn.commit()
                     st.success(f"Recorded: {total_yield:.1f} liters")
                     st.rerun()
         else:
             st.warning("No lactating buffaloes. Update buffalo lactation status in inventory.")
     
     with tab2:
-        conn = sqlite3.connect('buffalomitra.db')
-        df = pd.read_sql_query(
-            """SELECT mp.date, bi.tag_number, bi.name, mp.morning_yield, 
-               mp.evening_yield, mp.total_yield, mp.fat_percentage, mp.price_per_liter
-               FROM milk_production mp
-               JOIN buffalo_inventory bi ON mp.buffalo_id = bi.id
-               WHERE mp.user_id=? 
-               ORDER BY mp.date DESC LIMIT 100""",
-            conn, params=(user['id'],))
-        conn.close()
+        st.markdown("### Record the Whole Herd")
+        if buffaloes:
+            col1, col2 = st.columns(2)
+            with col1:
+                sheet_date = st.date_input("Date", value=datetime.now(), key="herd_sheet_date")
+            with col2:
+                sheet_price = st.number_input("Price per Liter (₹)", min_value=0, value=60, key="herd_sheet_price")
+            
+            with get_connection() as conn:
+                existing = herd_sheet_entries(conn, user['id'], sheet_date)
+            sheet = pd.DataFrame([{
+                'buffalo_id': b[0],
+                'Tag': b[1],
+                'Name': b[2],
+                'Morning (L)': existing.get(b[0], (0.0, 0.0, 7.5))[0],
+                'Evening (L)': existing.get(b[0], (0.0, 0.0, 7.5))[1],
+                'Fat %': existing.get(b[0], (0.0, 0.0, 7.5))[2],
+            } for b in buffaloes])
+            
+            with st.form("herd_sheet"):
+                edited = st.data_editor(
+                    sheet, hide_index=True, use_container_width=True,
+                    disabled=['Tag', 'Name'],
+                    column_config={
+                        'buffalo_id': None,
+                        'Morning (L)': st.column_config.NumberColumn(min_value=0.0, max_value=MAX_SESSION_YIELD, step=0.1),
+                        'Evening (L)': st.column_config.NumberColumn(min_value=0.0, max_value=MAX_SESSION_YIELD, step=0.1),
+                        'Fat %': st.column_config.NumberColumn(min_value=0.0, max_value=MAX_FAT_PERCENTAGE, step=0.1),
+                    })
+                st.caption("Leave both yields at 0 for animals not milked. Saving updates this date's record of every animal whose entry changed; notes are kept.")
+                submitted = st.form_submit_button("Save Herd Sheet", use_container_width=True, type="primary")
+            
+            if submitted:
+                rows = [{'buffalo_id': r['buffalo_id'], 'tag_number': r['Tag'],
+                         'morning_yield': r['Morning (L)'], 'evening_yield': r['Evening (L)'],
+                         'fat_percentage': r['Fat %']}
+                        for r in edited.to_dict('records')]
+                valid, errors = validate_herd_sheet(rows)
+                if errors:
+                    for tag, message in errors:
+                        st.error(f"{tag}: {message}")
+                else:
+                    with get_connection() as conn:
+                        saved = save_herd_sheet(conn, user['id'], sheet_date, valid, sheet_price)
+                        notify_write(conn, user['id'], 'milk_production')
+                        conn.commit()
+                    total = sum(r['morning_yield'] + r['evening_yield'] for r in valid)
+                    st.success(f"Recorded {saved} buffaloes: {total:.1f} liters")
+                    st.rerun()
+        else:
+            st.warning("No lactating buffaloes. Update buffalo lactation status in inventory.")
+    
+    with tab3:
+        with get_connection() as conn:
+            animals = conn.execute("""SELECT id, tag_number, name FROM buffalo_inventory
+                                      WHERE user_id=? ORDER BY tag_number""", (user['id'],)).fetchall()
         
-        if not df.empty:
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            animal_options = {"All buffaloes": None}
+            animal_options.update({f"{a[1]} - {a[2]}": a[0] for a in animals})
+            buffalo_id = animal_options[st.selectbox("Buffalo", list(animal_options.keys()), key="milk_browse_buffalo")]
+        with col2:
+            start_date = st.date_input("From", value=None, key="milk_browse_from")
+        with col3:
+            end_date = st.date_input("To", value=None, key="milk_browse_to")
+        with col4:
+            sort = st.selectbox("Sort", list(MILK_SORTS.keys()), key="milk_browse_sort")
+        
+        # Cursor stack for Previous/Next; any filter change starts again at page 1
+        filters = (buffalo_id, start_date, end_date, sort)
+        browser = st.session_state.get('milk_browser')
+        if browser is None or browser['filters'] != filters:
+            browser = st.session_state['milk_browser'] = {'filters': filters, 'cursors': [None]}
+        
+        with get_connection() as conn:
+            rows, next_cursor = milk_records_page(conn, user['id'], buffalo_id, start_date, end_date,
+                                                  sort, after=browser['cursors'][-1])
+            totals = milk_records_totals(conn, user['id'], buffalo_id, start_date, end_date)
+        
+        if rows:
+            df = pd.DataFrame([r[1:] for r in rows],
+                              columns=['date', 'tag_number', 'name', 'morning_yield', 'evening_yield',
+                                       'total_yield', 'fat_percentage', 'price_per_liter'])
             st.dataframe(df, use_container_width=True)
             
-            total_milk = df['total_yield'].sum()
-            avg_fat = df['fat_percentage'].mean()
-            total_value = (df['total_yield'] * df['price_per_liter']).sum()
+            col1, col2, col3 = st.columns([1, 2, 1])
+            with col1:
+                if st.button("← Previous", disabled=len(browser['cursors']) == 1, use_container_width=True):
+                    browser['cursors'].pop()
+                    st.rerun()
+            with col2:
+                st.caption(f"Page {len(browser['cursors'])}")
+            with col3:
+                if st.button("Next →", disabled=next_cursor is None, use_container_width=True):
+                    browser['cursors'].append(next_cursor)
+                    st.rerun()
             
             col1, col2, col3 = st.columns(3)
             with col1:
-                st.metric("Total Milk", f"{total_milk:.1f} L")
+                st.metric("Total Milk", f"{totals['total_milk']:.1f} L")
             with col2:
-                st.metric("Avg Fat %", f"{avg_fat:.2f}%")
+                st.metric("Avg Fat %", f"{totals['avg_fat'] or 0:.2f}%")
             with col3:
-                st.metric("Total Value", f"₹{total_value:,.0f}")
+                st.metric("Total Value", f"₹{totals['total_value']:,.0f}")
         else:
-            st.info("No production records yet")
+            st.info("No production records match these filters")
     
-    with tab3:
+    with tab4:
         st.markdown("### Production Analysis")
         
-        conn = sqlite3.connect('buffalomitra.db')
-        df_analysis = pd.read_sql_query(
-            """SELECT date, SUM(total_yield) as daily_total, AVG(fat_percentage) as avg_fat
-               FROM milk_production 
-               WHERE user_id=? AND date >= date('now', '-90 days')
-               GROUP BY date ORDER BY date""",
-            conn, params=(user['id'],))
-        conn.close()
+        with get_connection() as conn:
+            df_analysis = cached_frame(conn, user['id'],
+                """SELECT date, total_litres as daily_total, avg_fat
+                   FROM milk_daily_summary 
+                   WHERE user_id=? AND date >= date('now', '-90 days')
+                   ORDER BY date""",
+                (user['id'],))
         
         if not df_analysis.empty:
             fig = go.Figure()
@@ -1214,6 +1184,52 @@ def show_milk_production():
             )
             
             st.plotly_chart(fig, use_container_width=True)
+        
+        # Forward look from lactation curves, expected calvings and the farm's season
+        st.markdown("### Production Forecast")
+        with get_connection() as conn:
+            forecast = herd_forecast(conn, user['id'])
+        daily, animals = forecast['daily'], forecast['animals']
+        
+        if daily['litres'].sum() > 0:
+            cols = st.columns(2 * len(HORIZONS))
+            for i, days in enumerate(HORIZONS):
+                cols[2 * i].metric(f"Next {days} days", f"{animals[f'litres_{days}'].sum():,.0f} L")
+                if forecast['price'] is not None:
+                    cols[2 * i + 1].metric(f"Revenue, {days} days", f"₹{animals[f'revenue_{days}'].sum():,.0f}")
+            
+            fig = go.Figure()
+            if not df_analysis.empty:
+                fig.add_trace(go.Bar(x=df_analysis['date'], y=df_analysis['daily_total'],
+                                     name='Recorded', marker_color='lightblue'))
+            fig.add_trace(go.Scatter(x=daily['date'], y=daily['litres'], name='Forecast',
+                                     mode='lines', line=dict(color='green', width=2)))
+            fig.update_layout(title='Daily Herd Milk: Recorded and Forecast',
+                              xaxis=dict(title='Date'), yaxis=dict(title='Milk (Liters)'),
+                              hovermode='x unified')
+            st.plotly_chart(fig, use_container_width=True)
+            
+            with st.expander("Forecast by buffalo"):
+                st.dataframe(
+                    animals,
+                    column_config={
+                        'tag_number': "Tag", 'name': "Name", 'status': "Status",
+                        'level': st.column_config.NumberColumn("Recent vs Curve", format="%.2f"),
+                        'expected_calving': "Expected Calving",
+                        **{f'litres_{days}': st.column_config.NumberColumn(f"{days}-day Milk (L)", format="%.0f")
+                           for days in HORIZONS},
+                        **{f'revenue_{days}': st.column_config.NumberColumn(f"{days}-day Revenue (₹)", format="%.0f")
+                           for days in HORIZONS},
+                    },
+                    hide_index=True, use_container_width=True)
+            if forecast['price'] is not None:
+                st.caption(f"Revenue at ₹{forecast['price']:.2f}/L, your average price over the last "
+                           f"{PRICE_WINDOW_DAYS} days. Pregnant buffaloes are dried off {DRY_PERIOD_DAYS} days "
+                           "before their expected calving.")
+            else:
+                st.caption("Record milk prices or add a buyer to see forecast revenue.")
+        else:
+            st.info("Record daily milk for your lactating buffaloes to see a production forecast.")
 
 def show_breed_information():
     st.markdown("### Buffalo Breed Information")
@@ -1272,12 +1288,10 @@ def show_breeding_manager():
     tab1, tab2 = st.tabs(["Record Breeding", "Breeding Calendar"])
     
     with tab1:
-        conn = sqlite3.connect('buffalomitra.db')
-        c = conn.cursor()
-        c.execute("""SELECT id, tag_number, name FROM buffalo_inventory 
-                     WHERE user_id=? AND status='Active'""", (user['id'],))
-        buffaloes = c.fetchall()
-        conn.close()
+        with get_connection() as conn:
+            buffaloes = cached_rows(conn, user['id'],
+                                    """SELECT id, tag_number, name FROM buffalo_inventory 
+                                       WHERE user_id=? AND status='Active'""", (user['id'],))
         
         if buffaloes:
             with st.form("record_breeding"):
@@ -1298,32 +1312,31 @@ def show_breeding_manager():
                 submitted = st.form_submit_button("Record Breeding", use_container_width=True, type="primary")
                 
                 if submitted:
-                    conn = sqlite3.connect('buffalomitra.db')
-                    c = conn.cursor()
-                    c.execute("""INSERT INTO breeding_records 
-                                (user_id, buffalo_id, breeding_date, breeding_type, 
-                                 bull_details, expected_calving_date, pregnancy_status, notes)
-                                VALUES (?, ?, ?, ?, ?, ?, 'Bred', ?)""",
-                             (user['id'], buffalo_id, breeding_date, breeding_type,
-                              bull_details, expected_calving, notes))
-                    conn.commit()
-                    conn.close()
+                    with get_connection() as conn:
+                        c = conn.cursor()
+                        c.execute("""INSERT INTO breeding_records 
+                                    (user_id, buffalo_id, breeding_date, breeding_type, 
+                                     bull_details, expected_calving_date, pregnancy_status, notes)
+                                    VALUES (?, ?, ?, ?, ?, ?, 'Bred', ?)""",
+                                 (user['id'], buffalo_id, breeding_date, breeding_type,
+                                  bull_details, expected_calving, notes))
+                        notify_write(conn, user['id'], 'breeding_records', c.lastrowid)
+                        conn.commit()
                     st.success("Breeding recorded!")
                     st.rerun()
         else:
             st.warning("No buffaloes found in inventory!")
     
     with tab2:
-        conn = sqlite3.connect('buffalomitra.db')
-        df = pd.read_sql_query(
-            """SELECT br.breeding_date, bi.tag_number, bi.name, br.breeding_type,
-               br.expected_calving_date, br.pregnancy_status
-               FROM breeding_records br
-               JOIN buffalo_inventory bi ON br.buffalo_id = bi.id
-               WHERE br.user_id=? AND br.pregnancy_status IN ('Bred', 'Pregnant')
-               ORDER BY br.expected_calving_date""",
-            conn, params=(user['id'],))
-        conn.close()
+        with get_connection() as conn:
+            df = cached_frame(conn, user['id'],
+                """SELECT br.breeding_date, bi.tag_number, bi.name, br.breeding_type,
+                   br.expected_calving_date, br.pregnancy_status
+                   FROM breeding_records br
+                   JOIN buffalo_inventory bi ON br.buffalo_id = bi.id
+                   WHERE br.user_id=? AND br.pregnancy_status IN ('Bred', 'Pregnant')
+                   ORDER BY br.expected_calving_date""",
+                (user['id'],))
         
         if not df.empty:
             st.dataframe(df, use_container_width=True)
@@ -1335,12 +1348,10 @@ def show_health_records():
     tab1, tab2 = st.tabs(["Add Record", "View History"])
     
     with tab1:
-        conn = sqlite3.connect('buffalomitra.db')
-        c = conn.cursor()
-        c.execute("""SELECT id, tag_number, name FROM buffalo_inventory 
-                     WHERE user_id=? AND status='Active'""", (user['id'],))
-        buffaloes = c.fetchall()
-        conn.close()
+        with get_connection() as conn:
+            buffaloes = cached_rows(conn, user['id'],
+                                    """SELECT id, tag_number, name FROM buffalo_inventory 
+                                       WHERE user_id=? AND status='Active'""", (user['id'],))
         
         if buffaloes:
             with st.form("health_record"):
@@ -1363,32 +1374,30 @@ def show_health_records():
                 submitted = st.form_submit_button("Save Health Record", use_container_width=True, type="primary")
                 
                 if submitted:
-                    conn = sqlite3.connect('buffalomitra.db')
-                    c = conn.cursor()
-                    c.execute("""INSERT INTO health_records 
-                                (user_id, buffalo_id, date, record_type, disease_name, 
-                                 symptoms, treatment, medicine, veterinarian, cost)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                             (user['id'], buffalo_id, date, record_type, disease_name,
-                              symptoms, treatment, medicine, veterinarian, cost))
-                    conn.commit()
-                    conn.close()
+                    with get_connection() as conn:
+                        c = conn.cursor()
+                        c.execute("""INSERT INTO health_records 
+                                    (user_id, buffalo_id, date, record_type, disease_name, 
+                                     symptoms, treatment, medicine, veterinarian, cost)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                                 (user['id'], buffalo_id, date, record_type, disease_name,
+                                  symptoms, treatment, medicine, veterinarian, cost))
+                        conn.commit()
                     st.success("Health record saved!")
                     st.rerun()
         else:
             st.warning("No buffaloes found!")
     
     with tab2:
-        conn = sqlite3.connect('buffalomitra.db')
-        df = pd.read_sql_query(
-            """SELECT hr.date, bi.tag_number, bi.name, hr.record_type, 
-               hr.disease_name, hr.treatment, hr.cost
-               FROM health_records hr
-               JOIN buffalo_inventory bi ON hr.buffalo_id = bi.id
-               WHERE hr.user_id=? 
-               ORDER BY hr.date DESC""",
-            conn, params=(user['id'],))
-        conn.close()
+        with get_connection() as conn:
+            df = cached_frame(conn, user['id'],
+                """SELECT hr.date, bi.tag_number, bi.name, hr.record_type, 
+                   hr.disease_name, hr.treatment, hr.cost
+                   FROM health_records hr
+                   JOIN buffalo_inventory bi ON hr.buffalo_id = bi.id
+                   WHERE hr.user_id=? 
+                   ORDER BY hr.date DESC""",
+                (user['id'],))
         
         if not df.empty:
             st.dataframe(df, use_container_width=True)
@@ -1486,25 +1495,21 @@ def show_financial_manager():
             submitted = st.form_submit_button("Add", use_container_width=True, type="primary")
             
             if submitted:
-                conn = sqlite3.connect('buffalomitra.db')
-                c = conn.cursor()
-                c.execute("""INSERT INTO financial_records 
-                            (user_id, date, category, transaction_type, amount, description)
-                            VALUES (?, ?, ?, ?, ?, ?)""",
-                         (user['id'], date, category, transaction_type, amount, description))
-                conn.commit()
-                conn.close()
+                with get_connection() as conn:
+                    c = conn.cursor()
+                    c.execute("""INSERT INTO financial_records 
+                                (user_id, date, category, transaction_type, amount, description)
+                                VALUES (?, ?, ?, ?, ?, ?)""",
+                             (user['id'], date, category, transaction_type, amount, description))
+                    conn.commit()
                 st.success("Transaction added!")
                 st.rerun()
     
     with tab2:
-        conn = sqlite3.connect('buffalomitra.db')
-        c = conn.cursor()
-        
-        c.execute("""SELECT transaction_type, SUM(amount) FROM financial_records 
-                     WHERE user_id=? GROUP BY transaction_type""", (user['id'],))
-        summary = dict(c.fetchall())
-        conn.close()
+        with get_connection() as conn:
+            summary = dict(cached_rows(conn, user['id'],
+                                       """SELECT transaction_type, SUM(amount) FROM financial_records 
+                                          WHERE user_id=? GROUP BY transaction_type""", (user['id'],)))
         
         total_income = summary.get('Income', 0)
         total_expense = summary.get('Expense', 0)
@@ -1585,14 +1590,13 @@ def show_buyer_connect():
         submitted = st.form_submit_button("Register", use_container_width=True, type="primary")
         
         if submitted and buyer_name and contact:
-            conn = sqlite3.connect('buffalomitra.db')
-            c = conn.cursor()
-            c.execute("""INSERT INTO milk_buyers 
-                        (user_id, buyer_name, contact, price_per_liter, payment_terms, active)
-                        VALUES (?, ?, ?, ?, ?, 1)""",
-                     (user['id'], buyer_name, contact, price_per_liter, payment_terms))
-            conn.commit()
-            conn.close()
+            with get_connection() as conn:
+                c = conn.cursor()
+                c.execute("""INSERT INTO milk_buyers 
+                            (user_id, buyer_name, contact, price_per_liter, payment_terms, active)
+                            VALUES (?, ?, ?, ?, ?, 1)""",
+                         (user['id'], buyer_name, contact, price_per_liter, payment_terms))
+                conn.commit()
             st.success("Buyer registered!")
             st.rerun()
 
@@ -1640,6 +1644,34 @@ def show_alerts_reminders():
                 st.markdown(f'<div class="warning-card">{alert["message"]}</div>', unsafe_allow_html=True)
     else:
         st.success("No pending alerts!")
+    
+    # Everything dated in the chosen window, read from the farm_events timeline
+    st.markdown("### Farm Calendar")
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        days = st.selectbox("Show next", [7, 30, 90], index=1, format_func=lambda d: f"{d} days")
+    with col2:
+        types = st.multiselect("Events", list(EVENT_TYPES), format_func=EVENT_TYPES.get,
+                               default=[t for t in EVENT_TYPES if t != 'heat'])
+    
+    with get_connection() as conn:
+        events = upcoming_events(conn, user['id'], days, types=types)
+    
+    if events:
+        df_events = pd.DataFrame(events)
+        fig = px.scatter(df_events, x='date', y='label', color='label',
+                         hover_data=['tag_number', 'name', 'detail'],
+                         title=f'Farm Events in the Next {days} Days',
+                         labels={'date': 'Date', 'label': 'Event'})
+        fig.update_layout(showlegend=False)
+        st.plotly_chart(fig, use_container_width=True)
+        
+        st.dataframe(df_events[['date', 'label', 'tag_number', 'name', 'detail']],
+                     column_config={'date': "Date", 'label': "Event", 'tag_number': "Tag",
+                                    'name': "Name", 'detail': "Details"},
+                     hide_index=True, use_container_width=True)
+    else:
+        st.info(f"Nothing scheduled in the next {days} days.")
 
 def show_calf_management():
     st.markdown("### Calf Management")
@@ -1648,12 +1680,10 @@ def show_calf_management():
     tab1, tab2 = st.tabs(["Add Calf", "View Calves"])
     
     with tab1:
-        conn = sqlite3.connect('buffalomitra.db')
-        c = conn.cursor()
-        c.execute("""SELECT id, tag_number, name FROM buffalo_inventory 
-                     WHERE user_id=? AND status='Active'""", (user['id'],))
-        buffaloes = c.fetchall()
-        conn.close()
+        with get_connection() as conn:
+            buffaloes = cached_rows(conn, user['id'],
+                                    """SELECT id, tag_number, name FROM buffalo_inventory 
+                                       WHERE user_id=? AND status='Active'""", (user['id'],))
         
         if buffaloes:
             with st.form("add_calf"):
@@ -1675,36 +1705,33 @@ def show_calf_management():
                 submitted = st.form_submit_button("Add Calf", use_container_width=True, type="primary")
                 
                 if submitted and tag_number:
-                    conn = sqlite3.connect('buffalomitra.db')
-                    c = conn.cursor()
-                    try:
-                        c.execute("""INSERT INTO calf_records 
-                                    (user_id, mother_buffalo_id, tag_number, name, date_of_birth, 
-                                     gender, birth_weight, breed, status, notes)
-                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'Active', ?)""",
-                                 (user['id'], mother_id, tag_number, name, dob, gender, 
-                                  birth_weight, breed, notes))
-                        conn.commit()
-                        st.success("Calf added successfully!")
-                        st.rerun()
-                    except sqlite3.IntegrityError:
-                        st.error("Tag number already exists!")
-                    finally:
-                        conn.close()
+                    with get_connection() as conn:
+                        c = conn.cursor()
+                        try:
+                            c.execute("""INSERT INTO calf_records 
+                                        (user_id, mother_buffalo_id, tag_number, name, date_of_birth, 
+                                         gender, birth_weight, breed, status, notes)
+                                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'Active', ?)""",
+                                     (user['id'], mother_id, tag_number, name, dob, gender, 
+                                      birth_weight, breed, notes))
+                            conn.commit()
+                            st.success("Calf added successfully!")
+                            st.rerun()
+                        except sqlite3.IntegrityError:
+                            st.error("Tag number already exists!")
         else:
             st.warning("No buffaloes found!")
     
     with tab2:
-        conn = sqlite3.connect('buffalomitra.db')
-        df = pd.read_sql_query(
-            """SELECT c.tag_number, c.name, c.gender, c.date_of_birth, c.birth_weight,
-               c.breed, b.name as mother_name, c.status
-               FROM calf_records c
-               JOIN buffalo_inventory b ON c.mother_buffalo_id = b.id
-               WHERE c.user_id=?
-               ORDER BY c.date_of_birth DESC""",
-            conn, params=(user['id'],))
-        conn.close()
+        with get_connection() as conn:
+            df = cached_frame(conn, user['id'],
+                """SELECT c.tag_number, c.name, c.gender, c.date_of_birth, c.birth_weight,
+                   c.breed, b.name as mother_name, c.status
+                   FROM calf_records c
+                   JOIN buffalo_inventory b ON c.mother_buffalo_id = b.id
+                   WHERE c.user_id=?
+                   ORDER BY c.date_of_birth DESC""",
+                (user['id'],))
         
         if not df.empty:
             st.dataframe(df, use_container_width=True)
@@ -1722,15 +1749,13 @@ def show_heat_detection():
     st.markdown("### Heat Detection Tracker")
     user = st.session_state.user_data
     
-    tab1, tab2 = st.tabs(["Record Heat", "Heat History"])
+    tab1, tab2, tab3 = st.tabs(["Record Heat", "Heat Calendar", "Heat History"])
     
     with tab1:
-        conn = sqlite3.connect('buffalomitra.db')
-        c = conn.cursor()
-        c.execute("""SELECT id, tag_number, name FROM buffalo_inventory 
-                     WHERE user_id=? AND status='Active'""", (user['id'],))
-        buffaloes = c.fetchall()
-        conn.close()
+        with get_connection() as conn:
+            buffaloes = cached_rows(conn, user['id'],
+                                    """SELECT id, tag_number, name FROM buffalo_inventory 
+                                       WHERE user_id=? AND status='Active'""", (user['id'],))
         
         if buffaloes:
             with st.form("record_heat"):
@@ -1749,29 +1774,69 @@ def show_heat_detection():
                 submitted = st.form_submit_button("Record Heat", use_container_width=True, type="primary")
                 
                 if submitted:
-                    conn = sqlite3.connect('buffalomitra.db')
-                    c = conn.cursor()
-                    c.execute("""INSERT INTO heat_detection 
-                                (user_id, buffalo_id, heat_date, heat_intensity, bred, notes)
-                                VALUES (?, ?, ?, ?, ?, ?)""",
-                             (user['id'], buffalo_id, heat_date, heat_intensity, bred, notes))
-                    conn.commit()
-                    conn.close()
+                    with get_connection() as conn:
+                        c = conn.cursor()
+                        c.execute("""INSERT INTO heat_detection 
+                                    (user_id, buffalo_id, heat_date, heat_intensity, bred, notes)
+                                    VALUES (?, ?, ?, ?, ?, ?)""",
+                                 (user['id'], buffalo_id, heat_date, heat_intensity, bred, notes))
+                        notify_write(conn, user['id'], 'heat_detection', c.lastrowid)
+                        conn.commit()
                     st.success("Heat recorded!")
                     st.rerun()
         else:
             st.warning("No buffaloes found!")
     
     with tab2:
-        conn = sqlite3.connect('buffalomitra.db')
-        df = pd.read_sql_query(
-            """SELECT h.heat_date, b.tag_number, b.name, h.heat_intensity, h.bred
-               FROM heat_detection h
-               JOIN buffalo_inventory b ON h.buffalo_id = b.id
-               WHERE h.user_id=?
-               ORDER BY h.heat_date DESC LIMIT 50""",
-            conn, params=(user['id'],))
-        conn.close()
+        # Next heat window of every open buffalo, from its own recorded cycle
+        with get_connection() as conn:
+            predictions = herd_heats(conn, user['id'])
+        
+        if not predictions.empty:
+            today = pd.Timestamp(datetime.now().date())
+            col1, col2, col3 = st.columns(3)
+            col1.metric("In heat window now", int((predictions['window_start'] <= today).sum()))
+            col2.metric("Expected in next 7 days",
+                        int(predictions['expected'].between(today, today + pd.Timedelta(days=7)).sum()))
+            col3.metric("Open buffaloes tracked", len(predictions))
+            
+            upcoming = predictions[predictions['window_start'] <= today + pd.Timedelta(days=30)]
+            if not upcoming.empty:
+                fig = px.timeline(upcoming.assign(window_end=upcoming['window_end'] + pd.Timedelta(days=1)),
+                                  x_start='window_start', x_end='window_end', y='tag_number',
+                                  hover_data={'name': True, 'expected': '|%d %b'},
+                                  title='Predicted Heat Windows (Next 30 Days)',
+                                  labels={'tag_number': 'Buffalo Tag'})
+                fig.update_yaxes(autorange='reversed')
+                st.plotly_chart(fig, use_container_width=True)
+            
+            st.dataframe(
+                predictions[['tag_number', 'name', 'expected', 'window_start', 'window_end', 'last_heat',
+                             'heats', 'cycle_days']],
+                column_config={
+                    'tag_number': "Tag", 'name': "Name",
+                    'expected': st.column_config.DateColumn("Expected Heat"),
+                    'window_start': st.column_config.DateColumn("Window From"),
+                    'window_end': st.column_config.DateColumn("Window To"),
+                    'last_heat': st.column_config.DateColumn("Last Heat"),
+                    'heats': "Heats Recorded",
+                    'cycle_days': st.column_config.NumberColumn("Cycle (days)", format="%.1f"),
+                },
+                hide_index=True, use_container_width=True)
+            st.caption(f"Cycle lengths start at the {CYCLE_DAYS:.0f}-day buffalo norm and move toward each "
+                       "buffalo's own recorded cycle as heats are logged. Pregnant buffaloes are not shown.")
+        else:
+            st.info("Record heats to predict when each buffalo will next come into heat.")
+    
+    with tab3:
+        with get_connection() as conn:
+            df = cached_frame(conn, user['id'],
+                """SELECT h.heat_date, b.tag_number, b.name, h.heat_intensity, h.bred
+                   FROM heat_detection h
+                   JOIN buffalo_inventory b ON h.buffalo_id = b.id
+                   WHERE h.user_id=?
+                   ORDER BY h.heat_date DESC LIMIT 50""",
+                (user['id'],))
         
         if not df.empty:
             st.dataframe(df, use_container_width=True)
@@ -1785,12 +1850,10 @@ def show_vaccination_schedule():
     tab1, tab2, tab3 = st.tabs(["Record Vaccination", "Upcoming Due", "History"])
     
     with tab1:
-        conn = sqlite3.connect('buffalomitra.db')
-        c = conn.cursor()
-        c.execute("""SELECT id, tag_number, name FROM buffalo_inventory 
-                     WHERE user_id=? AND status='Active'""", (user['id'],))
-        buffaloes = c.fetchall()
-        conn.close()
+        with get_connection() as conn:
+            buffaloes = cached_rows(conn, user['id'],
+                                    """SELECT id, tag_number, name FROM buffalo_inventory 
+                                       WHERE user_id=? AND status='Active'""", (user['id'],))
         
         if buffaloes:
             with st.form("record_vaccination"):
@@ -1813,16 +1876,16 @@ def show_vaccination_schedule():
                 submitted = st.form_submit_button("Record Vaccination", use_container_width=True, type="primary")
                 
                 if submitted:
-                    conn = sqlite3.connect('buffalomitra.db')
-                    c = conn.cursor()
-                    c.execute("""INSERT INTO vaccination_records 
-                                (user_id, buffalo_id, vaccination_type, date, next_due_date, 
-                                 veterinarian, cost, batch_number)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                             (user['id'], buffalo_id, vacc_type, date, next_due, 
-                              veterinarian, cost, batch_number))
-                    conn.commit()
-                    conn.close()
+                    with get_connection() as conn:
+                        c = conn.cursor()
+                        c.execute("""INSERT INTO vaccination_records 
+                                    (user_id, buffalo_id, vaccination_type, date, next_due_date, 
+                                     veterinarian, cost, batch_number)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                                 (user['id'], buffalo_id, vacc_type, date, next_due, 
+                                  veterinarian, cost, batch_number))
+                        notify_write(conn, user['id'], 'vaccination_records', c.lastrowid)
+                        conn.commit()
                     st.success("Vaccination recorded!")
                     st.rerun()
         else:
@@ -1830,15 +1893,14 @@ def show_vaccination_schedule():
     
     with tab2:
         st.markdown("### Upcoming Vaccinations")
-        conn = sqlite3.connect('buffalomitra.db')
-        df = pd.read_sql_query(
-            """SELECT v.next_due_date, b.tag_number, b.name, v.vaccination_type
-               FROM vaccination_records v
-               JOIN buffalo_inventory b ON v.buffalo_id = b.id
-               WHERE v.user_id=? AND v.next_due_date >= date('now')
-               ORDER BY v.next_due_date LIMIT 20""",
-            conn, params=(user['id'],))
-        conn.close()
+        with get_connection() as conn:
+            df = cached_frame(conn, user['id'],
+                """SELECT v.next_due_date, b.tag_number, b.name, v.vaccination_type
+                   FROM vaccination_records v
+                   JOIN buffalo_inventory b ON v.buffalo_id = b.id
+                   WHERE v.user_id=? AND v.next_due_date >= date('now')
+                   ORDER BY v.next_due_date LIMIT 20""",
+                (user['id'],))
         
         if not df.empty:
             st.dataframe(df, use_container_width=True)
@@ -1846,16 +1908,15 @@ def show_vaccination_schedule():
             st.info("No upcoming vaccinations")
     
     with tab3:
-        conn = sqlite3.connect('buffalomitra.db')
-        df = pd.read_sql_query(
-            """SELECT v.date, b.tag_number, b.name, v.vaccination_type, 
-               v.veterinarian, v.cost
-               FROM vaccination_records v
-               JOIN buffalo_inventory b ON v.buffalo_id = b.id
-               WHERE v.user_id=?
-               ORDER BY v.date DESC""",
-            conn, params=(user['id'],))
-        conn.close()
+        with get_connection() as conn:
+            df = cached_frame(conn, user['id'],
+                """SELECT v.date, b.tag_number, b.name, v.vaccination_type, 
+                   v.veterinarian, v.cost
+                   FROM vaccination_records v
+                   JOIN buffalo_inventory b ON v.buffalo_id = b.id
+                   WHERE v.user_id=?
+                   ORDER BY v.date DESC""",
+                (user['id'],))
         
         if not df.empty:
             st.dataframe(df, use_container_width=True)
@@ -1884,29 +1945,28 @@ def show_feed_inventory():
             submitted = st.form_submit_button("Save", use_container_width=True, type="primary")
             
             if submitted and feed_name:
-                conn = sqlite3.connect('buffalomitra.db')
-                c = conn.cursor()
-                c.execute("""INSERT OR REPLACE INTO feed_inventory 
-                            (user_id, feed_name, feed_type, current_stock_kg, reorder_level_kg,
-                             last_purchase_date, last_purchase_quantity, last_purchase_cost, supplier)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                         (user['id'], feed_name, feed_type, current_stock, reorder_level,
-                          last_purchase_date, last_purchase_quantity, last_purchase_cost, supplier))
-                conn.commit()
-                conn.close()
+                with get_connection() as conn:
+                    c = conn.cursor()
+                    c.execute("""INSERT OR REPLACE INTO feed_inventory 
+                                (user_id, feed_name, feed_type, current_stock_kg, reorder_level_kg,
+                                 last_purchase_date, last_purchase_quantity, last_purchase_cost, supplier)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                             (user['id'], feed_name, feed_type, current_stock, reorder_level,
+                              last_purchase_date, last_purchase_quantity, last_purchase_cost, supplier))
+                    notify_write(conn, user['id'], 'feed_inventory', c.lastrowid)
+                    conn.commit()
                 st.success("Feed stock updated!")
                 st.rerun()
     
     with tab2:
-        conn = sqlite3.connect('buffalomitra.db')
-        df = pd.read_sql_query(
-            """SELECT feed_name, feed_type, current_stock_kg, reorder_level_kg,
-               last_purchase_date, supplier
-               FROM feed_inventory
-               WHERE user_id=?
-               ORDER BY feed_type, feed_name""",
-            conn, params=(user['id'],))
-        conn.close()
+        with get_connection() as conn:
+            df = cached_frame(conn, user['id'],
+                """SELECT feed_name, feed_type, current_stock_kg, reorder_level_kg,
+                   last_purchase_date, supplier
+                   FROM feed_inventory
+                   WHERE user_id=?
+                   ORDER BY feed_type, feed_name""",
+                (user['id'],))
         
         if not df.empty:
             st.dataframe(df, use_container_width=True)
@@ -1938,26 +1998,24 @@ def show_labor_management():
             submitted = st.form_submit_button("Add Worker", use_container_width=True, type="primary")
             
             if submitted and worker_name:
-                conn = sqlite3.connect('buffalomitra.db')
-                c = conn.cursor()
-                c.execute("""INSERT INTO labor_records 
-                            (user_id, worker_name, contact, role, monthly_salary, join_date, active)
-                            VALUES (?, ?, ?, ?, ?, ?, 1)""",
-                         (user['id'], worker_name, contact, role, monthly_salary, join_date))
-                conn.commit()
-                conn.close()
+                with get_connection() as conn:
+                    c = conn.cursor()
+                    c.execute("""INSERT INTO labor_records 
+                                (user_id, worker_name, contact, role, monthly_salary, join_date, active)
+                                VALUES (?, ?, ?, ?, ?, ?, 1)""",
+                             (user['id'], worker_name, contact, role, monthly_salary, join_date))
+                    conn.commit()
                 st.success("Worker added!")
                 st.rerun()
     
     with tab2:
-        conn = sqlite3.connect('buffalomitra.db')
-        df = pd.read_sql_query(
-            """SELECT worker_name, contact, role, monthly_salary, join_date, active
-               FROM labor_records
-               WHERE user_id=?
-               ORDER BY active DESC, worker_name""",
-            conn, params=(user['id'],))
-        conn.close()
+        with get_connection() as conn:
+            df = cached_frame(conn, user['id'],
+                """SELECT worker_name, contact, role, monthly_salary, join_date, active
+                   FROM labor_records
+                   WHERE user_id=?
+                   ORDER BY active DESC, worker_name""",
+                (user['id'],))
         
         if not df.empty:
             st.dataframe(df, use_container_width=True)
@@ -1971,85 +2029,117 @@ def show_advanced_analytics():
     st.markdown("### Advanced Analytics")
     user = st.session_state.user_data
     
-    conn = sqlite3.connect('buffalomitra.db')
-    
-    # Buffalo-wise production
-    st.markdown("### Buffalo-wise Performance")
-    df_buffalo = pd.read_sql_query(
-        """SELECT b.tag_number, b.name, b.breed,
-           AVG(m.total_yield) as avg_yield,
-           AVG(m.fat_percentage) as avg_fat,
-           COUNT(m.id) as records
-           FROM buffalo_inventory b
-           LEFT JOIN milk_production m ON b.id = m.buffalo_id
-           WHERE b.user_id=? AND b.status='Active' AND m.date >= date('now', '-90 days')
-           GROUP BY b.id
-           HAVING records > 0
-           ORDER BY avg_yield DESC""",
-        conn, params=(user['id'],))
-    
-    if not df_buffalo.empty:
-        fig = px.bar(df_buffalo, x='tag_number', y='avg_yield', 
-                    title='Average Daily Milk Yield by Buffalo (Last 90 Days)',
-                    labels={'avg_yield': 'Avg Milk (L)', 'tag_number': 'Buffalo Tag'},
-                    color='avg_fat', color_continuous_scale='Viridis')
-        st.plotly_chart(fig, use_container_width=True)
+    with get_connection() as conn:
+        # Buffalo-wise production
+        st.markdown("### Buffalo-wise Performance")
+        df_buffalo = cached_frame(conn, user['id'],
+            """SELECT b.tag_number, b.name, b.breed,
+               AVG(m.total_yield) as avg_yield,
+               AVG(m.fat_percentage) as avg_fat,
+               COUNT(m.id) as records
+               FROM buffalo_inventory b
+               LEFT JOIN milk_production m ON b.id = m.buffalo_id
+               WHERE b.user_id=? AND b.status='Active' AND m.date >= date('now', '-90 days')
+               GROUP BY b.id
+               HAVING records > 0
+               ORDER BY avg_yield DESC""",
+            (user['id'],))
+    
+        if not df_buffalo.empty:
+            fig = px.bar(df_buffalo, x='tag_number', y='avg_yield', 
+                        title='Average Daily Milk Yield by Buffalo (Last 90 Days)',
+                        labels={'avg_yield': 'Avg Milk (L)', 'tag_number': 'Buffalo Tag'},
+                        color='avg_fat', color_continuous_scale='Viridis')
+            st.plotly_chart(fig, use_container_width=True)
         
-        st.dataframe(df_buffalo, use_container_width=True)
-    
-    # Breed-wise comparison
-    st.markdown("### Breed-wise Comparison")
-    df_breed = pd.read_sql_query(
-        """SELECT b.breed,
-           COUNT(DISTINCT b.id) as count,
-           AVG(m.total_yield) as avg_yield,
-           AVG(m.fat_percentage) as avg_fat
-           FROM buffalo_inventory b
-           LEFT JOIN milk_production m ON b.id = m.buffalo_id
-           WHERE b.user_id=? AND m.date >= date('now', '-90 days')
-           GROUP BY b.breed""",
-        conn, params=(user['id'],))
-    
-    if not df_breed.empty:
-        col1, col2 = st.columns(2)
-        with col1:
-            fig1 = px.pie(df_breed, values='count', names='breed', 
-                         title='Buffalo Distribution by Breed')
-            st.plotly_chart(fig1, use_container_width=True)
-        with col2:
-            fig2 = px.bar(df_breed, x='breed', y='avg_yield',
-                         title='Average Yield by Breed')
-            st.plotly_chart(fig2, use_container_width=True)
-    
-    # Monthly trends
-    st.markdown("### Monthly Production Trends")
-    df_monthly = pd.read_sql_query(
-        """SELECT strftime('%Y-%m', date) as month,
-           SUM(total_yield) as total_milk,
-           AVG(fat_percentage) as avg_fat,
-           COUNT(DISTINCT buffalo_id) as active_buffaloes
-           FROM milk_production
-           WHERE user_id=? AND date >= date('now', '-12 months')
-           GROUP BY month
-           ORDER BY month""",
-        conn, params=(user['id'],))
-    
-    if not df_monthly.empty:
-        fig = go.Figure()
-        fig.add_trace(go.Bar(x=df_monthly['month'], y=df_monthly['total_milk'],
-                            name='Total Milk', yaxis='y'))
-        fig.add_trace(go.Scatter(x=df_monthly['month'], y=df_monthly['avg_fat'],
-                                name='Avg Fat %', yaxis='y2', mode='lines+markers'))
+            st.dataframe(df_buffalo, use_container_width=True)
+    
+        # Lactation stage and projection from each animal's fitted Wood curve
+        st.markdown("### Lactation Curves")
+        lactation = herd_lactation(conn, user['id'])
+        fitted = lactation.dropna(subset=['wood_a'])
+        if not fitted.empty:
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Animals with a fitted curve", f"{len(fitted)} / {len(lactation)}")
+            col2.metric("Avg projected 305-day yield", f"{fitted['yield_305'].mean():,.0f} L")
+            col3.metric("Avg peak yield", f"{fitted['peak_yield'].mean():.1f} L/day")
+            
+            shown = st.multiselect("Compare curves", fitted['tag_number'].tolist(),
+                                   default=fitted.nlargest(5, 'yield_305')['tag_number'].tolist())
+            if shown:
+                curves = lactation_curve_points(fitted[fitted['tag_number'].isin(shown)])
+                fig = px.line(curves, x='day', y='litres', color='tag_number',
+                              title="Fitted lactation curves (Wood's model)",
+                              labels={'day': 'Day of lactation', 'litres': 'Milk (L/day)', 'tag_number': 'Buffalo'})
+                st.plotly_chart(fig, use_container_width=True)
         
-        fig.update_layout(
-            title='Monthly Production & Fat % Trends',
-            xaxis=dict(title='Month'),
-            yaxis=dict(title='Total Milk (L)'),
-            yaxis2=dict(title='Fat %', overlaying='y', side='right')
-        )
-        st.plotly_chart(fig, use_container_width=True)
+        if not lactation.empty:
+            st.dataframe(
+                lactation[['tag_number', 'name', 'lactation_start', 'days_in_milk', 'stage', 'records',
+                           'peak_day', 'peak_yield', 'expected_today', 'yield_305']],
+                column_config={
+                    'tag_number': "Tag", 'name': "Name", 'lactation_start': "Lactation Start",
+                    'days_in_milk': "Days in Milk", 'stage': "Stage", 'records': "Records",
+                    'peak_day': "Peak Day",
+                    'peak_yield': st.column_config.NumberColumn("Peak (L/day)", format="%.1f"),
+                    'expected_today': st.column_config.NumberColumn("Expected Today (L)", format="%.1f"),
+                    'yield_305': st.column_config.NumberColumn("Projected 305-day (L)", format="%.0f"),
+                },
+                hide_index=True, use_container_width=True)
+            st.caption("Curves need at least 10 records spread over a few weeks of the current lactation.")
+    
+        # Breed-wise comparison
+        st.markdown("### Breed-wise Comparison")
+        df_breed = cached_frame(conn, user['id'],
+            """SELECT b.breed,
+               COUNT(DISTINCT b.id) as count,
+               AVG(m.total_yield) as avg_yield,
+               AVG(m.fat_percentage) as avg_fat
+               FROM buffalo_inventory b
+               LEFT JOIN milk_production m ON b.id = m.buffalo_id
+               WHERE b.user_id=? AND m.date >= date('now', '-90 days')
+               GROUP BY b.breed""",
+            (user['id'],))
+    
+        if not df_breed.empty:
+            col1, col2 = st.columns(2)
+            with col1:
+                fig1 = px.pie(df_breed, values='count', names='breed', 
+                             title='Buffalo Distribution by Breed')
+                st.plotly_chart(fig1, use_container_width=True)
+            with col2:
+                fig2 = px.bar(df_breed, x='breed', y='avg_yield',
+                             title='Average Yield by Breed')
+                st.plotly_chart(fig2, use_container_width=True)
+    
+        # Monthly trends
+        st.markdown("### Monthly Production Trends")
+        df_monthly = cached_frame(conn, user['id'],
+            """SELECT strftime('%Y-%m', date) as month,
+               SUM(total_yield) as total_milk,
+               AVG(fat_percentage) as avg_fat,
+               COUNT(DISTINCT buffalo_id) as active_buffaloes
+               FROM milk_production
+               WHERE user_id=? AND date >= date('now', '-12 months')
+               GROUP BY month
+               ORDER BY month""",
+            (user['id'],))
+    
+        if not df_monthly.empty:
+            fig = go.Figure()
+            fig.add_trace(go.Bar(x=df_monthly['month'], y=df_monthly['total_milk'],
+                                name='Total Milk', yaxis='y'))
+            fig.add_trace(go.Scatter(x=df_monthly['month'], y=df_monthly['avg_fat'],
+                                    name='Avg Fat %', yaxis='y2', mode='lines+markers'))
+        
+            fig.update_layout(
+                title='Monthly Production & Fat % Trends',
+                xaxis=dict(title='Month'),
+                yaxis=dict(title='Total Milk (L)'),
+                yaxis2=dict(title='Fat %', overlaying='y', side='right')
+            )
+            st.plotly_chart(fig, use_container_width=True)
     
-    conn.close()
 
 def show_reports_generator():
     st.markdown("### Reports Generator")
@@ -2067,122 +2157,172 @@ def show_reports_generator():
         start_date = st.date_input("Start Date", value=datetime.now().date() - timedelta(days=30))
     with col2:
         end_date = st.date_input("End Date", value=datetime.now().date())
+    export_format = st.selectbox("Export Format", available_formats())
     
     if st.button("Generate Report", type="primary", use_container_width=True):
-        conn = sqlite3.connect('buffalomitra.db')
-        
-        if report_type == "Monthly Production Report":
-            st.markdown("### Monthly Production Report")
-            st.markdown(f"**Period:** {start_date} to {end_date}")
+        params = (user['id'], start_date, end_date)
+        with get_connection() as conn:
+            # Cards come from SQL aggregates and the table from a bounded head of
+            # the report; only the export reads every row, in chunks
+            if report_type == "Monthly Production Report":
+                st.markdown("### Monthly Production Report")
+                st.markdown(f"**Period:** {start_date} to {end_date}")
             
-            df = pd.read_sql_query(
-                """SELECT date, 
-                   SUM(total_yield) as daily_milk,
-                   AVG(fat_percentage) as avg_fat,
-                   AVG(price_per_liter) as avg_price
-                   FROM milk_production
-                   WHERE user_id=? AND date BETWEEN ? AND ?
-                   GROUP BY date
-                   ORDER BY date""",
-                conn, params=(user['id'], start_date, end_date))
+                sql = """SELECT date, 
+                         total_litres as daily_milk,
+                         avg_fat,
+                         revenue / NULLIF(total_litres, 0) as avg_price,
+                         animals_milked
+                         FROM milk_daily_summary
+                         WHERE user_id=? AND date BETWEEN ? AND ?
+                         ORDER BY date"""
+                rows, total_milk, avg_daily, total_revenue = conn.execute(
+                    """SELECT COUNT(*), SUM(total_litres), AVG(total_litres), SUM(revenue)
+                       FROM milk_daily_summary
+                       WHERE user_id=? AND date BETWEEN ? AND ?""", params).fetchone()
             
-            if not df.empty:
-                total_milk = df['daily_milk'].sum()
-                avg_daily = df['daily_milk'].mean()
-                total_revenue = (df['daily_milk'] * df['avg_price']).sum()
-                
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric("Total Milk Production", f"{total_milk:.1f} L")
-                with col2:
-                    st.metric("Average Daily Production", f"{avg_daily:.1f} L")
-                with col3:
-                    st.metric("Total Revenue", f"₹{total_revenue:,.0f}")
-                
-                st.dataframe(df, use_container_width=True)
-                
-                # Download option
-                csv = df.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    "Download Report as CSV",
-                    csv,
-                    "production_report.csv",
-                    "text/csv",
-                    key='download-csv'
-                )
+                if rows:
+                    col1, col2, col3 = st.columns(3)
+                    with col1:
+                        st.metric("Total Milk Production", f"{total_milk or 0:.1f} L")
+                    with col2:
+                        st.metric("Average Daily Production", f"{avg_daily or 0:.1f} L")
+                    with col3:
+                        st.metric("Total Revenue", f"₹{total_revenue or 0:,.0f}")
         
-        elif report_type == "Financial Summary Report":
-            st.markdown("### Financial Summary Report")
-            st.markdown(f"**Period:** {start_date} to {end_date}")
+            elif report_type == "Financial Summary Report":
+                st.markdown("### Financial Summary Report")
+                st.markdown(f"**Period:** {start_date} to {end_date}")
             
-            df = pd.read_sql_query(
-                """SELECT category, transaction_type, SUM(amount) as total
-                   FROM financial_records
-                   WHERE user_id=? AND date BETWEEN ? AND ?
-                   GROUP BY category, transaction_type
-                   ORDER BY transaction_type, total DESC""",
-                conn, params=(user['id'], start_date, end_date))
+                sql = """SELECT category, transaction_type, SUM(amount) as total
+                         FROM financial_records
+                         WHERE user_id=? AND date BETWEEN ? AND ?
+                         GROUP BY category, transaction_type
+                         ORDER BY transaction_type, total DESC"""
+                rows, income, expense = conn.execute(
+                    """SELECT COUNT(*), SUM(CASE WHEN transaction_type='Income' THEN total END),
+                              SUM(CASE WHEN transaction_type='Expense' THEN total END)
+                       FROM (SELECT transaction_type, SUM(amount) AS total
+                             FROM financial_records
+                             WHERE user_id=? AND date BETWEEN ? AND ?
+                             GROUP BY category, transaction_type)""", params).fetchone()
             
-            if not df.empty:
-                income = df[df['transaction_type'] == 'Income']['total'].sum()
-                expense = df[df['transaction_type'] == 'Expense']['total'].sum()
-                profit = income - expense
-                
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric("Total Income", f"₹{income:,.0f}")
-                with col2:
-                    st.metric("Total Expense", f"₹{expense:,.0f}")
-                with col3:
-                    st.metric("Net Profit", f"₹{profit:,.0f}")
+                if rows:
+                    income, expense = income or 0, expense or 0
+                    profit = income - expense
                 
-                st.dataframe(df, use_container_width=True)
+                    col1, col2, col3 = st.columns(3)
+                    with col1:
+                        st.metric("Total Income", f"₹{income:,.0f}")
+                    with col2:
+                        st.metric("Total Expense", f"₹{expense:,.0f}")
+                    with col3:
+                        st.metric("Net Profit", f"₹{profit:,.0f}")
         
-        elif report_type == "Buffalo Health Report":
-            st.markdown("### Buffalo Health Report")
-            st.markdown(f"**Period:** {start_date} to {end_date}")
+            elif report_type == "Buffalo Health Report":
+                st.markdown("### Buffalo Health Report")
+                st.markdown(f"**Period:** {start_date} to {end_date}")
             
-            df = pd.read_sql_query(
-                """SELECT b.tag_number, b.name, h.date, h.record_type, 
-                   h.disease_name, h.treatment, h.cost
-                   FROM health_records h
-                   JOIN buffalo_inventory b ON h.buffalo_id = b.id
-                   WHERE h.user_id=? AND h.date BETWEEN ? AND ?
-                   ORDER BY h.date DESC""",
-                conn, params=(user['id'], start_date, end_date))
+                sql = """SELECT b.tag_number, b.name, h.date, h.record_type, 
+                         h.disease_name, h.treatment, h.cost
+                         FROM health_records h
+                         JOIN buffalo_inventory b ON h.buffalo_id = b.id
+                         WHERE h.user_id=? AND h.date BETWEEN ? AND ?
+                         ORDER BY h.date DESC"""
+                rows, total_cost = conn.execute(
+                    """SELECT COUNT(*), SUM(h.cost)
+                       FROM health_records h
+                       JOIN buffalo_inventory b ON h.buffalo_id = b.id
+                       WHERE h.user_id=? AND h.date BETWEEN ? AND ?""", params).fetchone()
             
-            if not df.empty:
-                st.dataframe(df, use_container_width=True)
-                st.metric("Total Health Expenditure", f"₹{df['cost'].sum():,.0f}")
+                if rows:
+                    st.metric("Total Health Expenditure", f"₹{total_cost or 0:,.0f}")
         
-        elif report_type == "Breeding Performance Report":
-            st.markdown("### Breeding Performance Report")
+            elif report_type == "Breeding Performance Report":
+                st.markdown("### Breeding Performance Report")
             
-            df = pd.read_sql_query(
-                """SELECT b.tag_number, b.name, br.breeding_date, br.breeding_type,
-                   br.expected_calving_date, br.pregnancy_status
-                   FROM breeding_records br
-                   JOIN buffalo_inventory b ON br.buffalo_id = b.id
-                   WHERE br.user_id=? AND br.breeding_date BETWEEN ? AND ?
-                   ORDER BY br.breeding_date DESC""",
-                conn, params=(user['id'], start_date, end_date))
+                sql = """SELECT b.tag_number, b.name, br.breeding_date, br.breeding_type,
+                         br.expected_calving_date, br.pregnancy_status
+                         FROM breeding_records br
+                         JOIN buffalo_inventory b ON br.buffalo_id = b.id
+                         WHERE br.user_id=? AND br.breeding_date BETWEEN ? AND ?
+                         ORDER BY br.breeding_date DESC"""
+                rows, ai_count, natural_count = conn.execute(
+                    """SELECT COUNT(*), SUM(br.breeding_type = 'AI'), SUM(br.breeding_type = 'Natural')
+                       FROM breeding_records br
+                       JOIN buffalo_inventory b ON br.buffalo_id = b.id
+                       WHERE br.user_id=? AND br.breeding_date BETWEEN ? AND ?""", params).fetchone()
             
-            if not df.empty:
-                st.dataframe(df, use_container_width=True)
-                
-                total_breeding = len(df)
-                ai_count = len(df[df['breeding_type'] == 'AI'])
-                natural_count = len(df[df['breeding_type'] == 'Natural'])
+                if rows:
+                    col1, col2, col3 = st.columns(3)
+                    with col1:
+                        st.metric("Total Breedings", rows)
+                    with col2:
+                        st.metric("AI Breedings", ai_count or 0)
+                    with col3:
+                        st.metric("Natural Breedings", natural_count or 0)
+            
+            if rows:
+                preview = pd.read_sql_query(sql + " LIMIT ?", conn, params=(*params, REPORT_PREVIEW_ROWS))
+                st.dataframe(preview, use_container_width=True)
+                if rows > REPORT_PREVIEW_ROWS:
+                    st.caption(f"Showing the first {REPORT_PREVIEW_ROWS:,} of {rows:,} rows; "
+                               "the download has all of them.")
                 
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric("Total Breedings", total_breeding)
-                with col2:
-                    st.metric("AI Breedings", ai_count)
-                with col3:
-                    st.metric("Natural Breedings", natural_count)
+                # The download is the exporter's temporary file, written chunk by chunk
+                extension, mime, _ = EXPORT_FORMATS[export_format]
+                with export_file(conn, sql, params, export_format) as data:
+                    st.download_button(
+                        f"Download Report as {export_format}",
+                        data,
+                        f"{report_type.lower().replace(' ', '_')}.{extension}",
+                        mime,
+                        key='download-report'
+                    )
+        
+
+def show_data_import():
+    st.markdown("### Data Import")
+    st.markdown("Bring in records from paper registers, spreadsheets or milk-analyser exports.")
+    user = st.session_state.user_data
+    
+    table = st.selectbox("Import Into", list(IMPORT_SPECS.keys()),
+                         format_func=lambda t: IMPORT_SPECS[t]['label'])
+    spec = IMPORT_SPECS[table]
+    columns = (['tag_number'] if spec['needs_buffalo'] else []) + list(spec['fields'].keys())
+    st.caption(f"**Columns:** {', '.join(columns)} (required: {', '.join(spec['required'])})")
+    
+    uploaded = st.file_uploader("CSV or Excel file", type=['csv', 'xlsx'])
+    
+    if uploaded and st.button("Import", type="primary", use_container_width=True):
+        progress_bar = st.progress(0.0, text="Starting import...")
+        
+        def show_progress(report):
+            progress_bar.progress(report.fraction_done or 0.0,
+                                  text=f"{report.rows_read:,} rows read, {report.inserted:,} imported")
+        
+        try:
+            with get_connection() as conn:
+                report = import_records(conn, user['id'], table, uploaded, uploaded.name,
+                                        progress=show_progress)
+        except ValueError as e:
+            st.error(str(e))
+            return
+        progress_bar.progress(1.0, text="Import complete")
+        
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("Rows Read", f"{report.rows_read:,}")
+        with col2:
+            st.metric("Imported", f"{report.inserted:,}")
+        with col3:
+            st.metric("Duplicates Skipped", f"{report.duplicates:,}")
+        with col4:
+            st.metric("Errors", f"{report.error_count:,}")
         
-        conn.close()
+        if report.errors:
+            st.warning(f"{report.error_count:,} rows were not imported")
+            st.dataframe(pd.DataFrame(report.errors, columns=['Line', 'Problem']), use_container_width=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file